@@ -12,6 +12,7 @@ from pycket.interpreter import (
     DefineValues,
     If,
     Lambda,
+    LazyBody,
     Let,
     Letrec,
     LexicalVar,
@@ -111,6 +112,11 @@ class AssignConvertVisitor(ASTVisitor):
         result.init_mutable_var_flags(need_cell_flags)
         return result
 
+    def visit_lazy_body(self, ast, vars, env_structure):
+        # the body itself is converted when it is forced
+        assert isinstance(ast, LazyBody)
+        return ast.with_conversion_context(vars, env_structure)
+
     def visit_letrec(self, ast, vars, env_structure):
         assert isinstance(ast, Letrec)
         local_muts = self.body_muts(ast)
@@ -160,8 +166,8 @@ class AssignConvertVisitor(ASTVisitor):
 
         new_body = [b.visit(self, new_vars, body_env_structures[i])
                     for i, b in enumerate(ast.body)]
-        result = Let(sub_env_structure, ast.counts, new_rhss, new_body,
-                     remove_num_envs)
+        result = Let.make(sub_env_structure, ast.counts, new_rhss, new_body,
+                          remove_num_envs)
         result.init_body_pruning(body_env_structure, body_remove_num_envs)
         result.init_mutable_var_flags(need_cell_flags)
         return result
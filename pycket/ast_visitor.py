@@ -10,6 +10,7 @@ from pycket.interpreter import (
     DefineValues,
     If,
     Lambda,
+    LazyBody,
     Let,
     Letrec,
     LexicalVar,
@@ -175,6 +176,11 @@ class ASTVisitor(object):
         assert isinstance(ast, Require)
         return ast
 
+    @specialize.argtype(0)
+    def visit_lazy_body(self, ast, *args):
+        assert isinstance(ast, LazyBody)
+        return ast
+
 class CopyVisitor(ASTVisitor):
 
     def visit_variable_reference(self, ast):
@@ -204,11 +210,11 @@ class CopyVisitor(ASTVisitor):
         assert isinstance(ast, Let)
         body = [b.visit(self) for b in ast.body]
         rhss = [r.visit(self) for r in ast.rhss]
-        result = Let(ast.args,
-                     ast.counts,
-                     rhss,
-                     body,
-                     ast.remove_num_envs)
+        result = Let.make(ast.args,
+                          ast.counts,
+                          rhss,
+                          body,
+                          ast.remove_num_envs)
         result.copy_body_pruning(ast)
         return result
 
@@ -0,0 +1,437 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A compact binary encoding of the expander output.
+#
+# The expander produces JSON, which is expensive to read back: every run has to
+# scan the whole text, decode every string and re-encode every object key. This
+# module stores the same tree in a binary form that can be decoded with very
+# little work:
+#
+#   HEADER                         magic bytes followed by the format version
+#   varint n, n x (varint, bytes)  the string table (keys, symbols, strings)
+#   node                           the root node
+#
+# A node is a one byte tag followed by its payload. Integers (which includes all
+# source locations) are zigzag varints, strings are varint indices into the
+# string table and arrays/objects are prefixed by their varint length.
+#
+# Decoding produces the same events as pycket_json.JsonEventReader, so the
+# JsonLoader converts either format form by form, without building the tree
+# of the whole module. Strings are shared through the table, which means keys
+# are never re-encoded and equal strings are only allocated once.
+#
+# The output of a complete expansion (`-c`) holds many modules. It is stored as
+# a bundle (`<file>.bundle.bin`), where every module is a separate binary AST
+# behind an index:
+#
+#   BUNDLE_HEADER                  magic bytes followed by the format version
+#   varint size                    size of the index in bytes
+#   index                          varint n, n x (name, varint offset, varint length)
+#   modules                        the encoded modules, offsets are relative to here
+#
+# A bundle is memory mapped and modules are only decoded when requested.
+
+import os
+
+from rpython.rlib             import streamio, rmmap
+from rpython.rlib.rarithmetic import r_uint, intmask, LONG_BIT
+from rpython.rlib.rfloat      import formatd, string_to_float
+from rpython.rlib.rstring     import StringBuilder
+from pycket                   import pycket_json
+
+FORMAT_VERSION = 1
+
+MAGIC  = "\x00PYCKET-AST"
+HEADER = MAGIC + chr(FORMAT_VERSION)
+
+BUNDLE_MAGIC  = "\x00PYCKET-MODS"
+BUNDLE_HEADER = BUNDLE_MAGIC + chr(FORMAT_VERSION)
+
+TAG_NULL   = 0
+TAG_FALSE  = 1
+TAG_TRUE   = 2
+TAG_INT    = 3
+TAG_FLOAT  = 4
+TAG_STRING = 5
+TAG_ARRAY  = 6
+TAG_OBJECT = 7
+
+class BinaryFormatError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def is_binary(data):
+    return data.startswith(MAGIC)
+
+def is_bundle(data):
+    return data.startswith(BUNDLE_MAGIC)
+
+#### ========================== Encoding
+
+class BinaryEncoder(object):
+
+    def __init__(self):
+        self.strings = []
+        self.string_index = {}
+        self.body = StringBuilder()
+
+    def intern(self, s):
+        index = self.string_index.get(s, -1)
+        if index < 0:
+            index = len(self.strings)
+            self.strings.append(s)
+            self.string_index[s] = index
+        return index
+
+    def encode(self, json):
+        if json.is_null:
+            self.body.append(chr(TAG_NULL))
+        elif json is pycket_json.json_false:
+            self.body.append(chr(TAG_FALSE))
+        elif json is pycket_json.json_true:
+            self.body.append(chr(TAG_TRUE))
+        elif json.is_int:
+            self.body.append(chr(TAG_INT))
+            write_varint(self.body, zigzag_encode(json.value_int()))
+        elif json.is_float:
+            self.body.append(chr(TAG_FLOAT))
+            s = formatd(json.value_float(), 'r', 0)
+            write_varint(self.body, r_uint(self.intern(s)))
+        elif json.is_string:
+            self.body.append(chr(TAG_STRING))
+            write_varint(self.body, r_uint(self.intern(json.value_string())))
+        elif json.is_array:
+            arr = json.value_array()
+            self.body.append(chr(TAG_ARRAY))
+            write_varint(self.body, r_uint(len(arr)))
+            for elem in arr:
+                self.encode(elem)
+        elif json.is_object:
+            obj = json.value_object()
+            self.body.append(chr(TAG_OBJECT))
+            write_varint(self.body, r_uint(len(obj)))
+            for key, value in obj.iteritems():
+                write_varint(self.body, r_uint(self.intern(key)))
+                self.encode(value)
+        else:
+            assert 0, "unknown json value"
+
+    def build(self):
+        result = StringBuilder()
+        result.append(HEADER)
+        write_varint(result, r_uint(len(self.strings)))
+        for s in self.strings:
+            write_varint(result, r_uint(len(s)))
+            result.append(s)
+        result.append(self.body.build())
+        return result.build()
+
+def dumps(json):
+    encoder = BinaryEncoder()
+    encoder.encode(json)
+    return encoder.build()
+
+def dump_bundle(names, modules):
+    assert len(names) == len(modules)
+    index = StringBuilder()
+    body = StringBuilder()
+    write_varint(index, r_uint(len(names)))
+    offset = 0
+    for i in range(len(names)):
+        name = names[i]
+        data = dumps(modules[i])
+        write_varint(index, r_uint(len(name)))
+        index.append(name)
+        write_varint(index, r_uint(offset))
+        write_varint(index, r_uint(len(data)))
+        body.append(data)
+        offset += len(data)
+    index = index.build()
+    result = StringBuilder()
+    result.append(BUNDLE_HEADER)
+    write_varint(result, r_uint(len(index)))
+    result.append(index)
+    result.append(body.build())
+    return result.build()
+
+def write_varint(builder, u):
+    while u >= 0x80:
+        builder.append(chr(intmask(u & 0x7f) | 0x80))
+        u = u >> 7
+    builder.append(chr(intmask(u)))
+
+def zigzag_encode(n):
+    return (r_uint(n) << 1) ^ r_uint(n >> (LONG_BIT - 1))
+
+def zigzag_decode(u):
+    return intmask((u >> 1) ^ (r_uint(0) - (u & 1)))
+
+#### ========================== Decoding
+
+class BinaryDecoder(object):
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.strings = []
+
+    def read_header(self, header=HEADER):
+        end = self.pos + len(header)
+        if self.data[self.pos:end] != header:
+            if self.data[self.pos:end - 1] == header[:len(header) - 1]:
+                raise BinaryFormatError("unsupported binary AST version %d, expected %d" %
+                                        (ord(self.data[end - 1]), FORMAT_VERSION))
+            raise BinaryFormatError("not a binary AST")
+        self.pos = end
+
+    def read_byte(self):
+        pos = self.pos
+        if pos >= len(self.data):
+            raise BinaryFormatError("truncated binary AST")
+        self.pos = pos + 1
+        return ord(self.data[pos])
+
+    def read_varint(self):
+        result = r_uint(0)
+        shift = 0
+        while True:
+            b = self.read_byte()
+            result |= r_uint(b & 0x7f) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+            if shift >= LONG_BIT:
+                raise BinaryFormatError("malformed varint in binary AST")
+
+    def read_length(self):
+        n = intmask(self.read_varint())
+        if n < 0:
+            raise BinaryFormatError("malformed length in binary AST")
+        return n
+
+    def read_bytes(self):
+        length = self.read_length()
+        start = self.pos
+        end = start + length
+        if end > len(self.data):
+            raise BinaryFormatError("truncated binary AST")
+        self.pos = end
+        return self.data[start:end]
+
+    def read_string_table(self):
+        n = self.read_length()
+        strings = [""] * n
+        for i in range(n):
+            strings[i] = self.read_bytes()
+        self.strings = strings
+
+    def read_string(self):
+        index = self.read_length()
+        if index >= len(self.strings):
+            raise BinaryFormatError("string index out of range in binary AST")
+        return index
+
+class BinaryEventReader(pycket_json.EventReader):
+    """ The events of a binary AST, see pycket_json.JsonEventReader """
+
+    def __init__(self, data):
+        pycket_json.EventReader.__init__(self)
+        self.decoder = BinaryDecoder(data)
+        self.decoder.read_header()
+        self.decoder.read_string_table()
+        # per open container, the entries left to read, which for objects
+        # counts keys and values separately, and whether it is an object
+        self.remaining = []
+        self.objects = []
+        self.started = False
+
+    def error(self, msg):
+        raise BinaryFormatError("%s at byte %d of binary AST" % (msg, self.decoder.pos))
+
+    def next(self):
+        decoder = self.decoder
+        depth = len(self.remaining)
+        if depth == 0:
+            if self.started:
+                if decoder.pos != len(decoder.data):
+                    raise BinaryFormatError("extra data after binary AST")
+                return pycket_json.EVENT_EOF
+            self.started = True
+        else:
+            remaining = self.remaining[depth - 1]
+            if remaining == 0:
+                self.remaining.pop()
+                if self.objects.pop():
+                    return pycket_json.EVENT_END_OBJECT
+                return pycket_json.EVENT_END_ARRAY
+            self.remaining[depth - 1] = remaining - 1
+            if self.objects[depth - 1] and remaining % 2 == 0:
+                self.key = decoder.strings[decoder.read_string()]
+                return pycket_json.EVENT_KEY
+        return self.read_value()
+
+    def read_value(self):
+        decoder = self.decoder
+        tag = decoder.read_byte()
+        if tag == TAG_NULL:
+            return pycket_json.EVENT_NULL
+        if tag == TAG_FALSE:
+            return pycket_json.EVENT_FALSE
+        if tag == TAG_TRUE:
+            return pycket_json.EVENT_TRUE
+        if tag == TAG_INT:
+            self.int_value = zigzag_decode(decoder.read_varint())
+            return pycket_json.EVENT_INT
+        if tag == TAG_FLOAT:
+            index = decoder.read_string()
+            self.float_value = string_to_float(decoder.strings[index])
+            return pycket_json.EVENT_FLOAT
+        if tag == TAG_STRING:
+            self.string_value = decoder.strings[decoder.read_string()]
+            return pycket_json.EVENT_STRING
+        if tag == TAG_ARRAY:
+            self.remaining.append(decoder.read_length())
+            self.objects.append(False)
+            return pycket_json.EVENT_START_ARRAY
+        if tag == TAG_OBJECT:
+            self.remaining.append(2 * decoder.read_length())
+            self.objects.append(True)
+            return pycket_json.EVENT_START_OBJECT
+        raise BinaryFormatError("unknown tag %d in binary AST" % tag)
+
+def loads(data):
+    builder = pycket_json.JsonTreeBuilder(BinaryEventReader(data))
+    result = builder.read_value()
+    builder.finish()
+    return result
+
+class ModuleBundle(object):
+    """
+    A bundle of separately encoded modules. The file is mapped into memory and
+    only the index is decoded up front, so the cost of loading a bundle scales
+    with the modules that are actually requested.
+    """
+
+    _immutable_fields_ = ["fname", "offsets", "lengths", "base"]
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.mmap = None
+        self.data = None
+        fd = os.open(fname, os.O_RDONLY, 0)
+        try:
+            try:
+                self.mmap = rmmap.mmap(fd, 0, access=rmmap.ACCESS_READ)
+            except rmmap.RMMapError:
+                self.data = readfile(fname)
+        finally:
+            os.close(fd)
+
+        # The index size is a varint, which takes at most 10 bytes
+        prefix = self._getslice(0, len(BUNDLE_HEADER) + 10)
+        decoder = BinaryDecoder(prefix)
+        decoder.read_header(BUNDLE_HEADER)
+        index_size = decoder.read_length()
+        index_start = decoder.pos
+
+        decoder = BinaryDecoder(self._getslice(index_start, index_size))
+        self.offsets = {}
+        self.lengths = {}
+        for i in range(decoder.read_length()):
+            name = decoder.read_bytes()
+            self.offsets[name] = decoder.read_length()
+            self.lengths[name] = decoder.read_length()
+        if decoder.pos != index_size:
+            raise BinaryFormatError("truncated module index in %s" % fname)
+        self.base = index_start + index_size
+
+    def _size(self):
+        if self.mmap is not None:
+            return self.mmap.size
+        assert self.data is not None
+        return len(self.data)
+
+    def _getslice(self, start, length):
+        length = min(length, self._size() - start)
+        if self.mmap is not None:
+            return self.mmap.getslice(start, length)
+        assert self.data is not None
+        if length < 0:
+            return ""
+        return self.data[start:start + length]
+
+    def has_module(self, name):
+        return name in self.offsets
+
+    def module_names(self):
+        return self.offsets.keys()
+
+    def get_module(self, name):
+        start = self.base + self.offsets[name]
+        length = self.lengths[name]
+        data = self._getslice(start, length)
+        if len(data) != length:
+            raise BinaryFormatError("truncated module %s in %s" % (name, self.fname))
+        return loads(data)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+#### ========================== Files
+
+def readfile(fname):
+    f = streamio.open_file_as_stream(fname)
+    try:
+        return f.readall()
+    finally:
+        f.close()
+
+def _has_header(fname, header):
+    try:
+        f = streamio.open_file_as_stream(fname)
+        try:
+            data = f.read(len(header))
+        finally:
+            f.close()
+    except (OSError, streamio.StreamError):
+        return False
+    return data == header
+
+def is_current_file(fname):
+    """ Whether `fname` is a binary AST written by this version of Pycket """
+    return _has_header(fname, HEADER)
+
+def is_current_bundle(fname):
+    """ Whether `fname` is a module bundle written by this version of Pycket """
+    return _has_header(fname, BUNDLE_HEADER)
+
+def write_file(fname, data):
+    # Write to a temporary file first, so that concurrent readers never see a
+    # partially written AST.
+    tmp_name = fname + ".tmp"
+    f = streamio.open_file_as_stream(tmp_name, "w")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_name, fname)
+
+def try_write_file(fname, data):
+    """ Best effort cache write: failing to write is not an error """
+    try:
+        write_file(fname, data)
+    except (OSError, streamio.StreamError):
+        return False
+    return True
+
+def dump_file(fname, json):
+    write_file(fname, dumps(json))
+
+def try_dump_file(fname, json):
+    return try_write_file(fname, dumps(json))
+
+def try_dump_bundle(fname, names, modules):
+    return try_write_file(fname, dump_bundle(names, modules))
@@ -0,0 +1,438 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Register bytecode for lambda bodies, used instead of the CEK interpreter when
+# translating with --bytecode-interpreter.
+#
+# The CEK interpreter allocates a continuation for every let binding of a
+# normalized body and returns to the interpreter loop for every node. Without
+# the JIT, nothing removes that overhead again. When a lambda is entered for
+# the first time, its body is compiled to a flat list of instructions instead,
+# and the let-bound variables live in registers rather than in environments:
+#
+#   (lambda (n acc)
+#     (let ([a (< n 1)])
+#       (if a acc (loop (- n 1) (* n acc)))))
+#
+#    0: ENV           1 0        ; n, read from the environment
+#    3: CONST         2 0        ; 1
+#    6: PRIMN         0 0 2 1 2  ; a = (< n 1), kept in register 0
+#   12: JUMP_IF_FALSE 0 18
+#   15: ...                      ; return acc
+#
+# Only bodies that need no continuation of their own are compiled: every
+# application that is not in tail position must be a call of a simple
+# primitive, and lambdas, letrec, set!, begin0, continuation marks and
+# multiple-value lets are left to the CEK interpreter. Tail calls hand the
+# callee back to the interpreter loop as usual, so the bytecode never grows
+# the Python stack.
+
+from pycket                   import values
+from pycket.AST               import AST
+from pycket.error             import SchemeException
+from pycket.interpreter       import (
+    App,
+    Begin,
+    CellRef,
+    If,
+    LazyBody,
+    Let,
+    LexicalVar,
+    ModuleVar,
+    Quote,
+    SimplePrimApp1,
+    SimplePrimApp2,
+    SimplePrimApp3,
+    ToplevelVar,
+    check_one_val,
+    return_multi_vals_direct,
+    return_value_direct,
+)
+from rpython.rlib             import jit
+from rpython.rlib.objectmodel import specialize
+
+# opcodes, followed by their operands in the code list
+CONST         = 0  # dst const        regs[dst] = consts[const]
+ENV           = 1  # dst sym          regs[dst] = env.lookup(syms[sym])
+ENV_CELL      = 2  # dst sym          regs[dst] = env.lookup(syms[sym]).get_val()
+GLOBAL        = 3  # dst var          regs[dst] = vars[var].interpret_simple(env)
+MOVE          = 4  # dst src          regs[dst] = regs[src]
+PRIM1         = 5  # dst prim a
+PRIM2         = 6  # dst prim a b
+PRIM3         = 7  # dst prim a b c
+PRIMN         = 8  # dst prim n a1 .. an
+JUMP_IF_FALSE = 9  # reg target
+JUMP          = 10 # target
+RETURN        = 11 # reg
+TAIL_CALL     = 12 # callee n a1 .. an
+
+# the dst of a primitive application in tail position, its result is
+# returned to the continuation
+NO_REG = -1
+
+opcode_names = ["CONST", "ENV", "ENV_CELL", "GLOBAL", "MOVE", "PRIM1",
+                "PRIM2", "PRIM3", "PRIMN", "JUMP_IF_FALSE", "JUMP", "RETURN",
+                "TAIL_CALL"]
+
+class NotCompilable(Exception):
+    pass
+
+class NotForced(Exception):
+    """ The body of the lambda has not been converted from JSON yet """
+
+def simple_primitive(rator):
+    """ The simple primitive that rator refers to, or None """
+    if not isinstance(rator, ModuleVar) or not rator.is_primitive():
+        return None
+    try:
+        w_prim = rator._lookup_primitive()
+    except SchemeException:
+        return None
+    if isinstance(w_prim, values.W_Prim) and w_prim.simple_call is not None:
+        return w_prim
+    return None
+
+class Compiler(object):
+
+    def __init__(self, lam):
+        self.lam = lam
+        self.code = []
+        self.consts = []
+        self.syms = []
+        self.vars = []
+        self.prims = []
+        self.next_reg = 0
+        self.num_regs = 0
+
+    def new_reg(self):
+        reg = self.next_reg
+        self.next_reg += 1
+        if self.next_reg > self.num_regs:
+            self.num_regs = self.next_reg
+        return reg
+
+    def emit(self, *ints):
+        for i in ints:
+            self.code.append(i)
+
+    @specialize.argtype(1, 2)
+    def _index(self, pool, obj):
+        for i, other in enumerate(pool):
+            if other is obj:
+                return i
+        pool.append(obj)
+        return len(pool) - 1
+
+    def patch(self, pos):
+        """ Makes the jump target at pos point to the next instruction """
+        self.code[pos] = len(self.code)
+
+    def compile_body(self, body, regs):
+        for i, b in enumerate(body):
+            if i == len(body) - 1:
+                self.compile_tail(b, regs)
+            else:
+                reg = self.new_reg()
+                self.compile_expr(b, regs, reg)
+
+    def compile_tail(self, ast, regs):
+        if isinstance(ast, LazyBody):
+            if ast.forced is None:
+                raise NotForced
+            return self.compile_tail(ast.forced, regs)
+        if isinstance(ast, If):
+            self.compile_if(ast, regs, NO_REG)
+        elif isinstance(ast, Let):
+            self.compile_let(ast, regs, NO_REG)
+        elif isinstance(ast, Begin):
+            self.compile_body(ast.body, regs)
+        elif isinstance(ast, App) and not self.is_prim_app(ast):
+            callee = self.operand(ast.rator, regs)
+            args = [self.operand(rand, regs) for rand in ast.rands]
+            self.emit(TAIL_CALL, callee, len(args))
+            for arg in args:
+                self.emit(arg)
+        elif isinstance(ast, App):
+            self.compile_prim_app(ast, regs, NO_REG)
+        else:
+            reg = self.operand(ast, regs)
+            self.emit(RETURN, reg)
+
+    def compile_expr(self, ast, regs, dst):
+        """ Compiles ast to store its value in register dst """
+        assert dst != NO_REG
+        if isinstance(ast, LazyBody):
+            raise NotCompilable
+        if isinstance(ast, If):
+            self.compile_if(ast, regs, dst)
+        elif isinstance(ast, Let):
+            self.compile_let(ast, regs, dst)
+        elif isinstance(ast, Begin):
+            for b in ast.body:
+                self.compile_expr(b, regs, dst)
+        elif isinstance(ast, App):
+            if not self.is_prim_app(ast):
+                # would need a continuation
+                raise NotCompilable
+            self.compile_prim_app(ast, regs, dst)
+        elif isinstance(ast, LexicalVar) and ast.sym in regs:
+            self.emit(MOVE, dst, regs[ast.sym])
+        else:
+            self.load(ast, regs, dst)
+
+    def compile_if(self, ast, regs, dst):
+        saved = self.next_reg
+        tst = self.operand_expr(ast.tst, regs)
+        self.next_reg = saved
+        self.emit(JUMP_IF_FALSE, tst, -1)
+        jump_to_els = len(self.code) - 1
+        if dst == NO_REG:
+            self.compile_tail(ast.thn, regs)
+            self.patch(jump_to_els)
+            self.compile_tail(ast.els, regs)
+        else:
+            self.compile_expr(ast.thn, regs, dst)
+            self.emit(JUMP, -1)
+            jump_to_end = len(self.code) - 1
+            self.patch(jump_to_els)
+            self.compile_expr(ast.els, regs, dst)
+            self.patch(jump_to_end)
+        self.next_reg = saved
+
+    def compile_let(self, ast, regs, dst):
+        if ast.binds_mutable_var():
+            raise NotCompilable
+        for count in ast.counts:
+            if count != 1:
+                raise NotCompilable
+        saved = self.next_reg
+        new_regs = regs.copy()
+        for i, rhs in enumerate(ast.rhss):
+            reg = self.new_reg()
+            self.compile_expr(rhs, regs, reg)
+            new_regs[ast.args.elems[i]] = reg
+        if dst == NO_REG:
+            self.compile_body(ast.body, new_regs)
+        else:
+            for b in ast.body:
+                self.compile_expr(b, new_regs, dst)
+        self.next_reg = saved
+
+    def is_prim_app(self, ast):
+        if (isinstance(ast, SimplePrimApp1) or isinstance(ast, SimplePrimApp2) or
+                isinstance(ast, SimplePrimApp3)):
+            return True
+        return isinstance(ast, App) and simple_primitive(ast.rator) is not None
+
+    def compile_prim_app(self, ast, regs, dst):
+        saved = self.next_reg
+        if isinstance(ast, SimplePrimApp1):
+            a = self.operand(ast.rand1, regs)
+            self.emit(PRIM1, dst, self._index(self.prims, ast.w_prim), a)
+        elif isinstance(ast, SimplePrimApp2):
+            a = self.operand(ast.rand1, regs)
+            b = self.operand(ast.rand2, regs)
+            self.emit(PRIM2, dst, self._index(self.prims, ast.w_prim), a, b)
+        elif isinstance(ast, SimplePrimApp3):
+            a = self.operand(ast.rand1, regs)
+            b = self.operand(ast.rand2, regs)
+            c = self.operand(ast.rand3, regs)
+            self.emit(PRIM3, dst, self._index(self.prims, ast.w_prim), a, b, c)
+        else:
+            w_prim = simple_primitive(ast.rator)
+            assert w_prim is not None
+            args = [self.operand(rand, regs) for rand in ast.rands]
+            self.emit(PRIMN, dst, self._index(self.prims, w_prim), len(args))
+            for arg in args:
+                self.emit(arg)
+        self.next_reg = saved
+
+    def operand_expr(self, ast, regs):
+        """ The register holding the value of the expression ast """
+        if isinstance(ast, LexicalVar) and ast.sym in regs:
+            return regs[ast.sym]
+        reg = self.new_reg()
+        self.compile_expr(ast, regs, reg)
+        return reg
+
+    def operand(self, ast, regs):
+        """ The register holding the value of the simple ast """
+        if isinstance(ast, LexicalVar) and ast.sym in regs:
+            return regs[ast.sym]
+        reg = self.new_reg()
+        self.load(ast, regs, reg)
+        return reg
+
+    def load(self, ast, regs, dst):
+        if isinstance(ast, Quote):
+            self.emit(CONST, dst, self._index(self.consts, ast.w_val))
+        elif isinstance(ast, CellRef):
+            if ast.sym in regs:
+                raise NotCompilable
+            self.emit(ENV_CELL, dst, self._index(self.syms, ast.sym))
+        elif isinstance(ast, LexicalVar):
+            assert ast.sym not in regs
+            self.emit(ENV, dst, self._index(self.syms, ast.sym))
+        elif isinstance(ast, ModuleVar) or isinstance(ast, ToplevelVar):
+            self.emit(GLOBAL, dst, self._index(self.vars, ast))
+        elif isinstance(ast, App) and self.is_prim_app(ast):
+            self.compile_prim_app(ast, regs, dst)
+        else:
+            raise NotCompilable
+
+def compile_lambda(lam):
+    """ The BytecodeBody for the body of lam. Raises NotCompilable if it uses
+    constructs that are left to the CEK interpreter. """
+    compiler = Compiler(lam)
+    compiler.compile_body(lam.body, {})
+    return BytecodeBody(lam, compiler.code[:], compiler.consts[:],
+                        compiler.syms[:], compiler.vars[:],
+                        compiler.prims[:], compiler.num_regs)
+
+class BytecodeBody(AST):
+    """ The compiled body of a lambda, which the interpreter loop runs in
+    place of the body in the environment of the arguments """
+    _immutable_fields_ = ["lam", "code[*]", "consts[*]", "syms[*]",
+                          "vars[*]", "prims[*]", "num_regs"]
+    visitable = False
+
+    def __init__(self, lam, code, consts, syms, vars, prims, num_regs):
+        self.lam = lam
+        self.code = code
+        self.consts = consts
+        self.syms = syms
+        self.vars = vars
+        self.prims = prims
+        self.num_regs = num_regs
+        self.surrounding_lambda = lam
+
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        regs = [None] * self.num_regs
+        try:
+            return self.run(regs, env, cont)
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+
+    @jit.dont_look_inside
+    def run(self, regs, env, cont):
+        code = self.code
+        env_structure = self.lam.env_structure
+        pc = 0
+        while True:
+            op = code[pc]
+            if op == CONST:
+                regs[code[pc + 1]] = self.consts[code[pc + 2]]
+                pc += 3
+            elif op == ENV:
+                regs[code[pc + 1]] = env.lookup(self.syms[code[pc + 2]], env_structure)
+                pc += 3
+            elif op == ENV_CELL:
+                w_cell = env.lookup(self.syms[code[pc + 2]], env_structure)
+                assert isinstance(w_cell, values.W_Cell)
+                regs[code[pc + 1]] = w_cell.get_val()
+                pc += 3
+            elif op == GLOBAL:
+                regs[code[pc + 1]] = self.vars[code[pc + 2]].interpret_simple(env)
+                pc += 3
+            elif op == MOVE:
+                regs[code[pc + 1]] = regs[code[pc + 2]]
+                pc += 3
+            elif op == PRIM1:
+                w_prim = self.prims[code[pc + 2]]
+                result = w_prim.simple1(regs[code[pc + 3]])
+                dst = code[pc + 1]
+                if dst == NO_REG:
+                    return return_result(result, env, cont)
+                regs[dst] = check_result(result)
+                pc += 4
+            elif op == PRIM2:
+                w_prim = self.prims[code[pc + 2]]
+                result = w_prim.simple2(regs[code[pc + 3]], regs[code[pc + 4]])
+                dst = code[pc + 1]
+                if dst == NO_REG:
+                    return return_result(result, env, cont)
+                regs[dst] = check_result(result)
+                pc += 5
+            elif op == PRIM3:
+                w_prim = self.prims[code[pc + 2]]
+                result = w_prim.simple3(regs[code[pc + 3]], regs[code[pc + 4]],
+                                        regs[code[pc + 5]])
+                dst = code[pc + 1]
+                if dst == NO_REG:
+                    return return_result(result, env, cont)
+                regs[dst] = check_result(result)
+                pc += 6
+            elif op == PRIMN:
+                w_prim = self.prims[code[pc + 2]]
+                args_w = self.collect_args(regs, pc + 3)
+                result = w_prim.simple_call(args_w)
+                dst = code[pc + 1]
+                if dst == NO_REG:
+                    return return_result(result, env, cont)
+                regs[dst] = check_result(result)
+                pc += 4 + len(args_w)
+            elif op == JUMP_IF_FALSE:
+                if regs[code[pc + 1]] is values.w_false:
+                    pc = code[pc + 2]
+                else:
+                    pc += 3
+            elif op == JUMP:
+                pc = code[pc + 1]
+            elif op == RETURN:
+                return return_value_direct(regs[code[pc + 1]], env, cont)
+            elif op == TAIL_CALL:
+                w_callable = regs[code[pc + 1]]
+                args_w = self.collect_args(regs, pc + 2)
+                if isinstance(w_callable, values.W_PromotableClosure):
+                    w_callable = w_callable.closure
+                return w_callable.call_with_extra_info(args_w, env, cont, None)
+            else:
+                assert False, "unknown opcode %d" % op
+
+    def collect_args(self, regs, pc):
+        """ The values of the registers listed after the count at pc """
+        code = self.code
+        n = code[pc]
+        args_w = [None] * n
+        for i in range(n):
+            args_w[i] = regs[code[pc + 1 + i]]
+        return args_w
+
+    def disassemble(self):
+        code = self.code
+        lines = []
+        pc = 0
+        while pc < len(code):
+            op = code[pc]
+            if op == PRIMN:
+                size = 4 + code[pc + 3]
+            elif op == TAIL_CALL:
+                size = 3 + code[pc + 2]
+            elif op == JUMP or op == RETURN:
+                size = 2
+            elif op == PRIM1:
+                size = 4
+            elif op == PRIM2:
+                size = 5
+            elif op == PRIM3:
+                size = 6
+            else:
+                size = 3
+            operands = [str(i) for i in code[pc + 1:pc + size]]
+            lines.append("%d: %s %s" % (pc, opcode_names[op], " ".join(operands)))
+            pc += size
+        return "\n".join(lines)
+
+    def _tostring(self):
+        return "#<bytecode %s>" % self.lam.tostring()
+
+def check_result(result):
+    if result is None:
+        return values.w_void
+    return check_one_val(result)
+
+def return_result(result, env, cont):
+    if result is None:
+        result = values.w_void
+    return return_multi_vals_direct(result, env, cont)
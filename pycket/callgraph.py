@@ -16,11 +16,21 @@ from rpython.rlib import jit, objectmodel
 # Further, we want to mark as few nodes as possible, as fewer loop headers reduces
 # the work performed by the JIT. This also reduces potential collisions in the
 # trace cache.
+#
+# Every SAMPLE_INTERVAL-th call of an edge that goes through register_call is
+# counted against it, with the weight of SAMPLE_INTERVAL calls. Each edge has a
+# countdown of its own, since a shared one would follow the call pattern, and
+# e.g. give all samples of a ping-pong between two lambdas to one edge. Calls
+# made from JIT compiled code are not registered. With prefer_hot_headers, the
+# loop header of a newly found cycle is the lambda of the cycle that is called
+# most often from within the cycle, instead of the lambda that closed it.
 
 NOT_LOOP         = 0b00
 LOOP_PARTICIPANT = 0b01
 LOOP_HEADER      = 0b11
 
+SAMPLE_INTERVAL = 8
+
 @objectmodel.always_inline
 def join_states(s1, s2):
     return s1 | s2
@@ -40,10 +50,20 @@ class Namer(object): #pragma: no cover
         self.names[val] = name
         return name
 
+class EdgeCount(object):
+    _attrs_ = ["countdown", "calls"]
+
+    def __init__(self):
+        self.countdown = SAMPLE_INTERVAL
+        self.calls = 0
+
 class CallGraph(object):
     def __init__(self):
         self.calls     = {}
         self.recursive = {}
+        # sampled call counts, caller -> callee -> EdgeCount
+        self.counts    = {}
+        self.prefer_hot_headers = False
 
     @jit.not_in_trace
     def register_call(self, lam, calling_app, cont, env):
@@ -52,6 +72,7 @@ class CallGraph(object):
         calling_lam = calling_app.surrounding_lambda
         if calling_lam is None:
             return
+        self.count_call(calling_lam, lam)
         subdct = self.calls.get(calling_lam, None)
         if subdct is None:
             self.calls[calling_lam] = subdct = {}
@@ -75,6 +96,44 @@ class CallGraph(object):
                 if status != NOT_LOOP:
                     cont_ast.set_should_enter()
 
+    def count_call(self, calling_lam, lam):
+        subdct = self.counts.get(calling_lam, None)
+        if subdct is None:
+            self.counts[calling_lam] = subdct = {}
+        edge = subdct.get(lam, None)
+        if edge is None:
+            subdct[lam] = edge = EdgeCount()
+        edge.countdown -= 1
+        if edge.countdown == 0:
+            edge.countdown = SAMPLE_INTERVAL
+            edge.calls += SAMPLE_INTERVAL
+
+    def call_count(self, calling_lam, lam):
+        subdct = self.counts.get(calling_lam, None)
+        if subdct is None:
+            return 0
+        edge = subdct.get(lam, None)
+        if edge is None:
+            return 0
+        return edge.calls
+
+    def choose_header(self, lam, path):
+        """ The loop header of the cycle from lam through the reversed path
+        back to lam """
+        if not self.prefer_hot_headers:
+            return lam
+        header = lam
+        best = self.call_count(path.node, lam)
+        while path is not None:
+            node = path.node
+            prev = path.prev.node if path.prev is not None else lam
+            count = self.call_count(prev, node)
+            if count > best:
+                header = node
+                best = count
+            path = path.prev
+        return header
+
     def add_participants(self, path):
         for node in path:
             status = self.recursive.get(node, NOT_LOOP)
@@ -100,7 +159,12 @@ class CallGraph(object):
             if current is lam:
                 # all the lambdas in the path are recursive too
                 self.add_participants(path)
-                self.recursive[lam] = LOOP_HEADER
+                header = self.choose_header(lam, path)
+                self.recursive[header] = LOOP_HEADER
+                if header is not lam:
+                    self.recursive[lam] = join_states(self.status(lam), LOOP_PARTICIPANT)
+                    header.enable_jitting()
+                    return LOOP_PARTICIPANT
                 return LOOP_HEADER
             if current in visited:
                 continue
@@ -137,11 +201,53 @@ class CallGraph(object):
                 output.write(srcname)
                 output.write(" -> ")
                 output.write(dstname)
+                output.write(" [label=%d" % self.call_count(src, dst))
                 if dst.body[0].should_enter:
-                    output.write(" [color=blue]")
-                output.write(";\n")
+                    output.write(",color=blue")
+                output.write("];\n")
         output.write("}\n")
 
+    def edges(self):
+        """ All edges as (caller, callee, sampled calls) """
+        result = []
+        for src, subdct in self.calls.iteritems():
+            for dst in subdct:
+                result.append((src, dst, self.call_count(src, dst)))
+        return result
+
+    def to_json(self):
+        from pycket.profiler import lambda_label
+        from pycket.pycket_json import JsonArray, JsonInt, JsonObject, JsonString
+        ids = {}
+        nodes = []
+        edges = []
+        for src, dst, count in self.edges():
+            for node in [src, dst]:
+                if node not in ids:
+                    ids[node] = len(nodes)
+                    nodes.append(JsonObject({
+                        "id": JsonInt(ids[node]),
+                        "srcloc": JsonString(lambda_label(node)),
+                        "status": JsonString(_status_name(self.status(node)))}))
+            edges.append(JsonObject({
+                "from": JsonInt(ids[src]),
+                "to": JsonInt(ids[dst]),
+                "calls": JsonInt(count)}))
+        return JsonObject({"sample_interval": JsonInt(SAMPLE_INTERVAL),
+                           "nodes": JsonArray(nodes),
+                           "edges": JsonArray(edges)})
+
+    def write_json_file(self, output): #pragma: no cover
+        output.write(self.to_json().tostring())
+        output.write("\n")
+
+def _status_name(status):
+    if status == LOOP_HEADER:
+        return "header"
+    if status == LOOP_PARTICIPANT:
+        return "participant"
+    return "none"
+
 class Path(object):
 
     __slots__ = ('node', 'prev')
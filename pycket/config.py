@@ -21,7 +21,17 @@ pycketoption_descr = OptionDescription(
     BoolOption("immutable_boolean_field_elision", "elide immutable boolean fields from structs",
                default=False, cmdline="--ibfe"),
     BoolOption("hidden_classes", "use hidden classes to implement impersonators",
-               default=True, cmdline="--hidden-classes")
+               default=True, cmdline="--hidden-classes"),
+    BoolOption("superinstructions", "fuse common AST shapes (if on a primitive test, let of a primitive application, ...) into single nodes",
+               default=True, cmdline="--superinstructions"),
+    BoolOption("constant_folding", "evaluate pure primitive applications to constants and propagate constants when loading modules",
+               default=True, cmdline="--constant-folding"),
+    BoolOption("lambda_lifting", "pass the free variables of local functions that are only called as arguments instead of allocating closures",
+               default=True, cmdline="--lambda-lifting"),
+    BoolOption("bytecode_interpreter", "compile lambda bodies to register bytecode instead of interpreting the AST, for builds without the JIT",
+               default=False, cmdline="--bytecode-interpreter"),
+    BoolOption("stack_continuations", "evaluate the right-hand sides of lets on the native stack and allocate their continuations only when captured, for builds without the JIT",
+               default=False, cmdline="--stack-continuations")
 ])
 
 def get_testing_config(**overrides):
@@ -46,6 +56,16 @@ def compute_executable_suffix(config):
         res.append("-no-type-size-specialization")
     if not config.hidden_classes:
         res.append("-no-hidden-classes")
+    if not config.superinstructions:
+        res.append("-no-superinstructions")
+    if not config.constant_folding:
+        res.append("-no-constant-folding")
+    if not config.lambda_lifting:
+        res.append("-no-lambda-lifting")
+    if config.bytecode_interpreter:
+        res.append("-bytecode")
+    if config.stack_continuations:
+        res.append("-stack-cont")
     if config.immutable_boolean_field_elision:
         res.append("-ibfe")
     return "".join(res)
@@ -62,6 +82,11 @@ exposed_options = ['strategies',
                    'prune_env',
                    'immutable_boolean_field_elision',
                    'hidden_classes',
+                   'superinstructions',
+                   'constant_folding',
+                   'lambda_lifting',
+                   'bytecode_interpreter',
+                   'stack_continuations',
 ]
 
 def expose_options(config):
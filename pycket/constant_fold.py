@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Constant folding of normalized modules.
+#
+# The JSON loader only folds an `if` whose test is a literal. This pass runs
+# after normalization and evaluates the applications of pure primitives (see
+# PURE_PRIM_NAMES in pycket.prims.expose) to constant arguments. Let-bound
+# variables that are bound to a constant and never mutated are replaced by the
+# constant, so that the branches of an `if` on them are pruned, and their
+# bindings are dropped. Constants that end up in non-tail positions of a body
+# are removed by remove_pure_ops when the bodies are rebuilt.
+#
+# An application that raises an error is left alone, the error is reported
+# when it is executed.
+
+from pycket                   import values
+from pycket.ast_visitor       import ASTVisitor
+from pycket.error             import SchemeException
+from pycket.interpreter       import (
+    App,
+    CaseLambda,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Quote,
+    SimplePrimApp1,
+    SimplePrimApp2,
+    check_one_val,
+    make_lambda,
+    make_let,
+    make_letrec,
+    variable_set,
+)
+from pycket.prims.expose      import is_pure_prim
+
+def without(consts, syms):
+    """ The constants that are not shadowed by a binding of syms """
+    if not consts:
+        return consts
+    result = consts
+    for sym in syms:
+        if sym in result:
+            if result is consts:
+                result = consts.copy()
+            del result[sym]
+    return result
+
+def fold_app(app):
+    """ The value of a pure primitive application to constants, or None """
+    if isinstance(app, SimplePrimApp1):
+        if not is_pure_prim(app.w_prim):
+            return None
+        rand1 = app.rand1
+        if not isinstance(rand1, Quote):
+            return None
+        try:
+            w_val = app.w_prim.simple1(rand1.w_val)
+            if w_val is None:
+                w_val = values.w_void
+            return check_one_val(w_val)
+        except SchemeException:
+            return None
+    if isinstance(app, SimplePrimApp2):
+        if not is_pure_prim(app.w_prim):
+            return None
+        rand1 = app.rand1
+        rand2 = app.rand2
+        if not isinstance(rand1, Quote) or not isinstance(rand2, Quote):
+            return None
+        try:
+            w_val = app.w_prim.simple2(rand1.w_val, rand2.w_val)
+            if w_val is None:
+                w_val = values.w_void
+            return check_one_val(w_val)
+        except SchemeException:
+            return None
+    return None
+
+class ConstantFoldVisitor(ASTVisitor):
+    """
+    Folds pure primitive applications to constants and propagates constants
+    through let bindings. The consts argument maps the symbols of the
+    let-bound variables in scope that are known to be constant to their value.
+    """
+
+    def visit_lexical_var(self, ast, consts):
+        assert isinstance(ast, LexicalVar)
+        w_val = consts.get(ast.sym, None)
+        if w_val is not None:
+            return Quote(w_val)
+        return ast
+
+    def visit_app(self, ast, consts):
+        assert isinstance(ast, App)
+        rator = ast.rator.visit(self, consts)
+        rands = [r.visit(self, consts) for r in ast.rands]
+        app = App.make(rator, rands, ast.env_structure)
+        w_val = fold_app(app)
+        if w_val is not None:
+            return Quote(w_val)
+        return app
+
+    def visit_lambda(self, ast, consts):
+        assert isinstance(ast, Lambda)
+        consts = without(consts, ast.args.elems)
+        body = [b.visit(self, consts) for b in ast.body]
+        return make_lambda(ast.formals, ast.rest, body, sourceinfo=ast.sourceinfo)
+
+    def visit_case_lambda(self, ast, consts):
+        assert isinstance(ast, CaseLambda)
+        if ast.recursive_sym is not None:
+            consts = without(consts, [ast.recursive_sym])
+        lams = [l.visit(self, consts) for l in ast.lams]
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym, arity=ast._arity)
+
+    def visit_letrec(self, ast, consts):
+        assert isinstance(ast, Letrec)
+        consts = without(consts, ast.args.elems)
+        rhss = [r.visit(self, consts) for r in ast.rhss]
+        body = [b.visit(self, consts) for b in ast.body]
+        return make_letrec(ast._rebuild_args(), rhss, body)
+
+    def visit_let(self, ast, consts):
+        assert isinstance(ast, Let)
+        rhss = [r.visit(self, consts) for r in ast.rhss]
+        varss = ast._rebuild_args()
+        muts = variable_set()
+        for b in ast.body:
+            muts.update(b.mutated_vars())
+        body_consts = without(consts, ast.args.elems)
+        for i, rhs in enumerate(rhss):
+            vars = varss[i]
+            if (len(vars) == 1 and isinstance(rhs, Quote) and
+                    LexicalVar(vars[0]) not in muts):
+                if body_consts is consts:
+                    body_consts = consts.copy()
+                body_consts[vars[0]] = rhs.w_val
+        body = [b.visit(self, body_consts) for b in ast.body]
+
+        # drop the bindings whose uses were all replaced, the references
+        # of lazily converted lambda bodies cannot be replaced
+        new_varss = []
+        new_rhss = []
+        for i, rhs in enumerate(rhss):
+            vars = varss[i]
+            if (len(vars) == 1 and vars[0] in body_consts and
+                    not _any_free(body, vars[0])):
+                continue
+            new_varss.append(vars)
+            new_rhss.append(rhs)
+        return make_let(new_varss, new_rhss, body)
+
+def _any_free(body, sym):
+    for b in body:
+        if b.free_vars().haskey(sym):
+            return True
+    return False
+
+def constant_fold(ast):
+    return ast.visit(ConstantFoldVisitor(), {})
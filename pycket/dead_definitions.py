@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Whole-program elimination of unreferenced module-level definitions.
+#
+# Instantiating a module evaluates every one of its definitions, although a
+# program typically uses only a small part of the libraries it requires. Once
+# the main module is loaded, this pass loads every module that its
+# instantiation will require, follows the ModuleVar references from all code
+# that is certainly executed, and removes the definitions that are never
+# reached and whose right-hand side is pure (a lambda or a quoted value), so
+# they are neither evaluated nor kept alive.
+#
+# Definitions are only found through static references, so the pass is
+# optional: a removed definition is also dropped from the module's defs, so
+# accessing it dynamically, e.g. through `dynamic-require` or `eval`, reports
+# an unknown module variable. Modules that use `(#%variable-reference)` keep
+# all their definitions, and if the references of some code are not known
+# (lazily converted lambda bodies, variables of a module that was not loaded)
+# nothing is removed.
+
+from rpython.rlib        import jit
+from pycket.interpreter import (
+    CaseLambda,
+    DefineValues,
+    LazyBody,
+    Module,
+    ModuleVar,
+    Quote,
+    QuoteSyntax,
+    Require,
+    VariableReference,
+)
+
+class IncompleteReferences(Exception):
+    pass
+
+def is_removable(form):
+    if not isinstance(form, DefineValues):
+        return False
+    rhs = form.rhs
+    return (isinstance(rhs, CaseLambda) or isinstance(rhs, Quote) or
+            isinstance(rhs, QuoteSyntax))
+
+class DeadDefinitionEliminator(object):
+
+    def __init__(self, main):
+        self.main = main
+        # the modules that are instantiated, in the order they are found
+        self.modules = []
+        self.seen = {}
+        # the root modules by file name, as referenced by ModuleVar.srcmod
+        self.by_name = {}
+        # for every module, the definitions by name and the names reached
+        self.definitions = {}
+        self.live = {}
+        self.all_live = {}
+        self.walked = {}
+        self.todo_forms = []
+        self.todo_modules = []
+
+    def add_module(self, module):
+        if module in self.seen:
+            return
+        self.seen[module] = None
+        self.modules.append(module)
+        definitions = {}
+        for form in module.body:
+            if isinstance(form, DefineValues):
+                for name in form.names:
+                    definitions[name] = form
+        self.definitions[module] = definitions
+        self.live[module] = {}
+        # instantiating a module instantiates its language, its parent and
+        # its requires
+        if isinstance(module.lang, Require):
+            self.add_required(module, module.lang)
+        if module.parent is not None:
+            self.add_module(module.parent)
+        for r in module.requires:
+            assert isinstance(r, Require)
+            self.add_required(module, r)
+
+    def add_required(self, module, require):
+        if require.loader is not None:
+            required = require.loader.lazy_load(require.fname)
+            self.by_name[require.fname] = required
+        else:
+            required = module
+        self.add_module(required.resolve_submodule_path(require.path))
+
+    def mark(self, module, name):
+        live = self.live.get(module, None)
+        if live is None or name in live:
+            # not one of our modules, or already reached
+            return
+        live[name] = None
+        form = self.definitions[module].get(name, None)
+        if form is not None and form not in self.walked:
+            self.walked[form] = None
+            self.todo_forms.append(form)
+            self.todo_modules.append(module)
+
+    def mark_all(self, module):
+        if module in self.all_live:
+            return
+        self.all_live[module] = None
+        for form in module.body:
+            if isinstance(form, DefineValues):
+                for name in form.names:
+                    self.mark(module, name)
+
+    def resolve(self, var, module):
+        if var.srcmod is None:
+            target = module
+        elif var.is_primitive() or var.srcmod.startswith("#%"):
+            # primitive modules are never loaded, like in _to_require
+            return None
+        else:
+            target = self.by_name.get(var.srcmod, None)
+            if target is None:
+                # the definitions this refers to could be removed
+                raise IncompleteReferences
+        return target.resolve_submodule_path(var.path)
+
+    def walk(self, ast, module):
+        if isinstance(ast, ModuleVar):
+            target = self.resolve(ast, module)
+            if target is not None:
+                self.mark(target, ast.srcsym)
+        elif isinstance(ast, VariableReference):
+            if ast.var is None:
+                # the module's namespace can be reflected on
+                self.mark_all(module)
+            else:
+                self.walk(ast.var, module)
+        elif isinstance(ast, LazyBody):
+            if ast.forced is None:
+                raise IncompleteReferences
+            self.walk(ast.forced, module)
+        elif isinstance(ast, Module):
+            # submodules are separate modules
+            return
+        else:
+            for child in ast.direct_children():
+                self.walk(child, module)
+
+    @jit.dont_look_inside
+    def run(self):
+        """ Remove the dead definitions, returns how many were removed """
+        self.add_module(self.main)
+        # the definitions of the program itself are kept
+        self.mark_all(self.main)
+        try:
+            for module in self.modules:
+                for form in module.body:
+                    if not is_removable(form):
+                        self.walk(form, module)
+                self.process_todo()
+        except IncompleteReferences:
+            return 0
+
+        removed = 0
+        for module in self.modules:
+            live = self.live[module]
+            body = []
+            for form in module.body:
+                if is_removable(form) and not self.any_live(form, live):
+                    assert isinstance(form, DefineValues)
+                    for name in form.names:
+                        del module.defs[name]
+                    removed += 1
+                else:
+                    body.append(form)
+            if len(body) != len(module.body):
+                module.body = body
+        return removed
+
+    def any_live(self, form, live):
+        assert isinstance(form, DefineValues)
+        for name in form.names:
+            if name in live:
+                return True
+        return False
+
+    def process_todo(self):
+        while self.todo_forms:
+            form = self.todo_forms.pop()
+            module = self.todo_modules.pop()
+            self.walk(form.rhs, module)
+
+def eliminate_dead_definitions(main):
+    """ Remove the unreferenced pure definitions of the modules instantiated
+    by the main module `main`. Returns the number of removed definitions. """
+    return DeadDefinitionEliminator(main).run()
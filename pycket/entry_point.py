@@ -22,12 +22,36 @@ def save_callgraph(config, env):
         with open('callgraph.dot', 'w') as outfile:
             env.callgraph.write_dot_file(outfile)
 
+def save_callgraph_json(names, env):
+    json_file = names.get('save-callgraph-json', "")
+    if json_file:
+        with open(json_file, 'w') as outfile:
+            env.callgraph.write_json_file(outfile)
+
+@register_post_run_callback
+def report_startup_stats(config, env):
+    from pycket import startup_stats
+    startup_stats.report(config, env)
+
+@register_post_run_callback
+def report_profile(config, env):
+    from pycket import profiler
+    profiler.report(config, env)
+
+@register_post_run_callback
+def report_jit_stats(config, env):
+    from pycket import jit_stats
+    jit_stats.report(config, env)
+
 def make_entry_point(pycketconfig=None):
     from pycket.expand import JsonLoader, ModuleMap, PermException
     from pycket.interpreter import interpret_one, ToplevelEnv, interpret_module
     from pycket.error import SchemeException
     from pycket.option_helper import parse_args, ensure_json_ast
+    from pycket.expansion_cache import make_expansion_cache
     from pycket.values_string import W_String
+    from pycket.dead_definitions import eliminate_dead_definitions
+    from pycket import startup_stats, profiler, jit_stats
 
     def entry_point(argv):
         if not objectmodel.we_are_translated():
@@ -49,8 +73,12 @@ def make_entry_point(pycketconfig=None):
         config, names, args, retval = parse_args(argv)
         if retval != 0 or config is None:
             return retval
+        startup_stats.configure(config, names)
+        profiler.configure(config, names)
+        jit_stats.configure(config)
         args_w = [W_String.fromstr_utf8(arg) for arg in args]
-        module_name, json_ast = ensure_json_ast(config, names)
+        expansion_cache = make_expansion_cache(config, names)
+        module_name, json_ast = ensure_json_ast(config, names, expansion_cache)
 
         entry_flag = 'byte-expand' in names
         multi_mod_flag = 'multiple-modules' in names
@@ -59,23 +87,34 @@ def make_entry_point(pycketconfig=None):
 
         reader = JsonLoader(bytecode_expand=entry_flag,
                             multiple_modules=multi_mod_flag,
-                            module_mapper=multi_mod_map)
+                            module_mapper=multi_mod_map,
+                            expansion_cache=expansion_cache,
+                            lazy_lambda_bodies=config.get('lazy-lambda-bodies', False))
         
         if json_ast is None:
             ast = reader.expand_to_ast(module_name)
         else:
             ast = reader.load_json_ast_rpython(module_name, json_ast)
 
+        if config.get('eliminate-dead-definitions', False):
+            timer = startup_stats.start("dead-definitions", module_name)
+            eliminate_dead_definitions(ast)
+            startup_stats.stop(timer)
+
         env = ToplevelEnv(pycketconfig)
+        env.callgraph.prefer_hot_headers = config.get('callgraph-hot-headers', False)
         env.globalconfig.load(ast)
         env.commandline_arguments = args_w
         env.module_env.add_module(module_name, ast)
         try:
+            timer = startup_stats.start("instantiate", module_name)
             val = interpret_module(ast, env)
+            startup_stats.stop(timer)
         finally:
             from pycket.prims.input_output import shutdown
             for callback in POST_RUN_CALLBACKS:
                 callback(config, env)
+            save_callgraph_json(names, env)
             shutdown(env)
         return 0
     return entry_point
@@ -102,6 +141,10 @@ def target(driver, args): #pragma: no cover
     entry_point = make_entry_point(config)
     return entry_point, None
 
+def jitpolicy(driver): #pragma: no cover
+    from pycket.jit_stats import jitpolicy
+    return jitpolicy(driver)
+
 def get_additional_config_options(): #pragma: no cover
     from pycket.config import pycketoption_descr
     return pycketoption_descr
@@ -11,14 +11,15 @@ from rpython.rlib.objectmodel import specialize, we_are_translated
 from rpython.rlib.rstring import ParseStringError, ParseStringOverflowError
 from rpython.rlib.rarithmetic import string_to_int
 from rpython.rlib.unroll import unrolling_iterable
-from pycket import pycket_json
+from pycket import pycket_json, binary_ast, module_cache, startup_stats
+from pycket.expander_client import ExpanderError, get_client as get_expander_client
 from pycket.error import SchemeException
 from pycket.interpreter import *
 from pycket import values, values_string
 from pycket import values_regex
 from pycket import vector
 from pycket import values_struct
-from pycket.hash.equal import W_EqualHashTable
+from pycket.hash.equal import make_immutable_equal_table
 
 class ExpandException(SchemeException):
     pass
@@ -100,13 +101,34 @@ def expand_file(fname):
         raise ExpandException("Racket produced an error")
     return data
 
+def expand_with_server(rkt_file, lib):
+    """ Ask the persistent expander (see pycket.expander_client) to expand
+    `rkt_file`. Returns None if no expander server is running. """
+    if lib != _FN:
+        # the server only implements the regular expansion
+        return None
+    try:
+        return get_expander_client().expand(rkt_file)
+    except ExpanderError as e:
+        raise ExpandException("Racket produced an error and said '%s'" % e.msg)
+
 # Call the Racket expander and read its output from STDOUT rather than producing an
 # intermediate (possibly cached) file.
 def expand_file_rpython(rkt_file, lib=_FN):
+    timer = startup_stats.start("expand", rkt_file)
+    try:
+        return _expand_file_rpython(rkt_file, lib)
+    finally:
+        startup_stats.stop(timer)
+
+def _expand_file_rpython(rkt_file, lib):
     from rpython.rlib.rfile import create_popen_file
     cmd = "racket %s --stdout \"%s\" 2>&1" % (lib, rkt_file)
     if not os.access(rkt_file, os.R_OK):
         raise ValueError("Cannot access file %s" % rkt_file)
+    data = expand_with_server(rkt_file, lib)
+    if data is not None:
+        return data
     pipe = create_popen_file(cmd, "r")
     out = pipe.read()
     err = os.WEXITSTATUS(pipe.close())
@@ -147,6 +169,13 @@ def expand_file_to_json(rkt_file, json_file, byte_flag=False):
     return _expand_file_to_json(rkt_file, json_file, byte_flag)
 
 def _expand_file_to_json(rkt_file, json_file, byte_flag=False, multi_flag=False):
+    timer = startup_stats.start("expand", rkt_file)
+    try:
+        return _run_expander_to_json(rkt_file, json_file, byte_flag, multi_flag)
+    finally:
+        startup_stats.stop(timer)
+
+def _run_expander_to_json(rkt_file, json_file, byte_flag, multi_flag):
     lib = _BE if byte_flag else _FN
 
     assert not (byte_flag and multi_flag)
@@ -170,6 +199,12 @@ def _expand_file_to_json(rkt_file, json_file, byte_flag=False, multi_flag=False)
         print "Complete expansion for %s into %s" % (rkt_file, json_file)
         cmd = "racket %s --complete-expansion --output \"%s\" \"%s\" 2>&1" % (lib, json_file, rkt_file)
     else:
+        data = expand_with_server(rpath.realpath(os.path.abspath(rkt_file)), lib)
+        if data is not None:
+            print "Expanding %s to %s" % (rkt_file, json_file)
+            binary_ast.write_file(json_file, data)
+            return json_file
+
         if byte_flag:
             print "Transforming %s bytecode to %s" % (rkt_file, json_file)
         else:
@@ -219,14 +254,68 @@ def needs_update(file_name, json_name):
 def _json_name(file_name):
     return file_name + '.json'
 
-def ensure_json_ast_run(file_name, byte_flag=False):
+def _bin_name(file_name):
+    return file_name + '.bin'
+
+def _bundle_name(file_name):
+    # distinct from _bin_name, so that the complete and the per module
+    # expansions of the same file do not overwrite each other
+    return file_name + '.bundle.bin'
+
+def _strip_bundle_suffix(file_name):
+    if file_name.endswith('.bundle.bin'):
+        to = len(file_name) - len('.bundle.bin')
+        assert to > 0
+        return file_name[:to]
+    return file_name
+
+def _strip_json_suffix(file_name):
+    if file_name.endswith('.json'):
+        to = len(file_name) - 5
+        assert to > 0
+        return file_name[:to]
+    return file_name
+
+def ensure_json_ast_run(file_name, byte_flag=False, cache=None):
+    if cache is not None:
+        cached, expanded = ensure_cached_ast(file_name, byte_flag, cache)
+        if cached is not None:
+            return cached
+        if expanded is not None:
+            # the cache is not writable, keep the expansion next to the
+            # source instead of expanding it again
+            bin = _bin_name(file_name)
+            if binary_ast.try_dump_file(bin, expanded):
+                return bin
+            raise PermException(file_name)
     json = _json_name(file_name)
     dbgprint("ensure_json_ast_run", json, filename=file_name)
+    bin = _bin_name(file_name)
+    if not needs_update(file_name, bin) and binary_ast.is_current_file(bin):
+        return bin
     if needs_update(file_name, json):
         return expand_file_to_json(file_name, json, byte_flag)
     else:
         return json
 
+def ensure_cached_ast(file_name, byte_flag, cache):
+    """
+    Look up the expansion of `file_name` in the expansion cache, expanding it
+    into the cache if necessary. Returns the name of the cache entry and, if
+    the expansion could not be stored, the expansion itself instead.
+    """
+    file_name = rpath.realpath(os.path.abspath(file_name))
+    cached = cache.lookup(file_name, byte_flag)
+    if cached is not None:
+        return cached, None
+    lib = _BE if byte_flag else _FN
+    print "Expanding %s into %s" % (file_name, cache.directory)
+    json = pycket_json.loads(expand_file_rpython(file_name, lib))
+    entry = cache.store(file_name, byte_flag, json)
+    if entry is None:
+        return None, json
+    return entry, None
+
 def ensure_json_ast_eval(code, file_name, stdlib=True, mcons=False, wrap=True):
     json = _json_name(file_name)
     if needs_update(file_name, json):
@@ -237,24 +326,53 @@ def ensure_json_ast_eval(code, file_name, stdlib=True, mcons=False, wrap=True):
 
 #### ========================== Functions for parsing json to an AST
 
+def parse_ast_data(data, fname=None):
+    """
+    Decode expander output, which is either JSON text or the binary format of
+    pycket.binary_ast. When the JSON came from a `<file>.json` written by the
+    expander, a binary copy is cached next to it so that later runs can skip
+    the JSON parser.
+    """
+    if binary_ast.is_binary(data):
+        return binary_ast.loads(data)
+    json = pycket_json.loads(data)
+    if fname is not None and fname.endswith('.json'):
+        binary_ast.try_dump_file(_bin_name(_strip_json_suffix(fname)), json)
+    return json
+
 def parse_ast(json_string):
     json = pycket_json.loads(json_string)
     modtable = ModTable()
     return to_ast(json, modtable)
 
-def finalize_module(mod):
+def finalize_module(mod, modname=None):
+    from pycket                import config
     from pycket.interpreter    import Context
     from pycket.assign_convert import assign_convert
+    from pycket.constant_fold  import constant_fold
+    from pycket.lambda_lift    import lambda_lift
+    if modname is None:
+        modname = mod.name
+    timer = startup_stats.start("normalize", modname)
     mod = Context.normalize_term(mod)
+    startup_stats.stop(timer)
+    if config.constant_folding:
+        timer = startup_stats.start("constant-fold", modname)
+        mod = constant_fold(mod)
+        startup_stats.stop(timer)
+    if config.lambda_lifting:
+        timer = startup_stats.start("lambda-lift", modname)
+        mod = lambda_lift(mod)
+        startup_stats.stop(timer)
+    timer = startup_stats.start("assign-convert", modname)
     mod = assign_convert(mod)
     mod.clean_caches()
+    startup_stats.stop(timer)
     return mod
 
-def parse_module(json_string, bytecode_expand=False):
-    json = pycket_json.loads(json_string)
-    modtable = ModTable()
-    reader = JsonLoader(bytecode_expand)
-    module = reader.to_module(json)
+def parse_module(json_string, bytecode_expand=False, lazy_lambda_bodies=False):
+    reader = JsonLoader(bytecode_expand, lazy_lambda_bodies=lazy_lambda_bodies)
+    module = reader.to_module_from_string(json_string)
     return finalize_module(module)
 
 #### ========================== Implementation functions
@@ -297,6 +415,42 @@ def to_formals(json):
         return [get_lexical(x) for x in arr], None
     assert 0
 
+def scan_lambda_body(json, refs, bound, targets):
+    """
+    Collect the lexical variables referenced and bound in the expander output
+    `json`, and the targets of its set! expressions.
+    """
+    if json.is_array:
+        arr = json.value_array()
+        if len(arr) == 3 and arr[0].is_object:
+            rator = arr[0].value_object().get("source-name", None)
+            if rator is not None and rator.is_string and rator.value_string() == "set!":
+                targets.append(arr[1].value_object())
+        for elem in arr:
+            scan_lambda_body(elem, refs, bound, targets)
+    elif json.is_object:
+        obj = json.value_object()
+        if "quote" in obj or "quote-syntax" in obj:
+            return
+        if "lexical" in obj:
+            lexical = obj["lexical"]
+            if lexical.is_string:
+                refs[lexical.value_string()] = None
+            return
+        if "lambda" in obj:
+            fmls, rest = to_formals(obj["lambda"])
+            for fml in fmls:
+                bound[fml.variable_name()] = None
+            if rest is not None:
+                bound[rest.variable_name()] = None
+        for key in ["let-bindings", "letrec-bindings"]:
+            if key in obj:
+                for binding in obj[key].value_array():
+                    for name in binding.value_array()[0].value_array():
+                        bound[name.value_string()] = None
+        for value in obj.itervalues():
+            scan_lambda_body(value, refs, bound, targets)
+
 def mksym(json):
     dbgprint("mksym", json)
     j = json.value_object()
@@ -427,15 +581,47 @@ def parse_path(p):
     return srcmod, path
 
 class ModuleMap(object):
+    """
+    The modules of a complete expansion (the `-c` option). These are either
+    read from the combined JSON written by the expander, or from a memory
+    mapped module bundle (see pycket.binary_ast), in which case a module is
+    only decoded once a Require actually reaches it.
+    """
 
     def __init__(self, json_file_name):
         assert json_file_name is not None and json_file_name != ""
-        data = readfile_rpython(rpath.realpath(os.path.abspath(json_file_name)))
+        fname = rpath.realpath(os.path.abspath(json_file_name))
         self.source_json = json_file_name
+        self.mod_map = None
+        self.bundle = None
+        if binary_ast.is_current_bundle(fname):
+            self.bundle = binary_ast.ModuleBundle(fname)
+            return
+        bin = _bundle_name(_strip_json_suffix(fname))
+        if not needs_update(fname, bin) and binary_ast.is_current_bundle(bin):
+            self.bundle = binary_ast.ModuleBundle(bin)
+            return
+        data = readfile_rpython(fname)
         self.mod_map = pycket_json.loads(data)
         ## TODO: validate the json
+        self.write_bundle(bin)
+
+    def write_bundle(self, bin_name):
+        assert self.mod_map is not None
+        names = []
+        modules = []
+        for name, mod in self.mod_map.value_object().iteritems():
+            names.append(name)
+            modules.append(mod)
+        binary_ast.try_dump_bundle(bin_name, names, modules)
 
     def get_mod(self, mod_path):
+        if self.bundle is not None:
+            if not self.bundle.has_module(mod_path):
+                raise ValueError('Requested module - %s - is not in - %s.' %
+                                 (mod_path, self.source_json))
+            return self.bundle.get_module(mod_path)
+
         if not mod_path in self.mod_map.value_object():
             raise ValueError('Requested module - %s - is not in - %s.' %
                              (mod_path, self.source_json))
@@ -444,13 +630,18 @@ class ModuleMap(object):
 
 class JsonLoader(object):
 
-    _immutable_fields_ = ["modtable", "bytecode_expand", "multiple_modules"]
+    _immutable_fields_ = ["modtable", "bytecode_expand", "multiple_modules", "expansion_cache",
+                          "lazy_lambda_bodies"]
 
-    def __init__(self, bytecode_expand=False, multiple_modules=False, module_mapper=None):
+    def __init__(self, bytecode_expand=False, multiple_modules=False, module_mapper=None,
+                 expansion_cache=None, lazy_lambda_bodies=False):
         self.modtable = ModTable()
         self.bytecode_expand = bytecode_expand
+        # the bytecode expander does not give lexical variables unique names
+        self.lazy_lambda_bodies = lazy_lambda_bodies and not bytecode_expand
         self.multi_mod_flag = multiple_modules
         self.multi_mod_mapper = module_mapper
+        self.expansion_cache = expansion_cache
 
     def _lib_string(self):
         return _BE if self.bytecode_expand else _FN
@@ -461,31 +652,89 @@ class JsonLoader(object):
         fname = rpath.realpath(fname)
         data = expand_file_rpython(fname, self._lib_string())
         self.modtable.enter_module(fname)
-        module = self.to_module(pycket_json.loads(data))
-        module = finalize_module(module)
+        timer = startup_stats.start("to-ast", fname)
+        module = self.to_module_from_string(data)
+        startup_stats.stop(timer)
+        module = finalize_module(module, fname)
         self.modtable.exit_module(fname, module)
         return module
 
+    def load_json_ast_tree(self, modname, json):
+        """ Load a module from its expansion, which is not stored anywhere """
+        assert modname is not None
+        modname = rpath.realpath(modname)
+        self.modtable.enter_module(modname)
+        timer = startup_stats.start("to-ast", modname)
+        module = self.to_module(json)
+        startup_stats.stop(timer)
+        module = finalize_module(module, modname)
+        self.modtable.exit_module(modname, module)
+        return module
+
     def load_json_ast_rpython(self, modname, fname):
         assert modname is not None
         modname = rpath.realpath(modname)
         self.modtable.enter_module(modname)
 
-        if self.multi_mod_flag:
-            mod_ast = self.multi_mod_mapper.get_mod(modname)
-            module = self.to_module(mod_ast)
-        else:
-            data = readfile_rpython(fname)
-            module = self.to_module(pycket_json.loads(data))
+        cached_name = self._cached_module_name(fname)
+        module = None
+        if cached_name is not None:
+            timer = startup_stats.start("read-module", modname)
+            module = module_cache.try_load_file(cached_name, self)
+            startup_stats.stop(timer)
+        if module is None:
+            timer = startup_stats.start("read", modname)
+            json = None
+            data = None
+            if self.multi_mod_flag:
+                json = self.multi_mod_mapper.get_mod(modname)
+            else:
+                data = readfile_rpython(fname)
+                if fname.endswith('.json') and not binary_ast.is_binary(data):
+                    # the tree of a .json file is also cached in binary form
+                    json = parse_ast_data(data, fname)
+            startup_stats.stop(timer)
+
+            # reading the JSON text is part of the conversion, see
+            # to_module_from_string
+            timer = startup_stats.start("to-ast", modname)
+            if json is not None:
+                module = self.to_module(json)
+            else:
+                assert data is not None
+                module = self.to_module_from_string(data)
+            startup_stats.stop(timer)
+
+            module = finalize_module(module, modname)
+            if cached_name is not None:
+                timer = startup_stats.start("write-module", modname)
+                if module_cache.try_dump_file(cached_name, module):
+                    self.expansion_cache.evict([cached_name, fname])
+                startup_stats.stop(timer)
 
-        module = finalize_module(module)
         self.modtable.exit_module(modname, module)
         return module
 
+    def _cached_module_name(self, fname):
+        # Only modules loaded from the expansion cache are cached, under the
+        # same key. Lazily converted lambda bodies cannot be cached.
+        cache = self.expansion_cache
+        if cache is None or self.multi_mod_flag or self.lazy_lambda_bodies:
+            return None
+        return cache.module_entry(fname)
+
     def expand_file_cached(self, rkt_file):
         dbgprint("expand_file_cached", "", lib=self._lib_string(), filename=rkt_file)
         # bypass if we already have module_map from the multi-ast-json
         if not self.multi_mod_flag:
+            cache = self.expansion_cache
+            if cache is not None:
+                entry, json = ensure_cached_ast(rkt_file, self.bytecode_expand, cache)
+                if entry is not None:
+                    return self.load_json_ast_rpython(rkt_file, entry)
+                if json is not None:
+                    # the cache is not writable, use the expansion directly
+                    return self.load_json_ast_tree(rkt_file, json)
             try:
                 json_file = ensure_json_ast_run(rkt_file, self.bytecode_expand)
             except PermException:
@@ -510,9 +759,70 @@ class JsonLoader(object):
     def _to_lambda(self, lam):
         fmls, rest = to_formals(lam["lambda"])
         sourceinfo = get_srcloc(lam)
-        body = [self.to_ast(x) for x in lam["body"].value_array()]
+        if self.lazy_lambda_bodies:
+            body = [self._to_lazy_body(lam["body"])]
+        else:
+            body = [self.to_ast(x) for x in lam["body"].value_array()]
         return make_lambda(fmls, rest, body, sourceinfo)
 
+    def _to_lazy_body(self, json):
+        """
+        Delay the conversion of a lambda body until the closure is called. The
+        expander gives every lexical binding a unique name, so the free
+        variables of the body are the lexical variables it references minus the
+        ones it binds itself.
+        """
+        refs, bound, targets = {}, {}, []
+        scan_lambda_body(json, refs, bound, targets)
+        frees = SymbolSet.EMPTY
+        for name in refs:
+            if name not in bound:
+                frees = frees.assoc(values.W_Symbol.make(name), None)
+        muts = variable_set()
+        for target in targets:
+            var = self._to_set_target(target)
+            if isinstance(var, CellRef):
+                if var.sym.variable_name() not in bound:
+                    muts[LexicalVar(var.sym)] = None
+            elif isinstance(var, ModuleVar):
+                muts[var] = None
+        return LazyBody(self, json, self.modtable.current_mod(), frees, muts)
+
+    def convert_lazy_body(self, lazy):
+        """ Convert, normalize and assignment convert the body of a LazyBody """
+        from pycket.assign_convert import AssignConvertVisitor
+        json = lazy.json
+        assert json is not None
+        self.modtable.push(lazy.module_name)
+        try:
+            body = [self.to_ast(x) for x in json.value_array()]
+        finally:
+            self.modtable.pop()
+        ast = Context.normalize_term(Begin.make(body))
+        return ast.visit(AssignConvertVisitor(), lazy.vars, lazy.env_structure)
+
+    def _to_set_target(self, target):
+        mksym = values.W_Symbol.make
+        if "source-name" in target:
+            srcname = mksym(target["source-name"].value_string())
+            if "source-module" in target:
+                if target["source-module"].is_array:
+                    path_arr = target["source-module"].value_array()
+                    srcmod, path = parse_path(path_arr)
+                else:
+                    srcmod = path = None
+            else:
+                srcmod = "#%kernel"
+                path   = None
+
+            modname = mksym(target["module"].value_string()) if "module" in target else srcname
+            return ModuleVar(modname, srcmod, srcname, path)
+        elif "lexical" in target:
+            return CellRef(mksym(target["lexical"].value_string()))
+        else:
+            assert "toplevel" in target
+            return ToplevelVar(mksym(target["toplevel"].value_string()))
+
     def _to_require(self, fname, path=None):
         path = shorten_submodule_path(path)
         modtable = self.modtable
@@ -544,28 +854,79 @@ class JsonLoader(object):
         # YYY
         obj = json.value_object()
         assert "body-forms" in obj, "got malformed JSON from expander"
+        self._check_config(obj)
+        lang = self._to_language(obj)
+        body = [self.to_ast(x) for x in getkey(obj, "body-forms", type='a')]
+        return self._make_module(obj, body, lang)
+
+    def to_module_from_string(self, data):
+        """
+        Convert the JSON text or binary AST of a module without building the
+        JSON tree of the whole module first: the events of the reader are
+        consumed directly, and every body form is converted as soon as it is
+        read, so that only the tree of a single form is alive at any time.
+        """
+        if binary_ast.is_binary(data):
+            reader = binary_ast.BinaryEventReader(data)
+        else:
+            reader = pycket_json.JsonEventReader(data)
+        return self.to_module_from_events(reader)
+
+    def to_module_from_events(self, reader):
+        builder = pycket_json.JsonTreeBuilder(reader)
+        if reader.next() != pycket_json.EVENT_START_OBJECT:
+            reader.error("got malformed JSON from expander")
+        obj = {}
+        body = None
+        while True:
+            event = reader.next()
+            if event == pycket_json.EVENT_END_OBJECT:
+                break
+            assert event == pycket_json.EVENT_KEY
+            key = reader.key
+            if key != "body-forms":
+                obj[key] = builder.read_value()
+                continue
+            if reader.next() != pycket_json.EVENT_START_ARRAY:
+                reader.error("expected an array of body forms")
+            body = []
+            while True:
+                event = reader.next()
+                if event == pycket_json.EVENT_END_ARRAY:
+                    break
+                body.append(self.to_ast(builder.build(event)))
+        builder.finish()
+        assert body is not None, "got malformed JSON from expander"
+        self._check_config(obj)
+        return self._make_module(obj, body, self._to_language(obj))
+
+    def _check_config(self, obj):
+        config_obj = getkey(obj, "config", type='o')
+        if config_obj is None:
+            return
+        be_json = False
+        be_value = config_obj.get("bytecode-expand", None)
+        if be_value is not None:
+            be_json = be_value.value_string() == "true"
+        if self.bytecode_expand != be_json:
+            modname = getkey(obj, "module-name", type='s')
+            raise ValueError('Byte-expansion is : %s, but "bytecode-expand" '
+                             'in json is : %s, in %s' %
+                             (self.bytecode_expand, be_json, modname))
+
+    def _to_language(self, obj):
+        try:
+            lang_arr = obj["language"].value_array()
+        except KeyError:
+            return None
+        return self._parse_require([lang_arr[0].value_string()]) if lang_arr else None
 
+    def _make_module(self, obj, body, lang):
         config = {}
         config_obj = getkey(obj, "config", type='o')
         if config_obj is not None:
             for k, v in config_obj.iteritems():
                 config[k] = v.value_string()
-
-            be_json = config.get("bytecode-expand", "false") == "true"
-            if self.bytecode_expand != be_json:
-                modname = getkey(obj, "module-name", type='s')
-                raise ValueError('Byte-expansion is : %s, but "bytecode-expand" '
-                                 'in json is : %s, in %s' %
-                                 (self.bytecode_expand, be_json, modname))
-
-        try:
-            lang_arr = obj["language"].value_array()
-        except KeyError:
-            lang = None
-        else:
-            lang = self._parse_require([lang_arr[0].value_string()]) if lang_arr else None
-
-        body = [self.to_ast(x) for x in getkey(obj, "body-forms", type='a')]
         name = getkey(obj, "module-name", type='s')
         return Module(name, body, config, lang=lang)
 
@@ -606,27 +967,7 @@ class JsonLoader(object):
             if ast_elem == "#%expression":
                 return self.to_ast(arr[1])
             if ast_elem == "set!":
-                target = arr[1].value_object()
-                var = None
-                if "source-name" in target:
-                    srcname = mksym(target["source-name"].value_string())
-                    if "source-module" in target:
-                        if target["source-module"].is_array:
-                            path_arr = target["source-module"].value_array()
-                            srcmod, path = parse_path(path_arr)
-                        else:
-                            srcmod = path = None
-                    else:
-                        srcmod = "#%kernel"
-                        path   = None
-
-                    modname = mksym(target["module"].value_string()) if "module" in target else srcname
-                    var = ModuleVar(modname, srcmod, srcname, path)
-                elif "lexical" in target:
-                    var = CellRef(values.W_Symbol.make(target["lexical"].value_string()))
-                else:
-                    assert "toplevel" in target
-                    var = ToplevelVar(mksym(target["toplevel"].value_string()))
+                var = self._to_set_target(arr[1].value_object())
                 return SetBang(var, self.to_ast(arr[2]))
             if ast_elem == "#%top":
                 assert 0
@@ -790,10 +1131,9 @@ def to_value(json):
         if "char" in obj:
             return values.W_Character.make(unichr(int(obj["char"].value_string())))
         if "hash-keys" in obj and "hash-vals" in obj:
-            return W_EqualHashTable(
+            return make_immutable_equal_table(
                     [to_value(i) for i in obj["hash-keys"].value_array()],
-                    [to_value(i) for i in obj["hash-vals"].value_array()],
-                    immutable=True)
+                    [to_value(i) for i in obj["hash-vals"].value_array()])
         if "regexp" in obj:
             return values_regex.W_Regexp(obj["regexp"].value_string())
         if "byte-regexp" in obj:
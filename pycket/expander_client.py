@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Client for the persistent Racket expander.
+#
+# Starting `racket -l pycket/expand` loads the whole Racket expander, which
+# dominates the time of expanding a small module. The expander can instead be
+# kept running as a server on a unix socket:
+#
+#   racket -l pycket/expand -- --server <socket>
+#
+# When that socket exists, expansions are requested from the server, otherwise
+# the callers in pycket.expand fall back to starting a new racket process.
+
+import os
+
+from rpython.rlib import rsocket
+
+SERVER_SOCKET_VARIABLE = "PYCKET_EXPANDER_SOCKET"
+
+def default_socket_path():
+    path = os.environ.get(SERVER_SOCKET_VARIABLE, None)
+    if path is not None:
+        return path
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", "")
+    if runtime_dir:
+        return runtime_dir + "/pycket-expander.sock"
+    return "/tmp/pycket-expander-%d.sock" % os.getuid()
+
+class ExpanderError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+class ExpanderClient(object):
+    _immutable_fields_ = ["socket_path"]
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def available(self):
+        return self.socket_path != "" and os.access(self.socket_path, os.F_OK)
+
+    def _request(self, request):
+        """ Send a request, returns None if the server could not be reached """
+        try:
+            sock = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+        except rsocket.SocketError:
+            return None
+        chunks = []
+        try:
+            try:
+                sock.connect(rsocket.UNIXAddress(self.socket_path))
+                sock.sendall(request + "\n")
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    chunks.append(data)
+            except rsocket.SocketError:
+                return None
+        finally:
+            sock.close()
+        return parse_response("".join(chunks))
+
+    def expand(self, rkt_file):
+        """
+        Expand `rkt_file` (an absolute path) and return the JSON. Returns None
+        if there is no server, and raises ExpanderError if the server failed
+        to expand the module.
+        """
+        if not self.available():
+            return None
+        return self._request("expand %s" % rkt_file)
+
+    def shutdown(self):
+        if not self.available():
+            return False
+        return self._request("shutdown") is not None
+
+def parse_response(response):
+    newline = response.find("\n")
+    if newline < 0:
+        return None
+    header = response[:newline].split(" ")
+    if len(header) != 2:
+        return None
+    status = header[0]
+    try:
+        length = int(header[1])
+    except ValueError:
+        return None
+    start = newline + 1
+    end = start + length
+    if length < 0 or end != len(response):
+        return None
+    body = response[start:end]
+    if status == "ok":
+        return body
+    raise ExpanderError(body)
+
+class ClientHolder(object):
+    # The socket path depends on the environment at runtime, so the client is
+    # created on first use rather than at translation time.
+    def __init__(self):
+        self.client = None
+
+_holder = ClientHolder()
+
+def get_client():
+    client = _holder.client
+    if client is None:
+        client = _holder.client = ExpanderClient(default_socket_path())
+    return client
@@ -0,0 +1,394 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A content addressed cache of expanded modules.
+#
+# Instead of writing `<file>.json` next to every source file and comparing
+# modification times, expanded modules are stored as binary ASTs in a cache
+# directory. An entry is found through two keys:
+#
+#   <key>.deps            the manifest: the direct dependencies of the module,
+#                         at phase 0 and for syntax, together with their
+#                         dependency hashes (see below) at expansion time
+#   <key>-<depkey>.bin    the expanded module
+#   <key>-<depkey>.ast    the module after normalization and assignment
+#                         conversion, see pycket/module_cache.py
+#
+# where <key> hashes the path and content of the source file, the expander
+# version and the bytecode-expand flag, and <depkey> hashes the contents of the
+# dependencies listed in the manifest. The dependency hash of a file covers its
+# content and, if it is cached itself, the dependency hashes of the files in its
+# own manifest, so comparing them to the manifest on lookup catches changes to
+# any module the expansion transitively depends on. Since the dependency hash of
+# a module changes when it is stored, storing it also rewrites the manifests of
+# the modules depending on it that this process stored before, like a program
+# that is expanded before the modules it requires. Touching a file therefore
+# does not cause a re-expansion, but editing it or one of its dependencies
+# does. Since nothing is written next to the sources, this also works on
+# read-only trees.
+#
+# The cache is bounded in size: when a store makes the cache outgrow its limit,
+# the least recently used entries are evicted until it fits again. The size of
+# the directory is only computed the first time, and then kept up to date with
+# the files written by this process, so most stores do not list the directory.
+
+import os
+
+from rpython.rlib          import streamio
+from rpython.rlib.listsort import make_timsort_class
+from rpython.rlib.rsha     import RSHA
+from pycket                import binary_ast
+
+# Bump this whenever the output of pycket/expand.rkt or pycket/zo-expand.rkt
+# changes, to invalidate existing cache entries
+EXPANDER_VERSION = "2"
+
+MANIFEST_HEADER = "pycket-expansion-cache %s %d" % (EXPANDER_VERSION, binary_ast.FORMAT_VERSION)
+
+HASH_LENGTH = 40 # length of a SHA-1 hex digest
+
+DEFAULT_MAX_SIZE = 256 # megabytes
+
+def default_cache_directory():
+    base = os.environ.get("XDG_CACHE_HOME", "")
+    if not base:
+        home = os.environ.get("HOME", "")
+        if not home:
+            return None
+        base = home + "/.cache"
+    return base + "/pycket"
+
+def make_expansion_cache(config, names):
+    """ Create the cache configured by the command line, or None if caching
+    is disabled or the cache directory is not usable. """
+    if not config.get('expansion-cache', True):
+        return None
+    directory = names.get('cache-dir', "")
+    if not directory:
+        directory = os.environ.get("PYCKET_CACHE_DIR", "")
+    if not directory:
+        directory = default_cache_directory()
+    if directory is None:
+        return None
+    max_size = DEFAULT_MAX_SIZE
+    size = names.get('cache-size', "")
+    if size:
+        try:
+            max_size = int(size)
+        except ValueError:
+            print "ignoring invalid cache size %s" % size
+    cache = ExpansionCache(directory, max_size * 1024 * 1024)
+    if not cache.ensure_directory():
+        return None
+    return cache
+
+def collect_dependencies(json, deps):
+    """ Collect the files named by the require forms of an expanded module,
+    including the ones required for syntax """
+    if json.is_array:
+        for elem in json.value_array():
+            collect_dependencies(elem, deps)
+    elif json.is_object:
+        obj = json.value_object()
+        requires = obj.get("require", None)
+        if requires is not None and requires.is_array:
+            collect_require_paths(requires, deps)
+            syntax_requires = obj.get("require-for-syntax", None)
+            if syntax_requires is not None and syntax_requires.is_array:
+                collect_require_paths(syntax_requires, deps)
+            return
+        for value in obj.itervalues():
+            collect_dependencies(value, deps)
+
+def collect_require_paths(requires, deps):
+    for path in requires.value_array():
+        if not path.is_array:
+            continue
+        path = path.value_array()
+        if not path or not path[0].is_string:
+            continue
+        fname = path[0].value_string()
+        if fname.startswith("/") and fname not in deps:
+            deps[fname] = None
+
+class StoredModule(object):
+    def __init__(self, file_name, key, deps, byte_flag):
+        self.file_name = file_name
+        self.key = key
+        self.deps = deps
+        self.byte_flag = byte_flag
+
+class CacheEntry(object):
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+BaseEntrySorter = make_timsort_class()
+
+class EntrySorter(BaseEntrySorter):
+    def lt(self, a, b):
+        return a.mtime < b.mtime
+
+class ExpansionCache(object):
+    _immutable_fields_ = ["directory", "max_size"]
+
+    def __init__(self, directory, max_size):
+        self.directory = directory.rstrip("/")
+        self.max_size = max_size
+        self.file_hashes = {}
+        self.dependency_hashes = {}
+        # for every file, the files whose dependency hash includes its own
+        self.hash_users = {}
+        # the size of the directory, -1 until it is first listed
+        self.known_size = -1
+        # the modules stored by this process, by key, and the keys of the
+        # ones depending on a file
+        self.stored = {}
+        self.dependents = {}
+
+    def ensure_directory(self):
+        """ Create the cache directory (and its parents) if necessary """
+        path = ""
+        for part in self.directory.split("/"):
+            if not part:
+                path += "/"
+                continue
+            path += part
+            if not os.access(path, os.F_OK):
+                try:
+                    os.mkdir(path, 0755)
+                except OSError:
+                    return False
+            path += "/"
+        return os.access(self.directory, os.W_OK)
+
+    def _path(self, name):
+        return self.directory + "/" + name
+
+    def hash_file(self, fname):
+        result = self.file_hashes.get(fname, None)
+        if result is None:
+            try:
+                data = binary_ast.readfile(fname)
+            except (OSError, streamio.StreamError):
+                return None
+            result = RSHA(data).hexdigest()
+            self.file_hashes[fname] = result
+        return result
+
+    def source_key(self, file_name, byte_flag):
+        content = self.hash_file(file_name)
+        if content is None:
+            return None
+        sha = RSHA(MANIFEST_HEADER)
+        sha.update("\n%s\n%s\n" % (file_name, content))
+        sha.update("bytecode-expand" if byte_flag else "expand")
+        return sha.hexdigest()
+
+    def dependencies_key(self, deps):
+        """ Returns None if one of the dependencies is not readable """
+        sha = RSHA()
+        for dep in deps:
+            content = self.hash_file(dep)
+            if content is None:
+                return None
+            sha.update("%s %s\n" % (content, dep))
+        return sha.hexdigest()
+
+    def dependency_hash(self, dep, byte_flag):
+        """ Hash the content of `dep` together with the dependency hashes of
+        the files in its manifest, if it is cached. Returns None if `dep` is
+        not readable. """
+        result = self.dependency_hashes.get(dep, None)
+        if result is not None:
+            return result
+        content = self.hash_file(dep)
+        if content is None:
+            return None
+        # cyclic requires are not valid Racket, but must not recurse forever
+        self.dependency_hashes[dep] = content
+        key = self.source_key(dep, byte_flag)
+        manifest = self.read_manifest_hashes(key) if key is not None else None
+        if manifest:
+            sha = RSHA(content)
+            for _, sub in manifest:
+                self.hash_users.setdefault(sub, {})[dep] = None
+                sub_hash = self.dependency_hash(sub, byte_flag)
+                if sub_hash is None:
+                    sub_hash = "-"
+                sha.update("\n%s %s" % (sub_hash, sub))
+            result = sha.hexdigest()
+            self.dependency_hashes[dep] = result
+            return result
+        return content
+
+    def invalidate_dependency_hash(self, dep):
+        """ Forget the dependency hash of `dep` and of the files whose
+        dependency hashes include it """
+        if dep in self.dependency_hashes:
+            del self.dependency_hashes[dep]
+        # recomputing the hashes records the edges again
+        users = self.hash_users.pop(dep, None)
+        if users is not None:
+            for user in users:
+                self.invalidate_dependency_hash(user)
+
+    def update_dependents(self, file_name, byte_flag, seen):
+        """ Rewrite the manifests of the stored modules depending on
+        `file_name`, whose dependency hash has changed """
+        for key in self.dependents.get(file_name, []):
+            if key in seen:
+                continue
+            seen[key] = None
+            module = self.stored[key]
+            if module.byte_flag != byte_flag:
+                continue
+            if self.write_manifest(key, module.file_name, module.deps, byte_flag):
+                self.update_dependents(module.file_name, byte_flag, seen)
+
+    def read_manifest_hashes(self, key):
+        """ The (dependency hash, file name) pairs of a manifest """
+        try:
+            data = binary_ast.readfile(self._path(key + ".deps"))
+        except (OSError, streamio.StreamError):
+            return None
+        lines = data.split("\n")
+        if not lines or lines[0] != MANIFEST_HEADER:
+            return None
+        manifest = []
+        for i in range(1, len(lines)):
+            line = lines[i]
+            if len(line) > HASH_LENGTH + 1:
+                manifest.append((line[:HASH_LENGTH], line[HASH_LENGTH + 1:]))
+        return manifest
+
+    def read_manifest(self, key):
+        manifest = self.read_manifest_hashes(key)
+        if manifest is None:
+            return None
+        return [dep for _, dep in manifest]
+
+    def write_manifest(self, key, file_name, deps, byte_flag):
+        lines = [MANIFEST_HEADER]
+        for dep in deps:
+            content = self.dependency_hash(dep, byte_flag)
+            if content is None:
+                return False
+            lines.append("%s %s" % (content, dep))
+        lines.append("")
+        # the dependency hash of file_name, and of the files requiring it,
+        # changes with its manifest
+        self.invalidate_dependency_hash(file_name)
+        return binary_ast.try_write_file(self._path(key + ".deps"), "\n".join(lines))
+
+    def lookup(self, file_name, byte_flag):
+        """ Returns the cached binary AST of `file_name`, or None """
+        key = self.source_key(file_name, byte_flag)
+        if key is None:
+            return None
+        manifest = self.read_manifest_hashes(key)
+        if manifest is None:
+            return None
+        dep_key = self.dependencies_key([dep for _, dep in manifest])
+        if dep_key is None:
+            return None
+        entry = self._path("%s-%s.bin" % (key, dep_key))
+        if not binary_ast.is_current_file(entry):
+            return None
+        for recorded, dep in manifest:
+            if self.dependency_hash(dep, byte_flag) != recorded:
+                return None
+        try:
+            # record the use for the LRU eviction
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return entry
+
+    def module_entry(self, entry):
+        """ The name of the cached module that belongs to the cache entry
+        `entry`, or None if `entry` is not part of this cache """
+        if not entry.startswith(self.directory + "/") or not entry.endswith(".bin"):
+            return None
+        return entry[:len(entry) - len(".bin")] + ".ast"
+
+    def cached_dependencies(self, file_name, byte_flag):
+        """ The direct dependencies of a cached module according to its
+        manifest, or None if `file_name` is not in the cache """
+        if self.lookup(file_name, byte_flag) is None:
+            return None
+        key = self.source_key(file_name, byte_flag)
+        assert key is not None
+        return self.read_manifest(key)
+
+    def store(self, file_name, byte_flag, json):
+        """ Store the expansion `json` of `file_name`, returns the name of the
+        cache entry or None if it could not be written """
+        key = self.source_key(file_name, byte_flag)
+        if key is None:
+            return None
+        dct = {}
+        collect_dependencies(json, dct)
+        deps = []
+        for dep in dct.keys():
+            if dep != file_name and self.hash_file(dep) is not None:
+                deps.append(dep)
+        dep_key = self.dependencies_key(deps)
+        assert dep_key is not None
+        entry = self._path("%s-%s.bin" % (key, dep_key))
+        if not binary_ast.try_dump_file(entry, json):
+            return None
+        if not self.write_manifest(key, file_name, deps, byte_flag):
+            return None
+        self.stored[key] = StoredModule(file_name, key, deps, byte_flag)
+        for dep in deps:
+            keys = self.dependents.setdefault(dep, [])
+            if key not in keys:
+                keys.append(key)
+        self.update_dependents(file_name, byte_flag, {})
+        self.evict([entry, self._path(key + ".deps")])
+        return entry
+
+    def evict(self, keep):
+        """ Remove the least recently used files until the cache fits into
+        its size limit again. The files in `keep`, which were just written,
+        are never removed. The directory is only listed if the cache may
+        have outgrown its limit. """
+        if self.known_size >= 0:
+            for path in keep:
+                try:
+                    self.known_size += os.stat(path).st_size
+                except OSError:
+                    pass
+            if self.known_size <= self.max_size:
+                return
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        entries = []
+        total = 0
+        for name in names:
+            path = self._path(name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append(CacheEntry(path, st.st_size, st.st_mtime))
+            total += st.st_size
+        self.known_size = total
+        if total <= self.max_size:
+            return
+        EntrySorter(entries).sort()
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            if entry.path in keep:
+                continue
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            total -= entry.size
+        self.known_size = total
@@ -2,15 +2,18 @@
 from pycket                   import config
 from pycket                   import values, values_string
 from pycket.base              import SingletonMeta, UnhashableType
-from pycket.hash.base         import W_HashTable, get_dict_item, next_valid_index, w_missing
+from pycket.hash.base         import (
+    W_HashTable,
+    W_ImmutableHashTable,
+    get_dict_item,
+    w_missing)
+from pycket.hash.persistent_hash_map import make_persistent_hash_type
 from pycket.error             import SchemeException
 from pycket.cont              import continuation, loop_label
 from rpython.rlib             import rerased, jit
 from rpython.rlib.rarithmetic import r_uint, intmask
 from rpython.rlib.objectmodel import compute_hash, import_from_mixin, r_dict, specialize
 
-import sys
-
 def elidable_iff(pred):
     def wrapper(func):
         @jit.elidable
@@ -42,27 +45,6 @@ def catch_ref_is_equal_cont(data, idx, key, v, env, cont, _vals):
         return return_value(v, env, cont)
     return equal_hash_ref_loop(data, idx + 1, key, env, cont)
 
-def equal_hash_set_loop(data, idx, key, val, env, cont):
-    from pycket.interpreter import check_one_val, return_value
-    from pycket.prims.equal import equal_func, EqualInfo
-    if idx >= len(data):
-        data.append((key, val))
-        return return_value(values.w_void, env, cont)
-    k, _ = data[idx]
-    info = EqualInfo.BASIC_SINGLETON
-    return equal_func(k, key, info, env,
-            catch_set_is_equal_cont(data, idx, key, val, env, cont))
-
-@continuation
-def catch_set_is_equal_cont(data, idx, key, val, env, cont, _vals):
-    from pycket.interpreter import check_one_val, return_value
-    cmp = check_one_val(_vals)
-    if cmp is not values.w_false:
-        data[idx] = (key, val)
-        return return_value(values.w_void, env, cont)
-    return equal_hash_set_loop(data, idx + 1, key, val, env, cont)
-
-
 class HashmapStrategy(object):
     __metaclass__ = SingletonMeta
 
@@ -238,116 +220,237 @@ UNHASHABLE_TAG = 0b0001
 
 def tagged_hash(w_object):
     try:
-        return w_object.hash_equal() << 1
+        return intmask(equal_hash(w_object) << 1)
     except UnhashableType:
         return UNHASHABLE_TAG
 
+# Hashing consistent with equal?. Like in Racket, only HASH_BUDGET parts of a
+# compound value contribute to its hash, so hashing large or cyclic values
+# takes constant time. Chaperones hash like the value they wrap, since they
+# can only return chaperones of its parts. Impersonators can return anything,
+# which equal? compares but the hash cannot see without calling them, so they
+# are unhashable, like structs with prop:equal+hash, whose hash procedure can
+# only be called with a continuation. All unhashable keys get UNHASHABLE_TAG,
+# and since such a key can be equal? to a key with any hash, lookups compare
+# it with every key of the table, and other keys with the unhashable keys of
+# the table as well as their own hash bucket.
+
+HASH_BUDGET = 64
+
+class HashState(object):
+    _attrs_ = ["budget"]
+
+    def __init__(self):
+        self.budget = HASH_BUDGET
+
+def equal_hash(w_object):
+    return _equal_hash(w_object, HashState())
+
+def _equal_hash(w_object, state):
+    from pycket import values_struct, vector as values_vector
+    while w_object.is_proxy():
+        if not w_object.is_chaperone():
+            raise UnhashableType
+        w_object = w_object.get_proxied()
+    if isinstance(w_object, values.W_Cons) or isinstance(w_object, values.W_MCons):
+        return _equal_hash_list(w_object, state)
+    if isinstance(w_object, values.W_MBox) or isinstance(w_object, values.W_IBox):
+        if state.budget <= 0:
+            return 0x2d4c6b
+        state.budget -= 1
+        return intmask(0x2d4c6b ^ _equal_hash(_box_value(w_object), state))
+    if isinstance(w_object, values_vector.W_Vector):
+        return _equal_hash_vector(w_object, state)
+    if isinstance(w_object, values_struct.W_RootStruct):
+        struct_type = w_object.struct_type()
+        if struct_type.read_prop(values_struct.w_prop_equal_hash):
+            raise UnhashableType
+        if struct_type.isopaque:
+            return compute_hash(w_object)
+        x = struct_type.name.hash_equal()
+        for w_field in w_object.vals():
+            if state.budget <= 0:
+                break
+            state.budget -= 1
+            x = intmask((1000003 * x) ^ _equal_hash(w_field, state))
+        return x
+    return w_object.hash_equal()
+
+def _equal_hash_list(w_list, state):
+    x = 0x345678
+    while isinstance(w_list, values.W_Cons) or isinstance(w_list, values.W_MCons):
+        if state.budget <= 0:
+            break
+        state.budget -= 1
+        if isinstance(w_list, values.W_UnwrappedFixnumCons):
+            y = w_list._car
+        else:
+            y = _equal_hash(w_list.car(), state)
+        x = intmask((1000003 * x) ^ y)
+        w_list = w_list.cdr()
+    return x
+
+def _equal_hash_vector(w_vector, state):
+    x = 0x456789
+    for i in range(w_vector.length()):
+        if state.budget <= 0:
+            break
+        state.budget -= 1
+        x = intmask((1000003 * x) ^ _equal_hash(w_vector.ref(i), state))
+    return x
+
+def _box_value(w_box):
+    if isinstance(w_box, values.W_MBox):
+        return w_box.value
+    assert isinstance(w_box, values.W_IBox)
+    return w_box.value
+
+# The storage of ObjectHashmapStrategy is compact, like CPython's dicts: the
+# entries are kept in insertion order in dense lists, which are indexed by an
+# open-addressed table of entry positions. Entries are never removed, so the
+# position of an entry is also its iteration position.
+
+MIN_INDEX_SIZE = 8
+PERTURB_SHIFT = 5
+
+class CompactStorage(object):
+    _attrs_ = ["hashes", "keys", "vals", "index", "unhashable"]
+
+    def __init__(self):
+        self.hashes = []
+        self.keys = []
+        self.vals = []
+        # entry positions plus one, 0 marks a free slot
+        self.index = [0] * MIN_INDEX_SIZE
+        # the number of entries with UNHASHABLE_TAG
+        self.unhashable = 0
+
+    def length(self):
+        return len(self.keys)
+
+    def lookup(self, hash):
+        """ The positions of the entries with the given hash """
+        index = self.index
+        mask = len(index) - 1
+        perturb = r_uint(hash)
+        i = intmask(perturb) & mask
+        positions = []
+        while True:
+            pos = index[i] - 1
+            if pos < 0:
+                return positions
+            if self.hashes[pos] == hash:
+                positions.append(pos)
+            perturb >>= PERTURB_SHIFT
+            i = intmask(r_uint(i) * 5 + perturb + 1) & mask
+
+    def candidates(self, hash):
+        """ The positions of the entries whose key can be equal? to a key
+        with the given hash """
+        if hash == UNHASHABLE_TAG:
+            return range(len(self.keys))
+        positions = self.lookup(hash)
+        if self.unhashable:
+            positions = positions + self.lookup(UNHASHABLE_TAG)
+        return positions
+
+    def append(self, hash, key, val):
+        if hash == UNHASHABLE_TAG:
+            self.unhashable += 1
+        if 3 * (len(self.keys) + 1) >= 2 * len(self.index):
+            self.resize()
+        self.insert_index(len(self.keys), hash)
+        self.hashes.append(hash)
+        self.keys.append(key)
+        self.vals.append(val)
+
+    def insert_index(self, pos, hash):
+        index = self.index
+        mask = len(index) - 1
+        perturb = r_uint(hash)
+        i = intmask(perturb) & mask
+        while index[i] != 0:
+            perturb >>= PERTURB_SHIFT
+            i = intmask(r_uint(i) * 5 + perturb + 1) & mask
+        index[i] = pos + 1
+
+    def resize(self):
+        size = len(self.index)
+        while 3 * (len(self.keys) + 1) >= 2 * size:
+            size *= 2
+        self.index = [0] * size
+        for pos in range(len(self.hashes)):
+            self.insert_index(pos, self.hashes[pos])
+
+@loop_label
+def equal_compact_loop(storage, positions, idx, hash, key, val, env, cont):
+    """ Looks up key among the entries at positions. A val of None means
+    hash-ref, otherwise the entry is set to val, or added. """
+    from pycket.interpreter import return_value
+    from pycket.prims.equal import equal_func_unroll_n, EqualInfo
+    if idx >= len(positions):
+        if val is None:
+            return return_value(w_missing, env, cont)
+        storage.append(hash, key, val)
+        return return_value(values.w_void, env, cont)
+    info = EqualInfo.BASIC_SINGLETON
+    cont = catch_compact_is_equal_cont(storage, positions, idx, hash, key, val, env, cont)
+    return equal_func_unroll_n(storage.keys[positions[idx]], key, info, env, cont, 5)
+
+@continuation
+def catch_compact_is_equal_cont(storage, positions, idx, hash, key, val, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_value
+    cmp = check_one_val(_vals)
+    if cmp is values.w_false:
+        return equal_compact_loop(storage, positions, idx + 1, hash, key, val, env, cont)
+    pos = positions[idx]
+    if val is None:
+        return return_value(storage.vals[pos], env, cont)
+    # keep the key of the table, like Racket does; the new key can have a
+    # different hash if one of them is unhashable
+    storage.vals[pos] = val
+    return return_value(values.w_void, env, cont)
+
 class ObjectHashmapStrategy(HashmapStrategy):
     erase, unerase = rerased.new_static_erasing_pair("object-hashmap-strategry")
 
     import_from_mixin(UnwrappedHashmapStrategyMixin)
 
-    def get_bucket(self, w_dict, w_key, nonull=False):
-        hash    = tagged_hash(w_key)
-        storage = self.get_storage(w_dict)
-        bucket  = storage.get(hash, None)
-        if nonull and bucket is None:
-            storage[hash] = bucket = []
-        return bucket
-
     def get(self, w_dict, w_key, env, cont):
         from pycket.interpreter import return_value
-        bucket = self.get_bucket(w_dict, w_key)
-        if not bucket:
+        hash = tagged_hash(w_key)
+        storage = self.get_storage(w_dict)
+        positions = storage.candidates(hash)
+        if not positions:
             return return_value(w_missing, env, cont)
-        return equal_hash_ref_loop(bucket, 0, w_key, env, cont)
+        return equal_compact_loop(storage, positions, 0, hash, w_key, None, env, cont)
 
     def set(self, w_dict, w_key, w_val, env, cont):
-        bucket = self.get_bucket(w_dict, w_key, nonull=True)
-        return equal_hash_set_loop(bucket, 0, w_key, w_val, env, cont)
+        hash = tagged_hash(w_key)
+        storage = self.get_storage(w_dict)
+        positions = storage.candidates(hash)
+        return equal_compact_loop(storage, positions, 0, hash, w_key, w_val, env, cont)
 
     def _set(self, w_dict, w_key, w_val):
         raise NotImplementedError("Unsafe set not supported for ObjectHashmapStrategy")
 
     def items(self, w_dict):
-        items = []
         storage = self.unerase(w_dict.hstorage)
-        for bucket in storage.itervalues():
-            for item in bucket:
-                items.append(item)
-        return items
-
-    if sys.maxint == 2147483647:
-
-        def get_item(self, w_dict, i):
-            storage = self.unerase(w_dict.hstorage)
-            for bucket in storage.itervalues():
-                size = len(bucket)
-                if size > i:
-                    return bucket[i]
-                i -= size
-            raise IndexError
+        return [(storage.keys[i], storage.vals[i]) for i in range(storage.length())]
 
-    else:
-
-        @staticmethod
-        def _valid_bucket(v):
-            return bool(v[1])
-
-        def get_item(self, w_dict, i):
-            from pycket.hash.persistent_hash_map import MASK_32
-            storage = self.unerase(w_dict.hstorage)
-            assert i >= 0
-            i = r_uint(i)
-            index = i & MASK_32
-            subindex = (i >> 32) & MASK_32
-
-            bucket = get_dict_item(storage, index)[1]
-            if bucket is None:
-                raise IndexError
-            return bucket[subindex]
-
-        def hash_iterate_next(self, w_dict, pos):
-            from pycket.hash.persistent_hash_map import MASK_32
-            storage = self.unerase(w_dict.hstorage)
-            i = r_uint(pos.value)
-            assert i >= 0
-            index    = r_uint(i & MASK_32)
-            subindex = r_uint((i >> 32) & MASK_32)
-
-            bucket = get_dict_item(storage, index)[1]
-            subindex += 1
-            if subindex == r_uint(len(bucket)):
-                subindex = r_uint(0)
-                try:
-                    next = next_valid_index(storage, intmask(index),
-                                            valid=self._valid_bucket)
-                except IndexError:
-                    return values.w_false
-                index = r_uint(next)
-
-            next = intmask((subindex << r_uint(32)) | index)
-            return values.wrap(next)
-
-        def hash_iterate_first(self, w_dict):
-            return next_valid_index(w_dict, 0, valid=self._valid_bucket)
+    def get_item(self, w_dict, i):
+        storage = self.unerase(w_dict.hstorage)
+        if i >= storage.length():
+            raise IndexError
+        return storage.keys[i], storage.vals[i]
 
     def length(self, w_dict):
-        storage = self.unerase(w_dict.hstorage)
-        size = 0
-        for bucket in storage.itervalues():
-            size += len(bucket)
-        return size
+        return self.unerase(w_dict.hstorage).length()
 
     def create_storage(self, keys, vals):
-        storage = {}
+        storage = CompactStorage()
         for i, key in enumerate(keys):
-            val  = vals[i]
-            hash = tagged_hash(key)
-            bucket = storage.get(hash, None)
-            if bucket is None:
-                storage[hash] = bucket = []
-            bucket.append((key, val))
+            storage.append(tagged_hash(key), key, vals[i])
         return self.erase(storage)
 
 class FixnumHashmapStrategy(HashmapStrategy):
@@ -506,3 +609,170 @@ class W_EqualHashTable(W_HashTable):
         lst = [values.W_Cons.make(k, v).tostring() for k, v in self.hash_items()]
         return "#hash(%s)" % " ".join(lst)
 
+
+# Immutable equal?-based tables are persistent hash maps as long as all their
+# keys are direct: keys that equal? can compare without running Racket code,
+# so that the map can compare them directly. A key is direct if it is built
+# from atomic values, pairs, immutable boxes and vectors and transparent
+# structs with immutable fields, and is small enough for DIRECT_KEY_FUEL. The
+# limit also excludes cyclic keys. Mutable parts are excluded because they
+# could be changed to hold an impersonator after the key was added. Tables
+# with other keys (impersonators, structs with prop:equal+hash, ...) use a
+# W_EqualHashTable instead.
+
+DIRECT_KEY_FUEL = 128
+
+def is_direct_key(w_key):
+    return _direct_key_fuel(w_key, DIRECT_KEY_FUEL) >= 0
+
+def _direct_key_fuel(w_key, fuel):
+    from pycket import values_struct, vector as values_vector
+    while True:
+        fuel -= 1
+        if fuel < 0 or w_key.is_proxy():
+            return -1
+        if isinstance(w_key, values.W_Cons):
+            fuel = _direct_key_fuel(w_key.car(), fuel)
+            if fuel < 0:
+                return -1
+            w_key = w_key.cdr()
+        elif isinstance(w_key, values.W_IBox):
+            w_key = w_key.value
+        elif isinstance(w_key, values.W_MCons) or isinstance(w_key, values.W_MBox):
+            return -1
+        elif isinstance(w_key, values.W_MVector):
+            if (not isinstance(w_key, values_vector.W_Vector) or
+                    not w_key.immutable()):
+                return -1
+            for i in range(w_key.length()):
+                fuel = _direct_key_fuel(w_key.ref(i), fuel)
+                if fuel < 0:
+                    return -1
+            return fuel
+        elif isinstance(w_key, values_struct.W_RootStruct):
+            struct_type = w_key.struct_type()
+            if struct_type.read_prop(values_struct.w_prop_equal_hash):
+                return -1
+            if struct_type.isopaque:
+                return fuel
+            if not struct_type.all_fields_immutable():
+                return -1
+            for w_field in w_key.vals():
+                fuel = _direct_key_fuel(w_field, fuel)
+                if fuel < 0:
+                    return -1
+            return fuel
+        else:
+            return fuel
+
+def equal_direct(a, b):
+    """ equal? on two direct keys, which never needs equal_func: direct keys
+    are deeply immutable, so they cannot come to hold an impersonator """
+    from pycket.prims.equal import equalp_logic, EqualState
+    return equalp_logic(a, b, EqualState())
+
+W_EqualImmutableHashTable = make_persistent_hash_type(
+        super=W_ImmutableHashTable,
+        keytype=values.W_Object,
+        valtype=values.W_Object,
+        name="W_EqualImmutableHashTable",
+        hashfun=lambda x: r_uint(tagged_hash(x)),
+        equal=equal_direct)
+
+class __extend__(W_EqualImmutableHashTable):
+
+    def length(self):
+        return len(self)
+
+    def make_copy(self):
+        return self
+
+    def make_empty(self):
+        return W_EqualImmutableHashTable.EMPTY
+
+    def hash_items(self):
+        return [(k, v) for k, v in self.iteritems()]
+
+    def hash_ref(self, key, env, cont):
+        from pycket.interpreter import return_value
+        if is_direct_key(key):
+            result = self.val_at(key, w_missing)
+            return return_value(result, env, cont)
+        cont = equal_immutable_ref_cont(self, env, cont)
+        return self.find_equal_key(key, env, cont)
+
+    def hash_remove(self, key, env, cont):
+        from pycket.interpreter import return_value
+        if is_direct_key(key):
+            return return_value(self.without(key), env, cont)
+        cont = equal_immutable_remove_cont(self, env, cont)
+        return self.find_equal_key(key, env, cont)
+
+    def hash_set_persistent(self, key, val, env, cont):
+        """ The table extended with key, which is not direct """
+        cont = equal_immutable_set_cont(self, key, val, env, cont)
+        return self.find_equal_key(key, env, cont)
+
+    def find_equal_key(self, key, env, cont):
+        """ The key of the table that is equal? to key, or w_missing. Only
+        keys with the same hash can be equal, but key is not direct, so the
+        comparison has to go through equal_func. The keys of the table are
+        direct and never unhashable, but an unhashable key can be equal? to
+        any of them. """
+        hash = tagged_hash(key)
+        if hash == UNHASHABLE_TAG:
+            data = [(k, k) for k, _ in self.iteritems()]
+        else:
+            data = [(k, k) for k, _ in self.entries_with_hash(r_uint(hash))]
+        return equal_hash_ref_loop(data, 0, key, env, cont)
+
+    def tostring(self):
+        assert type(self) is W_EqualImmutableHashTable
+        entries = [None] * len(self)
+        i = 0
+        for k, v in self.iteritems():
+            entries[i] = "(%s . %s)" % (k.tostring(), v.tostring())
+            i += 1
+        return "#hash(%s)" % " ".join(entries)
+
+@continuation
+def equal_immutable_ref_cont(table, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_value
+    key = check_one_val(_vals)
+    if key is w_missing:
+        return return_value(w_missing, env, cont)
+    return return_value(table.val_at(key, w_missing), env, cont)
+
+@continuation
+def equal_immutable_remove_cont(table, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_value
+    key = check_one_val(_vals)
+    if key is w_missing:
+        return return_value(table, env, cont)
+    return return_value(table.without(key), env, cont)
+
+@continuation
+def equal_immutable_set_cont(table, key, val, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_value
+    found = check_one_val(_vals)
+    if found is not w_missing:
+        # keep the equal key of the table, so that all keys stay direct
+        return return_value(table.assoc(found, val), env, cont)
+    # A new key that is not direct turns the table into a W_EqualHashTable,
+    # and every hash-set on that copies all of its entries. Building a table
+    # with n such keys (e.g. mutable vectors) one hash-set at a time is
+    # therefore quadratic; use a mutable table for that.
+    keys = table.keys() + [key]
+    vals = table.vals() + [val]
+    return return_value(W_EqualHashTable(keys, vals, immutable=True), env, cont)
+
+def make_immutable_equal_table(keys, vals):
+    """ An immutable equal?-based table, persistent if all keys are direct """
+    assert len(keys) == len(vals)
+    for key in keys:
+        if not is_direct_key(key):
+            return W_EqualHashTable(keys, vals, immutable=True)
+    table = W_EqualImmutableHashTable.EMPTY
+    for i, key in enumerate(keys):
+        table = table.assoc(key, vals[i])
+    return table
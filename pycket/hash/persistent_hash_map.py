@@ -609,6 +609,43 @@ def make_persistent_hash_type(
                     return restrict_val_type(val_or_node)
                 shift += 5
 
+        @jit.dont_look_inside
+        def entries_with_hash(self, hash):
+            """ The (key, value) pairs whose key has the given hash. Only
+            follows the path of hash through the trie and never calls equal,
+            so callers can compare the keys themselves. """
+            entries = []
+            hashval = hash & MASK_32
+            shift = r_uint(0)
+            node = self._root
+            while node is not None:
+                t = type(node)
+                if t is BitmapIndexedNode:
+                    bit = bitpos(hashval, shift)
+                    if (node._bitmap & bit) == 0:
+                        break
+                    key_or_null, val_or_node = node.entry(node.index(bit))
+                    if key_or_null is None:
+                        assert isinstance(val_or_node, INode)
+                        node = val_or_node
+                    else:
+                        if hashfun(key_or_null) & MASK_32 == hashval:
+                            entries.append(restrict_types(key_or_null, val_or_node))
+                        break
+                elif t is ArrayNode:
+                    node = node._array[mask(hashval, shift)]
+                elif t is HashCollisionNode:
+                    if node._hash == hashval:
+                        for x in range(node.entry_count()):
+                            key_or_null = node.keyat(x)
+                            if key_or_null is not None:
+                                entries.append(restrict_types(key_or_null, node.valat(x)))
+                    break
+                else:
+                    break
+                shift += 5
+            return entries
+
         @jit.dont_look_inside
         def without(self, key):
             key = restrict_key_type(key)
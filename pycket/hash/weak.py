@@ -0,0 +1,305 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Mutable hash tables that hold their keys weakly, for make-weak-hasheq,
+# make-late-weak-hasheq and make-weak-hash.
+#
+# The entries of a table are kept in insertion order in a list, whose indices
+# are the iteration positions of the table, and in buckets indexed by the hash
+# of their key. An entry refers to its key through a weak reference, so once
+# the key is collected the entry is dead: lookups and iteration skip it. Dead
+# and removed entries are dropped when the entry list fills up, which rebuilds
+# the buckets and makes room for twice the number of live entries, so the
+# cleanup is amortized over the insertions.
+#
+# Values are held strongly, as in Racket. Fixnums and characters are compared
+# by value and can never become unreachable in Racket terms, so they are held
+# strongly as well.
+
+from pycket                   import values
+from pycket.cont              import continuation
+from pycket.hash.base         import W_MutableHashTable, w_missing
+from pycket.hash.equal        import (
+    UNHASHABLE_TAG, equal_hash_ref_loop, tagged_hash)
+from pycket.hash.simple       import W_EqMutableHashTable
+from rpython.rlib             import jit, rweakref
+
+MIN_CLEANUP_SIZE = 8
+
+class WeakEntry(object):
+    _attrs_ = ["hash", "index", "weak_key", "strong_key", "value"]
+
+    def __init__(self, hash, index, key, value):
+        self.hash = hash
+        self.index = index
+        if isinstance(key, values.W_Fixnum) or isinstance(key, values.W_Character):
+            self.weak_key = None
+            self.strong_key = key
+        else:
+            self.weak_key = rweakref.ref(key)
+            self.strong_key = None
+        self.value = value
+
+    def get_key(self):
+        """ The key of the entry, or None if it has been collected """
+        if self.weak_key is None:
+            return self.strong_key
+        return self.weak_key()
+
+class W_WeakHashTable(W_MutableHashTable):
+    _attrs_ = ["entries", "buckets", "cleanup_size"]
+
+    def __init__(self):
+        self.entries = []
+        self.buckets = {}
+        self.cleanup_size = MIN_CLEANUP_SIZE
+
+    def hash_key(self, key):
+        raise NotImplementedError("abstract method")
+
+    def make_empty(self):
+        raise NotImplementedError("abstract method")
+
+    def make_copy(self):
+        table = self.make_empty()
+        for entry in self.entries:
+            if entry is None:
+                continue
+            key = entry.get_key()
+            if key is not None:
+                table.add_entry(entry.hash, key, entry.value)
+        return table
+
+    @jit.dont_look_inside
+    def find_entry(self, hash, key):
+        """ The live entry whose key is key, or None """
+        bucket = self.buckets.get(hash, None)
+        if bucket is None:
+            return None
+        for entry in bucket:
+            if entry.get_key() is key:
+                return entry
+        return None
+
+    @jit.dont_look_inside
+    def live_keys(self, hash):
+        """ The live keys of the bucket for hash """
+        bucket = self.buckets.get(hash, None)
+        if bucket is None:
+            return []
+        keys = []
+        for entry in bucket:
+            key = entry.get_key()
+            if key is not None:
+                keys.append(key)
+        return keys
+
+    @jit.dont_look_inside
+    def add_entry(self, hash, key, val):
+        if len(self.entries) >= self.cleanup_size:
+            self.cleanup()
+        entry = WeakEntry(hash, len(self.entries), key, val)
+        self.entries.append(entry)
+        bucket = self.buckets.get(hash, None)
+        if bucket is None:
+            self.buckets[hash] = [entry]
+        else:
+            bucket.append(entry)
+
+    @jit.dont_look_inside
+    def remove_entry(self, entry):
+        self.entries[entry.index] = None
+        bucket = self.buckets[entry.hash]
+        bucket.remove(entry)
+        if not bucket:
+            del self.buckets[entry.hash]
+
+    @jit.dont_look_inside
+    def cleanup(self):
+        """ Drop dead and removed entries and rebuild the buckets """
+        entries = []
+        buckets = {}
+        for entry in self.entries:
+            if entry is None or entry.get_key() is None:
+                continue
+            entry.index = len(entries)
+            entries.append(entry)
+            bucket = buckets.get(entry.hash, None)
+            if bucket is None:
+                buckets[entry.hash] = [entry]
+            else:
+                bucket.append(entry)
+        self.entries = entries
+        self.buckets = buckets
+        self.cleanup_size = max(MIN_CLEANUP_SIZE, 2 * len(entries))
+
+    def live_entry(self, i):
+        entry = self.entries[i]
+        if entry is None:
+            return None
+        key = entry.get_key()
+        if key is None:
+            return None
+        return entry
+
+    def length(self):
+        count = 0
+        for i in range(len(self.entries)):
+            if self.live_entry(i) is not None:
+                count += 1
+        return count
+
+    def hash_items(self):
+        items = []
+        for entry in self.entries:
+            if entry is None:
+                continue
+            key = entry.get_key()
+            if key is not None:
+                items.append((key, entry.value))
+        return items
+
+    def get_item(self, i):
+        if i >= len(self.entries):
+            raise IndexError
+        entry = self.live_entry(i)
+        if entry is None:
+            raise KeyError
+        return (entry.get_key(), entry.value)
+
+    def hash_iterate_first(self):
+        return self.next_live_index(0)
+
+    def hash_iterate_next(self, pos):
+        try:
+            return values.wrap(self.next_live_index(pos.value + 1))
+        except IndexError:
+            return values.w_false
+
+    def next_live_index(self, i):
+        while i < len(self.entries):
+            if self.live_entry(i) is not None:
+                return i
+            i += 1
+        raise IndexError
+
+    def tostring(self):
+        lst = [values.W_Cons.make(k, v).tostring() for k, v in self.hash_items()]
+        return "#hash(%s)" % " ".join(lst)
+
+class W_WeakEqHashTable(W_WeakHashTable):
+
+    def hash_key(self, key):
+        return W_EqMutableHashTable.hash_value(key)
+
+    def make_empty(self):
+        return W_WeakEqHashTable()
+
+    def lookup(self, key):
+        hash = self.hash_key(key)
+        for k in self.live_keys(hash):
+            if W_EqMutableHashTable.cmp_value(k, key):
+                return self.find_entry(hash, k)
+        return None
+
+    def _set(self, key, val):
+        entry = self.lookup(key)
+        if entry is not None:
+            entry.value = val
+        else:
+            self.add_entry(self.hash_key(key), key, val)
+
+    def hash_set(self, key, val, env, cont):
+        from pycket.interpreter import return_value
+        self._set(key, val)
+        return return_value(values.w_void, env, cont)
+
+    def hash_ref(self, key, env, cont):
+        from pycket.interpreter import return_value
+        entry = self.lookup(key)
+        if entry is None:
+            return return_value(w_missing, env, cont)
+        return return_value(entry.value, env, cont)
+
+    def hash_remove_inplace(self, key, env, cont):
+        from pycket.interpreter import return_value
+        entry = self.lookup(key)
+        if entry is not None:
+            self.remove_entry(entry)
+        return return_value(values.w_void, env, cont)
+
+class W_WeakEqualHashTable(W_WeakHashTable):
+
+    def hash_key(self, key):
+        return tagged_hash(key)
+
+    def make_empty(self):
+        return W_WeakEqualHashTable()
+
+    @jit.dont_look_inside
+    def all_live_keys(self):
+        keys = []
+        for entry in self.entries:
+            if entry is None:
+                continue
+            key = entry.get_key()
+            if key is not None:
+                keys.append(key)
+        return keys
+
+    def find_equal_key(self, key, env, cont):
+        """ The key of the table that is equal? to key, or w_missing. An
+        unhashable key can be equal? to any key of the table. """
+        hash = self.hash_key(key)
+        if hash == UNHASHABLE_TAG:
+            keys = self.all_live_keys()
+        else:
+            keys = self.live_keys(hash) + self.live_keys(UNHASHABLE_TAG)
+        data = [(k, k) for k in keys]
+        return equal_hash_ref_loop(data, 0, key, env, cont)
+
+    def hash_set(self, key, val, env, cont):
+        cont = weak_equal_set_cont(self, key, val, env, cont)
+        return self.find_equal_key(key, env, cont)
+
+    def hash_ref(self, key, env, cont):
+        cont = weak_equal_ref_cont(self, env, cont)
+        return self.find_equal_key(key, env, cont)
+
+    def hash_remove_inplace(self, key, env, cont):
+        cont = weak_equal_remove_cont(self, env, cont)
+        return self.find_equal_key(key, env, cont)
+
+@continuation
+def weak_equal_set_cont(table, key, val, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_value
+    found = check_one_val(_vals)
+    entry = None
+    if found is not w_missing:
+        entry = table.find_entry(table.hash_key(found), found)
+    if entry is not None:
+        entry.value = val
+    else:
+        table.add_entry(table.hash_key(key), key, val)
+    return return_value(values.w_void, env, cont)
+
+@continuation
+def weak_equal_ref_cont(table, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_value
+    found = check_one_val(_vals)
+    if found is w_missing:
+        return return_value(w_missing, env, cont)
+    entry = table.find_entry(table.hash_key(found), found)
+    if entry is None:
+        return return_value(w_missing, env, cont)
+    return return_value(entry.value, env, cont)
+
+@continuation
+def weak_equal_remove_cont(table, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_value
+    found = check_one_val(_vals)
+    if found is not w_missing:
+        entry = table.find_entry(table.hash_key(found), found)
+        if entry is not None:
+            table.remove_entry(entry)
+    return return_value(values.w_void, env, cont)
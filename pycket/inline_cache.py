@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Polymorphic inline caches for call sites.
+#
+# An App remembers the case-lambdas of the last few closures it called. The
+# number of arguments of a call site never changes, so the lambda accepting
+# them is resolved and arity checked once, when the entry is created. A hit
+# saves the work of call_with_extra_info that only depends on the lambda:
+#
+# - the failing match_args calls of the clauses before the accepting one
+# - for a lambda without rest or mutable parameters (direct), the arity and
+#   rest checks and the binds_mutable_var loop of match_args, since the
+#   arguments are then bound as they are
+#
+# A single lambda that is not direct has nothing to save, so its entry has no
+# lambda and the call goes through call_with_extra_info as without a cache.
+# Entries are shared by all closures of a case-lambda, including the single
+# lambda closures that are their own environment (W_Closure1AsEnv).
+#
+# Primitives are not cached, since calling their code directly is all a hit
+# could do.
+#
+# The caches are only used by the interpreter, i.e. without the JIT or before
+# a loop is compiled; traces specialize on the callee anyway.
+
+CACHE_SIZE = 4
+
+class CacheEntry(object):
+    _immutable_fields_ = ["caselam", "lam_index", "lam", "direct"]
+
+    def __init__(self, caselam, lam_index, lam, direct):
+        self.caselam = caselam
+        self.lam_index = lam_index
+        # None if a hit would not save anything
+        self.lam = lam
+        # whether the arguments of the call site are the actuals of lam,
+        # computed once instead of by match_args on every call
+        self.direct = direct
+
+class InlineCache(object):
+
+    def __init__(self):
+        # most recently added first
+        self.entries = []
+
+    def lookup(self, caselam):
+        for entry in self.entries:
+            if entry.caselam is caselam:
+                return entry
+        return None
+
+    def add(self, entry):
+        if len(self.entries) >= CACHE_SIZE:
+            self.entries.pop()
+        self.entries.insert(0, entry)
+
+class InlineCacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+stats = InlineCacheStats()
@@ -4,12 +4,17 @@
 from pycket                   import config
 from pycket                   import values, values_string, values_parameter
 from pycket                   import vector
+from pycket                   import startup_stats
 from pycket.AST               import AST
 from pycket.arity             import Arity
 from pycket.cont              import Cont, NilCont, label
 from pycket.env               import SymList, ConsEnv, ToplevelEnv
 from pycket.error             import SchemeException
 from pycket.prims.expose      import prim_env, make_call_method
+from pycket.profiler          import profiler, poll as profile_poll
+from pycket                   import inline_cache
+from pycket.inline_cache      import CacheEntry, InlineCache
+from pycket.native_stack      import native_stack
 
 from pycket.hash.persistent_hash_map import make_persistent_hash_type
 
@@ -800,7 +805,11 @@ class Require(AST):
         module = self.find_module(env)
         top = env.toplevel_env()
         top.module_env.add_module(self.fname, module.root_module())
+        if module.interpreted:
+            return values.w_void
+        timer = startup_stats.start("instantiate", self.fname)
         module.interpret_mod(top)
+        startup_stats.stop(timer)
         return values.w_void
 
     def collect_module_info(self, info):
@@ -965,6 +974,7 @@ class App(AST):
         self.rator = rator
         self.rands = rands
         self.env_structure = env_structure
+        self.inline_cache = None
 
     @staticmethod
     def make(rator, rands, env_structure=None):
@@ -979,6 +989,11 @@ class App(AST):
                         return SimplePrimApp1(rator, rands, env_structure, w_prim)
                     if w_prim.simple2 and len(rands) == 2:
                         return SimplePrimApp2(rator, rands, env_structure, w_prim)
+                    if (config.superinstructions and w_prim.simple3 and
+                            len(rands) == 3):
+                        return SimplePrimApp3(rator, rands, env_structure, w_prim)
+        elif isinstance(rator, ModuleVar):
+            return KnownCallApp(rator, rands, env_structure)
         return App(rator, rands, env_structure)
 
     def direct_children(self):
@@ -1001,8 +1016,49 @@ class App(AST):
             # fast path
             jit.promote(w_callable)
             w_callable = w_callable.closure
+        if not jit.we_are_jitted():
+            return self.call_cached(w_callable, args_w, env, cont)
+        return w_callable.call_with_extra_info(args_w, env, cont, self)
+
+    def call_cached(self, w_callable, args_w, env, cont):
+        if isinstance(w_callable, values.W_Closure):
+            entry = self.cache_entry(w_callable.caselam, len(args_w))
+            if entry is not None and entry.lam is not None:
+                actuals = args_w if entry.direct else entry.lam.match_args(args_w)
+                return w_callable.call_lam(entry.lam_index, entry.lam, actuals,
+                                           env, cont, self)
+        elif isinstance(w_callable, values.W_Closure1AsEnv):
+            entry = self.cache_entry(w_callable.caselam, len(args_w))
+            if entry is not None and entry.lam is not None:
+                # single lambda, only cached when the arguments are direct
+                return w_callable.call_lam(entry.lam, args_w, env, cont, self)
         return w_callable.call_with_extra_info(args_w, env, cont, self)
 
+    def cache_entry(self, caselam, argc):
+        """ The entry of the inline cache for caselam, or None if none of its
+        lambdas accepts argc arguments """
+        cache = self.inline_cache
+        if cache is None:
+            cache = self.inline_cache = InlineCache()
+        entry = cache.lookup(caselam)
+        if entry is not None:
+            inline_cache.stats.hits += 1
+            return entry
+        index = caselam.find_lam_index(argc)
+        if index < 0:
+            # let the closure report the arity error
+            return None
+        lam = caselam.lams[index]
+        direct = lam.rest is None and not lam.binds_mutable_var()
+        if not direct and len(caselam.lams) == 1:
+            # a hit could not skip anything, the entry only records that
+            entry = CacheEntry(caselam, index, None, False)
+        else:
+            entry = CacheEntry(caselam, index, lam, direct)
+        cache.add(entry)
+        inline_cache.stats.misses += 1
+        return entry
+
     def normalize(self, context):
         context = Context.AppRator(self.rands, context)
         return Context.normalize_name(self.rator, context, hint="AppRator")
@@ -1011,6 +1067,60 @@ class App(AST):
         elements = [self.rator] + self.rands
         return "(%s)" % " ".join([r.tostring() for r in elements])
 
+# binding states of a KnownCallApp
+UNBOUND = 0
+BOUND   = 1
+UNKNOWN = 2
+
+class KnownCallApp(App):
+    """ An application of a module-level variable. The first call after the
+    variable is defined binds the closure it holds, unless it is mutated, and
+    the index of the lambda accepting the arguments. Later calls skip the
+    lookup and the arity dispatch. """
+    _immutable_fields_ = ["state?", "w_closure?", "lam_index?"]
+    visitable = False
+
+    def __init__(self, rator, rands, env_structure=None):
+        App.__init__(self, rator, rands, env_structure)
+        self.state = UNBOUND
+        self.w_closure = None
+        self.lam_index = -1
+
+    @jit.dont_look_inside
+    def bind(self, env):
+        rator = self.rator
+        assert isinstance(rator, ModuleVar)
+        try:
+            if rator.is_mutable(env):
+                self.state = UNKNOWN
+                return
+            w_callable = rator._lookup(env)
+        except SchemeException:
+            # not defined yet, the call reports it
+            return
+        if isinstance(w_callable, values.W_PromotableClosure):
+            w_callable = w_callable.closure
+        if isinstance(w_callable, values.W_Closure):
+            index = w_callable.caselam.find_lam_index(len(self.rands))
+            if index >= 0:
+                self.w_closure = w_callable
+                self.lam_index = index
+                self.state = BOUND
+                return
+        self.state = UNKNOWN
+
+    @jit.unroll_safe
+    def interpret(self, env, cont):
+        if self.state == UNBOUND:
+            self.bind(env)
+        w_closure = self.w_closure
+        if w_closure is None:
+            return App.interpret(self, env, cont)
+        args_w = [None] * len(self.rands)
+        for i, rand in enumerate(self.rands):
+            args_w[i] = rand.interpret_simple(env)
+        return w_closure.call_lam_index(self.lam_index, args_w, env, cont, self)
+
 class SimplePrimApp1(App):
     _immutable_fields_ = ['w_prim', 'rand1']
     simple = True
@@ -1082,6 +1192,43 @@ class SimplePrimApp2(App):
             return convert_runtime_exception(exn, env, cont)
         return return_multi_vals_direct(result, env, cont)
 
+class SimplePrimApp3(App):
+    _immutable_fields_ = ['w_prim', 'rand1', 'rand2', 'rand3']
+    simple = True
+    visitable = False
+
+    def __init__(self, rator, rands, env_structure, w_prim):
+        App.__init__(self, rator, rands, env_structure)
+        assert len(rands) == 3
+        self.rand1, self.rand2, self.rand3 = rands
+        self.w_prim = w_prim
+
+    def normalize(self, context):
+        context = Context.AppRand(self.rator, context)
+        return Context.normalize_names(self.rands, context)
+
+    def run(self, env):
+        arg1 = self.rand1.interpret_simple(env)
+        arg2 = self.rand2.interpret_simple(env)
+        arg3 = self.rand3.interpret_simple(env)
+        result = self.w_prim.simple3(arg1, arg2, arg3)
+        if result is None:
+            result = values.w_void
+        return result
+
+    def interpret_simple(self, env):
+        return check_one_val(self.run(env))
+
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        if not env.pycketconfig().callgraph:
+            self.set_should_enter() # to jit downrecursion
+        try:
+            result = self.run(env)
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        return return_multi_vals_direct(result, env, cont)
+
 class SequencedBodyAST(AST):
     _immutable_fields_ = ["body[*]", "counting_asts[*]",
                           "_sequenced_env_structure",
@@ -1466,6 +1613,11 @@ class If(AST):
                 return els
             else:
                 return thn
+        if config.superinstructions:
+            if isinstance(tst, SimplePrimApp1):
+                return IfSimplePrim1(tst, thn, els)
+            if isinstance(tst, SimplePrimApp2):
+                return IfSimplePrim2(tst, thn, els)
         return If(tst, thn, els)
 
     @objectmodel.always_inline
@@ -1486,6 +1638,50 @@ class If(AST):
     def _tostring(self):
         return "(if %s %s %s)" % (self.tst.tostring(), self.thn.tostring(), self.els.tostring())
 
+class IfSimplePrim1(If):
+    """ An if whose test is a one argument simple primitive application,
+    which is called directly """
+    _immutable_fields_ = ["w_prim", "rand1"]
+    visitable = False
+
+    def __init__(self, tst, thn, els):
+        If.__init__(self, tst, thn, els)
+        assert isinstance(tst, SimplePrimApp1)
+        self.w_prim = tst.w_prim
+        self.rand1 = tst.rand1
+
+    def interpret(self, env, cont):
+        w_val = self.w_prim.simple1(self.rand1.interpret_simple(env))
+        if w_val is None:
+            w_val = values.w_void
+        if check_one_val(w_val) is values.w_false:
+            return self.els, env, cont
+        else:
+            return self.thn, env, cont
+
+class IfSimplePrim2(If):
+    """ An if whose test is a two argument simple primitive application,
+    which is called directly """
+    _immutable_fields_ = ["w_prim", "rand1", "rand2"]
+    visitable = False
+
+    def __init__(self, tst, thn, els):
+        If.__init__(self, tst, thn, els)
+        assert isinstance(tst, SimplePrimApp2)
+        self.w_prim = tst.w_prim
+        self.rand1 = tst.rand1
+        self.rand2 = tst.rand2
+
+    def interpret(self, env, cont):
+        w_val = self.w_prim.simple2(self.rand1.interpret_simple(env),
+                                    self.rand2.interpret_simple(env))
+        if w_val is None:
+            w_val = values.w_void
+        if check_one_val(w_val) is values.w_false:
+            return self.els, env, cont
+        else:
+            return self.thn, env, cont
+
 def make_lambda(formals, rest, body, sourceinfo=None):
     """
     Create a λ-node after computing information about the free variables
@@ -1537,6 +1733,13 @@ class CaseLambda(AST):
     def make_recursive_copy(self, sym):
         return CaseLambda(self.lams, sym, self._arity)
 
+    def find_lam_index(self, argc):
+        """ The index of the first lambda accepting argc arguments, or -1 """
+        for i, lam in enumerate(self.lams):
+            if lam.accepts(argc):
+                return i
+        return -1
+
     def interpret_simple(self, env):
         if not env.pycketconfig().callgraph:
             self.enable_jitting() # XXX not perfectly pretty
@@ -1621,6 +1824,9 @@ class Lambda(SequencedBodyAST):
     visitable = True
     simple = True
     ispure = True
+    # the compiled body, see pycket.bytecode
+    bytecode_body = None
+    bytecode_failed = False
 
     import_from_mixin(BindingFormMixin)
 
@@ -1643,6 +1849,28 @@ class Lambda(SequencedBodyAST):
     def enable_jitting(self):
         self.body[0].set_should_enter()
 
+    def make_begin_cont(self, env, prev, i=0):
+        if config.bytecode_interpreter and not i:
+            body = self.bytecode_body
+            if body is None and not self.bytecode_failed:
+                body = self.compile_bytecode()
+            if body is not None:
+                return body, env, prev
+        return SequencedBodyAST.make_begin_cont(self, env, prev, i)
+
+    def compile_bytecode(self):
+        from pycket.bytecode import compile_lambda, NotCompilable, NotForced
+        try:
+            body = compile_lambda(self)
+        except NotForced:
+            # compiled on a later call, once the body is converted
+            return None
+        except NotCompilable:
+            self.bytecode_failed = True
+            return None
+        self.bytecode_body = body
+        return body
+
     def can_enter(self):
         return self.body[0].should_enter
 
@@ -1689,6 +1917,10 @@ class Lambda(SequencedBodyAST):
     def _is_mutable_arg(self, i):
         return self.args_need_cell_flags is not None and self.args_need_cell_flags[i]
 
+    def accepts(self, argc):
+        fmls_len = len(self.formals)
+        return fmls_len == argc or (self.rest is not None and fmls_len < argc)
+
     @jit.unroll_safe
     def match_args(self, args):
         fmls_len = len(self.formals)
@@ -1769,6 +2001,72 @@ class Lambda(SequencedBodyAST):
                 self.body[0].tostring() if len(self.body) == 1 else
                 " ".join([b.tostring() for b in self.body]))
 
+class LazyBody(AST):
+    """
+    The body of a lambda whose conversion from the expander output is delayed
+    until the closure is called for the first time (see
+    JsonLoader._to_lazy_body). The free and mutated variables are computed from
+    the JSON up front, so that the surrounding code can be normalized and
+    assignment converted as usual. Assignment conversion records the mutable
+    variables and the environment structure, which are needed to convert the
+    body later on.
+    """
+    _immutable_fields_ = ["loader", "module_name", "frees", "muts",
+                          "vars", "env_structure", "forced?"]
+    visitable = True
+
+    def __init__(self, loader, json, module_name, frees, muts,
+                 vars=None, env_structure=None):
+        self.loader = loader
+        self.json = json
+        self.module_name = module_name
+        self.frees = frees
+        self.muts = muts
+        self.vars = vars
+        self.env_structure = env_structure
+        self.forced = None
+
+    def with_conversion_context(self, vars, env_structure):
+        return LazyBody(self.loader, self.json, self.module_name, self.frees,
+                        self.muts, vars, env_structure)
+
+    def interpret(self, env, cont):
+        return self.force(), env, cont
+
+    def force(self):
+        forced = self.forced
+        if forced is None:
+            forced = self._force()
+        return forced
+
+    @jit.dont_look_inside
+    def _force(self):
+        assert self.vars is not None, "lambda body forced before assignment conversion"
+        forced = self.loader.convert_lazy_body(self)
+        lam = self.surrounding_lambda
+        if lam is not None:
+            forced.set_surrounding_lambda(lam)
+        self.forced = forced
+        # the JSON is not needed anymore
+        self.json = None
+        return forced
+
+    def set_surrounding_lambda(self, lam):
+        self.surrounding_lambda = lam
+
+    def _free_vars(self):
+        return self.frees
+
+    def _mutated_vars(self):
+        x = variable_set()
+        x.update(self.muts)
+        return x
+
+    def _tostring(self):
+        if self.forced is not None:
+            return self.forced.tostring()
+        return "#<lazy-body>"
+
 class CombinedAstAndIndex(AST):
     _immutable_fields_ = ["ast", "index"]
 
@@ -1931,7 +2229,7 @@ def make_let_singlevar(sym, rhs, body):
                 body  = b.body
                 return make_let(varss, rhss, body)
     body = remove_pure_ops(body)
-    return Let(SymList([sym]), [1], [rhs], body)
+    return Let.make(SymList([sym]), [1], [rhs], body)
 
 def _make_let_direct(varss, rhss, body):
     symlist, counts = _make_symlist_counts(varss)
@@ -1939,7 +2237,7 @@ def _make_let_direct(varss, rhss, body):
         b = body[0]
         if isinstance(b, Begin):
             body = b.body
-    return Let(symlist, counts, rhss, body)
+    return Let.make(symlist, counts, rhss, body)
 
 def make_letrec(varss, rhss, body):
     if not varss:
@@ -1980,6 +2278,13 @@ class Let(SequencedBodyAST):
             remove_num_envs = [0] * (len(rhss) + 1)
         self.remove_num_envs = remove_num_envs
 
+    @staticmethod
+    def make(args, counts, rhss, body, remove_num_envs=None):
+        if (config.superinstructions and len(rhss) == 1 and counts[0] == 1 and
+                is_simple_prim_app(rhss[0])):
+            return SimplePrimLet(args, counts, rhss, body, remove_num_envs)
+        return Let(args, counts, rhss, body, remove_num_envs)
+
     @jit.unroll_safe
     def _prune_env(self, env, i):
         env_structure = self.args.prev
@@ -1999,9 +2304,30 @@ class Let(SequencedBodyAST):
     @objectmodel.always_inline
     def interpret(self, env, cont):
         env = self._prune_env(env, 0)
+        if (config.stack_continuations and not jit.we_are_jitted() and
+                len(self.rhss) == 1 and isinstance(self.rhss[0], App)):
+            frame = native_stack.enter(self, env, cont)
+            if frame is not None:
+                vals = native_stack.run(frame, self.rhss[0], env)
+                return self.make_begin_cont(self._bind_values(vals, env), cont)
         return self.rhss[0], env, LetCont.make(
                 None, self, 0, env, cont)
 
+    @jit.unroll_safe
+    def _bind_values(self, vals, env):
+        """ The environment of the body, given the values of the only
+        right-hand side, like LetCont.plug_reduce """
+        len_vals = vals.num_values()
+        if self.counts[0] != len_vals:
+            raise SchemeException("wrong number of values")
+        prev = self._prune_env(env, 1)
+        if len_vals == 1:
+            return ConsEnv.make1(self.wrap_value(vals.get_value(0), 0), prev)
+        new_env = ConsEnv.make_n(len_vals, prev)
+        for i in range(len_vals):
+            new_env._set_list(i, self.wrap_value(vals.get_value(i), i))
+        return new_env
+
     def direct_children(self):
         return self.rhss + self.body
 
@@ -2062,6 +2388,27 @@ class Let(SequencedBodyAST):
         result.append(")")
         return "".join(result)
 
+def is_simple_prim_app(ast):
+    return (isinstance(ast, SimplePrimApp1) or isinstance(ast, SimplePrimApp2) or
+            isinstance(ast, SimplePrimApp3))
+
+class SimplePrimLet(Let):
+    """ A let binding one variable to a simple primitive application, which
+    is evaluated directly instead of through a LetCont """
+    visitable = False
+
+    @objectmodel.always_inline
+    def interpret(self, env, cont):
+        from pycket.prims.control import convert_runtime_exception
+        env = self._prune_env(env, 0)
+        try:
+            w_val = self.rhss[0].interpret_simple(env)
+        except SchemeException, exn:
+            return convert_runtime_exception(exn, env, cont)
+        prev = self._prune_env(env, 1)
+        return self.make_begin_cont(
+            ConsEnv.make1(self.wrap_value(w_val, 0), prev), cont)
+
 class DefineValues(AST):
     _immutable_fields_ = ["names", "rhs", "display_names"]
     visitable = True
@@ -2123,6 +2470,8 @@ def inner_interpret_two_state(ast, env, cont):
             ast, env, cont = ast.interpret(env, cont)
         else:
             ast, env, cont = ast.interpret(env, cont)
+        if profiler.active:
+            profile_poll(ast, cont)
         if ast.should_enter:
             driver_two_state.can_enter_jit(ast=ast, came_from=came_from, env=env, cont=cont)
 
@@ -2141,6 +2490,8 @@ def inner_interpret_one_state(ast, env, cont):
     while True:
         driver_one_state.jit_merge_point(ast=ast, env=env, cont=cont)
         ast, env, cont = ast.interpret(env, cont)
+        if profiler.active:
+            profile_poll(ast, cont)
         if ast.should_enter:
             driver_one_state.can_enter_jit(ast=ast, env=env, cont=cont)
 
@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# JIT statistics per Racket loop.
+#
+# The JIT calls the hooks below whenever it compiles a loop or a bridge or
+# aborts a trace. Loops and aborts come with the green key they started at,
+# and are counted under its printable location (see
+# get_printable_location_two_state). A bridge belongs to the loop it was
+# attached to. Guard failures are read from the counters the backend keeps
+# for every bridge once --jit-stats enables debugging, so they count the
+# failures that entered a bridge.
+#
+# Compilations and aborts are rare, so they are always recorded. The
+# statistics are reported at exit with --jit-stats, together with the hits
+# and misses of the inline caches of the interpreter, and returned by the
+# pycket-jit-stats primitive.
+
+import os
+
+from rpython.rlib              import jit_hooks
+from rpython.rlib.jit          import Counters, JitHookInterface
+from rpython.rlib.listsort     import make_timsort_class
+from rpython.rlib.objectmodel  import compute_unique_id, we_are_translated
+from pycket                    import inline_cache
+
+class LocationStats(object):
+    def __init__(self, location):
+        self.location = location
+        self.loops = 0
+        self.bridges = 0
+        self.aborts = 0
+        self.guard_failures = 0
+
+BaseLocationSorter = make_timsort_class()
+
+class LocationSorter(BaseLocationSorter):
+    def lt(self, a, b):
+        # the loops that fail and bridge the most first
+        if a.guard_failures != b.guard_failures:
+            return a.guard_failures > b.guard_failures
+        if a.bridges != b.bridges:
+            return a.bridges > b.bridges
+        return a.aborts > b.aborts
+
+class JitStats(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.locations = {}
+        # unique id of a loop token or fail descr -> its loop's location
+        self.loop_locations = {}
+        self.bridge_locations = {}
+        self.abort_reasons = {}
+
+    def enable(self):
+        self.enabled = True
+        if we_are_translated():
+            # count how often every bridge is entered
+            jit_hooks.stats_set_debug(None, True)
+
+    def location(self, location):
+        stats = self.locations.get(location, None)
+        if stats is None:
+            stats = self.locations[location] = LocationStats(location)
+        return stats
+
+    def record_loop(self, loop_id, location):
+        self.loop_locations[loop_id] = location
+        self.location(location).loops += 1
+
+    def record_bridge(self, loop_id, descr_id):
+        location = self.loop_locations.get(loop_id, "<unknown loop>")
+        self.bridge_locations[descr_id] = location
+        self.location(location).bridges += 1
+
+    def record_abort(self, location, reason):
+        self.location(location).aborts += 1
+        self.abort_reasons[reason] = self.abort_reasons.get(reason, 0) + 1
+
+    def record_guard_failures(self, descr_id, count):
+        location = self.bridge_locations.get(descr_id, None)
+        if location is not None:
+            self.location(location).guard_failures += count
+
+    def collect_guard_failures(self):
+        if not we_are_translated():
+            return
+        for stats in self.locations.values():
+            stats.guard_failures = 0
+        counters = jit_hooks.stats_get_loop_run_times(None)
+        for i in range(len(counters)):
+            entry = counters[i]
+            if entry.type == 'b':
+                self.record_guard_failures(entry.number, entry.counter)
+
+    def entries(self):
+        """ The statistics of every location, most troublesome first """
+        self.collect_guard_failures()
+        result = self.locations.values()
+        LocationSorter(result).sort()
+        return result
+
+    def format_table(self):
+        entries = self.entries()
+        total = LocationStats("total")
+        for entry in entries:
+            total.loops += entry.loops
+            total.bridges += entry.bridges
+            total.aborts += entry.aborts
+            total.guard_failures += entry.guard_failures
+        lines = ["JIT statistics", "",
+                 _row("loops", "bridges", "aborts", "guard fails", "location"),
+                 _entry_row(total)]
+        for entry in entries:
+            lines.append(_entry_row(entry))
+        lines.append("")
+        lines.append("inline caches: %d hits, %d misses" %
+                     (inline_cache.stats.hits, inline_cache.stats.misses))
+        if self.abort_reasons:
+            lines.append("")
+            lines.append("aborts by reason:")
+            for reason, count in self.abort_reasons.items():
+                lines.append("%s %s" % (_pad_left(str(count), 8), _abort_reason(reason)))
+        lines.append("")
+        return "\n".join(lines)
+
+    def report(self):
+        os.write(2, self.format_table())
+
+def _pad_left(s, width):
+    return " " * max(width - len(s), 0) + s
+
+def _row(loops, bridges, aborts, guard_failures, location):
+    return "%s %s %s %s  %s" % (_pad_left(loops, 6), _pad_left(bridges, 8),
+                                _pad_left(aborts, 7), _pad_left(guard_failures, 12),
+                                location)
+
+def _entry_row(entry):
+    return _row(str(entry.loops), str(entry.bridges), str(entry.aborts),
+                str(entry.guard_failures), entry.location)
+
+def _abort_reason(reason):
+    if 0 <= reason < len(Counters.counter_names):
+        return Counters.counter_names[reason].lower()
+    return "reason %d" % reason
+
+stats = JitStats()
+
+class PycketJitHooks(JitHookInterface):
+
+    def on_abort(self, reason, jitdriver, greenkey, greenkey_repr, logops, operations):
+        stats.record_abort(greenkey_repr, reason)
+
+    def after_compile(self, debug_info):
+        stats.record_loop(compute_unique_id(debug_info.looptoken),
+                          debug_info.get_greenkey_repr())
+
+    def after_compile_bridge(self, debug_info):
+        stats.record_bridge(compute_unique_id(debug_info.looptoken),
+                            compute_unique_id(debug_info.fail_descr))
+
+pycket_hooks = PycketJitHooks()
+
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy(pycket_hooks)
+
+def configure(config):
+    if config.get('jit-stats', False):
+        stats.enable()
+
+def report(config, env):
+    if stats.enabled:
+        stats.report()
@@ -0,0 +1,194 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Closure conversion of local functions that do not escape.
+#
+# A named let or an internal define becomes a let binding a lambda, whose
+# closure is allocated every time the let is entered, because the lambda
+# refers to variables of the enclosing function:
+#
+#   (define (sum n)
+#     (let loop ([i 0] [acc 0])
+#       (if (< i n) (loop (+ i 1) (+ acc i)) acc)))
+#
+# When the bound variable is only ever called, the free variables of the
+# lambda are passed as extra arguments instead, at every call site:
+#
+#   (define (sum n)
+#     (let ([loop (lambda (n i acc)
+#                   (if (< i n) (loop n (+ i 1) (+ acc i)) acc))])
+#       (loop n 0 0)))
+#
+# The lambda no longer has free variables, so CaseLambda.interpret_simple
+# returns the same cached closure every time. The pass runs on normalized
+# code before assignment conversion. Free variables that are mutated anywhere
+# in the module are not copied, and neither the function nor its free
+# variables may be rebound below the let, so that every call site refers to
+# the same variables as the lambda.
+
+from pycket.ast_visitor import ASTVisitor
+from pycket.interpreter import (
+    App,
+    CaseLambda,
+    Lambda,
+    LazyBody,
+    Let,
+    Letrec,
+    LexicalVar,
+    SetBang,
+    VariableReference,
+    make_lambda,
+    make_let,
+)
+
+# functions with more free variables keep their closure
+MAX_EXTRA_ARGS = 8
+
+class NotLiftable(Exception):
+    pass
+
+def collect_set_targets(ast, targets):
+    """ The symbols of all lexical variables that are set! in ast """
+    if isinstance(ast, SetBang):
+        var = ast.var
+        if isinstance(var, LexicalVar):
+            targets[var.sym] = None
+    for child in ast.direct_children():
+        collect_set_targets(child, targets)
+
+def binders(ast):
+    """ The symbols bound by ast itself """
+    if isinstance(ast, Lambda) or isinstance(ast, Let) or isinstance(ast, Letrec):
+        return ast.args.elems
+    if isinstance(ast, CaseLambda) and ast.recursive_sym is not None:
+        return [ast.recursive_sym]
+    return []
+
+class CallSiteChecker(object):
+    """ Checks that the function bound to sym is only called, with a number
+    of arguments it accepts, and that neither sym nor any of the extra
+    variables are rebound """
+
+    def __init__(self, sym, caselam, extra):
+        self.sym = sym
+        self.caselam = caselam
+        self.extra = {}
+        for v in extra:
+            self.extra[v] = None
+
+    def check(self, ast):
+        if isinstance(ast, LexicalVar):
+            if ast.sym is self.sym:
+                # escapes
+                raise NotLiftable
+            return
+        if isinstance(ast, LazyBody):
+            # references unknown
+            raise NotLiftable
+        if isinstance(ast, VariableReference):
+            var = ast.var
+            if isinstance(var, LexicalVar) and var.sym is self.sym:
+                raise NotLiftable
+            return
+        if isinstance(ast, App):
+            rator = ast.rator
+            if isinstance(rator, LexicalVar) and rator.sym is self.sym:
+                if self.caselam.find_lam_index(len(ast.rands)) < 0:
+                    # keep the arity error of the original function
+                    raise NotLiftable
+                for rand in ast.rands:
+                    self.check(rand)
+                return
+        for sym in binders(ast):
+            if sym is self.sym or sym in self.extra:
+                raise NotLiftable
+        for child in ast.direct_children():
+            self.check(child)
+
+class CallSiteRewriter(ASTVisitor):
+    """ Passes the extra variables to every call of the function bound to
+    sym """
+
+    def __init__(self, sym, extra):
+        self.sym = sym
+        self.extra = extra
+
+    def visit_app(self, ast):
+        assert isinstance(ast, App)
+        rator = ast.rator.visit(self)
+        rands = [r.visit(self) for r in ast.rands]
+        if isinstance(rator, LexicalVar) and rator.sym is self.sym:
+            rands = [LexicalVar(v) for v in self.extra] + rands
+        return App.make(rator, rands, ast.env_structure)
+
+    def visit_lazy_body(self, ast):
+        # ruled out by CallSiteChecker
+        assert False
+
+class LambdaLifter(ASTVisitor):
+    """ Closure converts the let-bound lambdas that are only called """
+
+    def __init__(self, mutated):
+        self.mutated = mutated
+
+    def visit_let(self, ast):
+        assert isinstance(ast, Let)
+        rhss = [r.visit(self) for r in ast.rhss]
+        body = [b.visit(self) for b in ast.body]
+        varss = ast._rebuild_args()
+        for i, rhs in enumerate(rhss):
+            vars = varss[i]
+            if len(vars) != 1 or not isinstance(rhs, CaseLambda):
+                continue
+            sym = vars[0]
+            extra = self.extra_args(sym, rhs, ast.args.elems)
+            if extra is None:
+                continue
+            try:
+                checker = CallSiteChecker(sym, rhs, extra)
+                for lam in rhs.lams:
+                    for b in lam.body:
+                        checker.check(b)
+                for b in body:
+                    checker.check(b)
+            except NotLiftable:
+                continue
+            rewriter = CallSiteRewriter(sym, extra)
+            rhss[i] = self.lift(rhs, extra, rewriter)
+            body = [b.visit(rewriter) for b in body]
+        return make_let(varss, rhss, body)
+
+    def extra_args(self, sym, caselam, let_vars):
+        """ The free variables of caselam to pass as arguments, or None if it
+        cannot be converted """
+        if sym in self.mutated:
+            return None
+        if caselam.recursive_sym is not None and caselam.recursive_sym is not sym:
+            return None
+        extra = caselam.free_vars().keys()
+        if not extra or len(extra) > MAX_EXTRA_ARGS:
+            return None
+        for v in extra:
+            if v is sym or v in self.mutated:
+                return None
+            # a variable of the let itself would be a different one at the
+            # call sites in the body
+            for w in let_vars:
+                if v is w:
+                    return None
+        return extra
+
+    def lift(self, caselam, extra, rewriter):
+        lams = [None] * len(caselam.lams)
+        for i, lam in enumerate(caselam.lams):
+            body = [b.visit(rewriter) for b in lam.body]
+            lams[i] = make_lambda(extra + lam.formals, lam.rest, body,
+                                  sourceinfo=lam.sourceinfo)
+        return CaseLambda(lams, recursive_sym=caselam.recursive_sym)
+
+def lambda_lift(ast):
+    """ Closure converts the local functions of ast that do not escape,
+    returns the new AST """
+    mutated = {}
+    collect_set_targets(ast, mutated)
+    return ast.visit(LambdaLifter(mutated))
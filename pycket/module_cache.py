@@ -0,0 +1,901 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A cache of loaded modules.
+#
+# Loading a module from the expansion cache still has to convert the expander
+# output to an AST, normalize it and run assignment conversion, which together
+# compute the environment structures, the environment pruning information and
+# the mutable variable flags. This module stores the result of those passes, so
+# that a module which is already cached can be loaded without re-running them:
+#
+#   header()                           magic bytes followed by the format version
+#                                      and the AST passes enabled, see OPTION_*
+#   varint n, n x (varint, bytes)      the string table
+#   varint n, n x (byte, string)       the symbol table, see SYMBOL_*
+#   varint n, n x (symbols, varint)    the environment structures (SymList): the
+#                                      symbol indices of the frame and the index
+#                                      of the previous frame plus one, or zero
+#   node                               the module
+#
+# Nodes and quoted values are a one byte tag followed by their fields. Symbols
+# and environment structures are written once and referenced by index, which
+# preserves the sharing the interpreter relies on: lexical variables and
+# environment structures are compared by identity, and gensyms created during
+# normalization are not interned.
+#
+# Modules that contain something this format cannot express (such as lazily
+# converted lambda bodies or prefab structs in quoted data) raise
+# ModuleCacheError when written and are simply not cached.
+
+from rpython.rlib.rarithmetic import r_uint
+from rpython.rlib.rbigint     import rbigint
+from rpython.rlib.rfloat      import formatd, string_to_float
+from rpython.rlib.rstring     import ParseStringError, StringBuilder
+from rpython.rlib             import streamio
+from pycket                   import binary_ast, values, values_string, values_regex, vector
+from pycket.binary_ast        import BinaryFormatError, write_varint, zigzag_encode, zigzag_decode
+from pycket.env               import SymList
+from pycket.hash.equal        import (
+    W_EqualHashTable, W_EqualImmutableHashTable, make_immutable_equal_table)
+from pycket.interpreter       import (
+    App,
+    Begin,
+    Begin0,
+    BeginForSyntax,
+    CaseLambda,
+    Cell,
+    CellRef,
+    DefineValues,
+    If,
+    Lambda,
+    Let,
+    Letrec,
+    LexicalVar,
+    Module,
+    ModuleVar,
+    Quote,
+    QuoteSyntax,
+    Require,
+    SequencedBodyAST,
+    SetBang,
+    ToplevelVar,
+    Var,
+    VariableReference,
+    WithContinuationMark,
+)
+
+# Bump this whenever the AST classes or the passes run by finalize_module
+# change, to invalidate existing cached modules
+FORMAT_VERSION = 3
+
+MAGIC  = "\x00PYCKET-MODULE"
+
+# The passes of finalize_module that can be turned off change the cached AST,
+# so a module cached by a build with different options must not be loaded
+OPTION_SUPERINSTRUCTIONS = 1
+OPTION_CONSTANT_FOLDING  = 2
+OPTION_LAMBDA_LIFTING    = 4
+OPTION_PRUNE_ENV         = 8
+
+def header():
+    from pycket import config
+    options = 0
+    if config.superinstructions:
+        options |= OPTION_SUPERINSTRUCTIONS
+    if config.constant_folding:
+        options |= OPTION_CONSTANT_FOLDING
+    if config.lambda_lifting:
+        options |= OPTION_LAMBDA_LIFTING
+    if config.prune_env:
+        options |= OPTION_PRUNE_ENV
+    return MAGIC + chr(FORMAT_VERSION) + chr(options)
+
+SYMBOL_INTERNED   = 0
+SYMBOL_UNREADABLE = 1
+SYMBOL_UNINTERNED = 2
+
+NODE_MODULE              = 0
+NODE_REQUIRE             = 1
+NODE_QUOTE               = 2
+NODE_QUOTE_SYNTAX        = 3
+NODE_VARIABLE_REFERENCE  = 4
+NODE_WCM                 = 5
+NODE_APP                 = 6
+NODE_BEGIN               = 7
+NODE_BEGIN0              = 8
+NODE_BEGIN_FOR_SYNTAX    = 9
+NODE_CELL                = 10
+NODE_CELL_REF            = 11
+NODE_LEXICAL_VAR         = 12
+NODE_MODULE_VAR          = 13
+NODE_TOPLEVEL_VAR        = 14
+NODE_SET_BANG            = 15
+NODE_IF                  = 16
+NODE_CASE_LAMBDA         = 17
+NODE_LAMBDA              = 18
+NODE_LETREC              = 19
+NODE_LET                 = 20
+NODE_DEFINE_VALUES       = 21
+
+VALUE_FALSE        = 0
+VALUE_TRUE         = 1
+VALUE_VOID         = 2
+VALUE_NULL         = 3
+VALUE_FIXNUM       = 4
+VALUE_FLONUM       = 5
+VALUE_BIGNUM       = 6
+VALUE_RATIONAL     = 7
+VALUE_COMPLEX      = 8
+VALUE_SYMBOL       = 9
+VALUE_STRING       = 10
+VALUE_KEYWORD      = 11
+VALUE_CHAR         = 12
+VALUE_LIST         = 13
+VALUE_VECTOR       = 14
+VALUE_BOX          = 15
+VALUE_PATH         = 16
+VALUE_BYTES        = 17
+VALUE_REGEXP       = 18
+VALUE_PREGEXP      = 19
+VALUE_BYTE_REGEXP  = 20
+VALUE_BYTE_PREGEXP = 21
+VALUE_HASH         = 22
+
+class ModuleCacheError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+def is_module_cache(data):
+    return data.startswith(MAGIC)
+
+#### ========================== Encoding
+
+class ModuleEncoder(binary_ast.BinaryEncoder):
+
+    def __init__(self):
+        binary_ast.BinaryEncoder.__init__(self)
+        self.symbols = []
+        self.symbol_index = {}
+        self.envs = []
+        self.env_index = {}
+
+    def write_byte(self, b):
+        self.body.append(chr(b))
+
+    def write_int(self, n):
+        write_varint(self.body, zigzag_encode(n))
+
+    def write_length(self, n):
+        write_varint(self.body, r_uint(n))
+
+    def write_bool(self, b):
+        self.write_byte(1 if b else 0)
+
+    def write_string(self, s):
+        self.write_length(self.intern(s))
+
+    def write_optional_string(self, s):
+        if s is None:
+            self.write_length(0)
+        else:
+            self.write_length(self.intern(s) + 1)
+
+    def write_optional_strings(self, strs):
+        if strs is None:
+            self.write_length(0)
+            return
+        self.write_length(len(strs) + 1)
+        for s in strs:
+            self.write_string(s)
+
+    def write_ints(self, ints):
+        self.write_length(len(ints))
+        for n in ints:
+            self.write_int(n)
+
+    def write_optional_ints(self, ints):
+        if ints is None:
+            self.write_length(0)
+            return
+        self.write_length(len(ints) + 1)
+        for n in ints:
+            self.write_int(n)
+
+    def write_optional_bools(self, bools):
+        if bools is None:
+            self.write_length(0)
+            return
+        self.write_length(len(bools) + 1)
+        for b in bools:
+            self.write_bool(b)
+
+    def intern_symbol(self, w_sym):
+        index = self.symbol_index.get(w_sym, -1)
+        if index < 0:
+            index = len(self.symbols)
+            self.symbols.append(w_sym)
+            self.symbol_index[w_sym] = index
+        return index
+
+    def write_symbol(self, w_sym):
+        self.write_length(self.intern_symbol(w_sym))
+
+    def write_optional_symbol(self, w_sym):
+        if w_sym is None:
+            self.write_length(0)
+        else:
+            self.write_length(self.intern_symbol(w_sym) + 1)
+
+    def write_symbols(self, syms):
+        self.write_length(len(syms))
+        for w_sym in syms:
+            self.write_symbol(w_sym)
+
+    def intern_env(self, env_structure):
+        index = self.env_index.get(env_structure, -1)
+        if index < 0:
+            # the previous frames are always written first
+            if env_structure.prev is not None:
+                self.intern_env(env_structure.prev)
+            for w_sym in env_structure.elems:
+                self.intern_symbol(w_sym)
+            index = len(self.envs)
+            self.envs.append(env_structure)
+            self.env_index[env_structure] = index
+        return index
+
+    def write_env(self, env_structure):
+        self.write_length(self.intern_env(env_structure))
+
+    def write_optional_env(self, env_structure):
+        if env_structure is None:
+            self.write_length(0)
+        else:
+            self.write_length(self.intern_env(env_structure) + 1)
+
+    def write_optional_node(self, ast):
+        if ast is None:
+            self.write_bool(False)
+        else:
+            self.write_bool(True)
+            self.write_node(ast)
+
+    def write_nodes(self, asts):
+        self.write_length(len(asts))
+        for ast in asts:
+            self.write_node(ast)
+
+    def write_pruning(self, ast):
+        assert isinstance(ast, SequencedBodyAST)
+        self.write_optional_env(ast._sequenced_env_structure)
+        self.write_optional_ints(ast._sequenced_remove_num_envs)
+
+    def write_lambda(self, lam):
+        self.write_byte(NODE_LAMBDA)
+        self.write_symbols(lam.formals)
+        self.write_optional_symbol(lam.rest)
+        self.write_env(lam.args)
+        self.write_env(lam.frees)
+        self.write_nodes(lam.body)
+        sourceinfo = lam.sourceinfo
+        if sourceinfo is None:
+            self.write_bool(False)
+        else:
+            self.write_bool(True)
+            self.write_int(sourceinfo.position)
+            self.write_int(sourceinfo.line)
+            self.write_int(sourceinfo.column)
+            self.write_int(sourceinfo.span)
+            self.write_optional_string(sourceinfo.sourcefile)
+        self.write_optional_env(lam.enclosing_env_structure)
+        self.write_optional_env(lam.env_structure)
+        self.write_pruning(lam)
+        self.write_optional_bools(lam._mutable_var_flags)
+
+    def write_node(self, ast):
+        if isinstance(ast, Module):
+            self.write_byte(NODE_MODULE)
+            self.write_string(ast.name)
+            self.write_length(len(ast.config))
+            for key, value in ast.config.iteritems():
+                self.write_string(key)
+                self.write_string(value)
+            self.write_optional_node(ast.lang)
+            self.write_nodes(ast.requires)
+            self.write_nodes(ast.body)
+        elif isinstance(ast, Require):
+            self.write_byte(NODE_REQUIRE)
+            self.write_string(ast.fname)
+            self.write_bool(ast.loader is not None)
+            self.write_optional_strings(ast.path)
+        elif isinstance(ast, Quote):
+            self.write_byte(NODE_QUOTE)
+            self.write_value(ast.w_val)
+        elif isinstance(ast, QuoteSyntax):
+            self.write_byte(NODE_QUOTE_SYNTAX)
+            self.write_value(ast.w_val)
+        elif isinstance(ast, VariableReference):
+            self.write_byte(NODE_VARIABLE_REFERENCE)
+            self.write_optional_node(ast.var)
+            self.write_optional_string(ast.path)
+            self.write_bool(ast.is_mut)
+        elif isinstance(ast, WithContinuationMark):
+            self.write_byte(NODE_WCM)
+            self.write_node(ast.key)
+            self.write_node(ast.value)
+            self.write_node(ast.body)
+        elif isinstance(ast, App):
+            self.write_byte(NODE_APP)
+            self.write_node(ast.rator)
+            self.write_nodes(ast.rands)
+            self.write_optional_env(ast.env_structure)
+        elif isinstance(ast, Begin):
+            self.write_byte(NODE_BEGIN)
+            self.write_nodes(ast.body)
+            self.write_pruning(ast)
+        elif isinstance(ast, Begin0):
+            self.write_byte(NODE_BEGIN0)
+            self.write_node(ast.first)
+            self.write_nodes(ast.body)
+            self.write_pruning(ast)
+        elif isinstance(ast, BeginForSyntax):
+            self.write_byte(NODE_BEGIN_FOR_SYNTAX)
+            self.write_nodes(ast.body)
+        elif isinstance(ast, Cell):
+            self.write_byte(NODE_CELL)
+            self.write_node(ast.expr)
+            self.write_optional_bools(ast.need_cell_flags)
+        elif isinstance(ast, CellRef):
+            self.write_byte(NODE_CELL_REF)
+            self.write_symbol(ast.sym)
+            self.write_optional_env(ast.env_structure)
+        elif isinstance(ast, LexicalVar):
+            self.write_byte(NODE_LEXICAL_VAR)
+            self.write_symbol(ast.sym)
+            self.write_optional_env(ast.env_structure)
+        elif isinstance(ast, ModuleVar):
+            self.write_byte(NODE_MODULE_VAR)
+            self.write_symbol(ast.sym)
+            self.write_optional_string(ast.srcmod)
+            self.write_symbol(ast.srcsym)
+            self.write_optional_strings(ast.path)
+        elif isinstance(ast, ToplevelVar):
+            self.write_byte(NODE_TOPLEVEL_VAR)
+            self.write_symbol(ast.sym)
+            self.write_optional_env(ast.env_structure)
+        elif isinstance(ast, SetBang):
+            self.write_byte(NODE_SET_BANG)
+            self.write_node(ast.var)
+            self.write_node(ast.rhs)
+        elif isinstance(ast, If):
+            self.write_byte(NODE_IF)
+            self.write_node(ast.tst)
+            self.write_node(ast.thn)
+            self.write_node(ast.els)
+        elif isinstance(ast, CaseLambda):
+            self.write_byte(NODE_CASE_LAMBDA)
+            self.write_length(len(ast.lams))
+            for lam in ast.lams:
+                self.write_lambda(lam)
+            self.write_optional_symbol(ast.recursive_sym)
+        elif isinstance(ast, Lambda):
+            self.write_lambda(ast)
+        elif isinstance(ast, Letrec):
+            self.write_byte(NODE_LETREC)
+            self.write_env(ast.args)
+            self.write_ints(ast.counts)
+            self.write_nodes(ast.rhss)
+            self.write_nodes(ast.body)
+            self.write_pruning(ast)
+        elif isinstance(ast, Let):
+            self.write_byte(NODE_LET)
+            self.write_env(ast.args)
+            self.write_ints(ast.counts)
+            self.write_nodes(ast.rhss)
+            self.write_nodes(ast.body)
+            self.write_ints(ast.remove_num_envs)
+            self.write_pruning(ast)
+            self.write_optional_bools(ast._mutable_var_flags)
+        elif isinstance(ast, DefineValues):
+            self.write_byte(NODE_DEFINE_VALUES)
+            self.write_symbols(ast.names)
+            self.write_node(ast.rhs)
+            self.write_symbols(ast.display_names)
+        else:
+            raise ModuleCacheError("cannot cache %s" % ast.tostring())
+
+    def write_value(self, w_val):
+        if w_val is values.w_false:
+            self.write_byte(VALUE_FALSE)
+        elif w_val is values.w_true:
+            self.write_byte(VALUE_TRUE)
+        elif w_val is values.w_void:
+            self.write_byte(VALUE_VOID)
+        elif w_val is values.w_null:
+            self.write_byte(VALUE_NULL)
+        elif isinstance(w_val, values.W_Fixnum):
+            self.write_byte(VALUE_FIXNUM)
+            self.write_int(w_val.value)
+        elif isinstance(w_val, values.W_Flonum):
+            self.write_byte(VALUE_FLONUM)
+            self.write_string(formatd(w_val.value, 'r', 0))
+        elif isinstance(w_val, values.W_Bignum):
+            self.write_byte(VALUE_BIGNUM)
+            self.write_string(w_val.value.str())
+        elif isinstance(w_val, values.W_Rational):
+            self.write_byte(VALUE_RATIONAL)
+            self.write_string(w_val._numerator.str())
+            self.write_string(w_val._denominator.str())
+        elif isinstance(w_val, values.W_Complex):
+            self.write_byte(VALUE_COMPLEX)
+            self.write_value(w_val.real)
+            self.write_value(w_val.imag)
+        elif isinstance(w_val, values.W_Symbol):
+            self.write_byte(VALUE_SYMBOL)
+            self.write_symbol(w_val)
+        elif isinstance(w_val, values_string.W_String):
+            self.write_byte(VALUE_STRING)
+            self.write_string(w_val.as_str_utf8())
+        elif isinstance(w_val, values.W_Keyword):
+            self.write_byte(VALUE_KEYWORD)
+            self.write_string(w_val.value)
+        elif isinstance(w_val, values.W_Character):
+            self.write_byte(VALUE_CHAR)
+            self.write_length(ord(w_val.value))
+        elif isinstance(w_val, values.W_Cons):
+            # lists are written iteratively, they can be long
+            elems = []
+            while isinstance(w_val, values.W_Cons):
+                elems.append(w_val.car())
+                w_val = w_val.cdr()
+            self.write_byte(VALUE_LIST)
+            self.write_length(len(elems))
+            for w_elem in elems:
+                self.write_value(w_elem)
+            self.write_value(w_val)
+        elif isinstance(w_val, vector.W_Vector) and w_val.immutable():
+            self.write_byte(VALUE_VECTOR)
+            self.write_length(w_val.length())
+            for i in range(w_val.length()):
+                self.write_value(w_val.ref(i))
+        elif isinstance(w_val, values.W_IBox):
+            self.write_byte(VALUE_BOX)
+            self.write_value(w_val.value)
+        elif isinstance(w_val, values.W_Path):
+            self.write_byte(VALUE_PATH)
+            self.write_string(w_val.path)
+        elif isinstance(w_val, values.W_ImmutableBytes):
+            self.write_byte(VALUE_BYTES)
+            self.write_string("".join(w_val.value))
+        elif isinstance(w_val, values_regex.W_AnyRegexp):
+            if isinstance(w_val, values_regex.W_BytePRegexp):
+                self.write_byte(VALUE_BYTE_PREGEXP)
+            elif isinstance(w_val, values_regex.W_ByteRegexp):
+                self.write_byte(VALUE_BYTE_REGEXP)
+            elif isinstance(w_val, values_regex.W_PRegexp):
+                self.write_byte(VALUE_PREGEXP)
+            elif isinstance(w_val, values_regex.W_Regexp):
+                self.write_byte(VALUE_REGEXP)
+            else:
+                raise ModuleCacheError("cannot cache %s" % w_val.tostring())
+            self.write_string(w_val.source)
+        elif ((isinstance(w_val, W_EqualHashTable) and w_val.is_immutable) or
+              isinstance(w_val, W_EqualImmutableHashTable)):
+            items = w_val.hash_items()
+            self.write_byte(VALUE_HASH)
+            self.write_length(len(items))
+            for w_key, w_value in items:
+                self.write_value(w_key)
+                self.write_value(w_value)
+        else:
+            raise ModuleCacheError("cannot cache %s" % w_val.tostring())
+
+    def build(self):
+        result = StringBuilder()
+        result.append(header())
+        write_varint(result, r_uint(len(self.strings)))
+        for s in self.strings:
+            write_varint(result, r_uint(len(s)))
+            result.append(s)
+        write_varint(result, r_uint(len(self.symbols)))
+        for w_sym in self.symbols:
+            if not w_sym.is_interned():
+                kind = SYMBOL_UNINTERNED
+            elif w_sym.unreadable:
+                kind = SYMBOL_UNREADABLE
+            else:
+                kind = SYMBOL_INTERNED
+            result.append(chr(kind))
+            write_varint(result, r_uint(len(w_sym.utf8value)))
+            result.append(w_sym.utf8value)
+        write_varint(result, r_uint(len(self.envs)))
+        for env_structure in self.envs:
+            write_varint(result, r_uint(len(env_structure.elems)))
+            for w_sym in env_structure.elems:
+                write_varint(result, r_uint(self.symbol_index[w_sym]))
+            if env_structure.prev is None:
+                write_varint(result, r_uint(0))
+            else:
+                write_varint(result, r_uint(self.env_index[env_structure.prev] + 1))
+        result.append(self.body.build())
+        return result.build()
+
+def dumps(module):
+    """ Encode a module that went through finalize_module. Raises
+    ModuleCacheError if the module cannot be cached. """
+    assert isinstance(module, Module)
+    encoder = ModuleEncoder()
+    encoder.write_node(module)
+    return encoder.build()
+
+#### ========================== Decoding
+
+class ModuleDecoder(binary_ast.BinaryDecoder):
+
+    def __init__(self, data, loader):
+        binary_ast.BinaryDecoder.__init__(self, data)
+        self.loader = loader
+        self.symbols = []
+        self.envs = []
+
+    def read_int(self):
+        return zigzag_decode(self.read_varint())
+
+    def read_bool(self):
+        return self.read_byte() != 0
+
+    def read_index(self, n):
+        index = self.read_length()
+        if index >= n:
+            raise BinaryFormatError("index out of range in cached module")
+        return index
+
+    def read_str(self):
+        return self.strings[self.read_string()]
+
+    def read_optional_str(self):
+        index = self.read_index(len(self.strings) + 1)
+        if index == 0:
+            return None
+        return self.strings[index - 1]
+
+    def read_optional_strs(self):
+        n = self.read_length()
+        if n == 0:
+            return None
+        return [self.read_str() for i in range(n - 1)]
+
+    def read_ints(self):
+        return [self.read_int() for i in range(self.read_length())]
+
+    def read_optional_ints(self):
+        n = self.read_length()
+        if n == 0:
+            return None
+        return [self.read_int() for i in range(n - 1)]
+
+    def read_optional_bools(self):
+        n = self.read_length()
+        if n == 0:
+            return None
+        return [self.read_bool() for i in range(n - 1)]
+
+    def read_symbol_table(self):
+        n = self.read_length()
+        symbols = [None] * n
+        for i in range(n):
+            kind = self.read_byte()
+            name = self.read_bytes()
+            if kind == SYMBOL_INTERNED:
+                symbols[i] = values.W_Symbol.make(name)
+            elif kind == SYMBOL_UNREADABLE:
+                symbols[i] = values.W_Symbol.make_unreadable(name)
+            elif kind == SYMBOL_UNINTERNED:
+                symbols[i] = values.W_Symbol(name)
+            else:
+                raise BinaryFormatError("unknown symbol kind %d in cached module" % kind)
+        self.symbols = symbols
+
+    def read_env_table(self):
+        n = self.read_length()
+        envs = [None] * n
+        for i in range(n):
+            elems = [self.read_symbol() for j in range(self.read_length())]
+            # previous frames always come first
+            prev = self.read_index(i + 1)
+            envs[i] = SymList(elems, envs[prev - 1] if prev else None)
+        self.envs = envs
+
+    def read_symbol(self):
+        return self.symbols[self.read_index(len(self.symbols))]
+
+    def read_optional_symbol(self):
+        index = self.read_index(len(self.symbols) + 1)
+        if index == 0:
+            return None
+        return self.symbols[index - 1]
+
+    def read_symbols(self):
+        return [self.read_symbol() for i in range(self.read_length())]
+
+    def read_env(self):
+        return self.envs[self.read_index(len(self.envs))]
+
+    def read_optional_env(self):
+        index = self.read_index(len(self.envs) + 1)
+        if index == 0:
+            return None
+        return self.envs[index - 1]
+
+    def read_optional_node(self):
+        if self.read_bool():
+            return self.read_node()
+        return None
+
+    def read_nodes(self):
+        return [self.read_node() for i in range(self.read_length())]
+
+    def read_body(self):
+        body = self.read_nodes()
+        if not body:
+            raise BinaryFormatError("empty body in cached module")
+        return body
+
+    def read_pruning(self, ast):
+        env_structure = self.read_optional_env()
+        remove_num_envs = self.read_optional_ints()
+        ast.init_body_pruning(env_structure, remove_num_envs)
+
+    def read_lambda(self):
+        if self.read_byte() != NODE_LAMBDA:
+            raise BinaryFormatError("expected a lambda in cached module")
+        return self.read_lambda_fields()
+
+    def read_lambda_fields(self):
+        from pycket.expand import SourceInfo
+        formals = self.read_symbols()
+        rest = self.read_optional_symbol()
+        args = self.read_env()
+        frees = self.read_env()
+        body = self.read_body()
+        sourceinfo = None
+        if self.read_bool():
+            position = self.read_int()
+            line = self.read_int()
+            column = self.read_int()
+            span = self.read_int()
+            sourcefile = self.read_optional_str()
+            sourceinfo = SourceInfo(position, line, column, span, sourcefile)
+        enclosing_env_structure = self.read_optional_env()
+        env_structure = self.read_optional_env()
+        lam = Lambda(formals, rest, args, frees, body, sourceinfo,
+                     enclosing_env_structure, env_structure)
+        self.read_pruning(lam)
+        flags = self.read_optional_bools()
+        if flags is not None:
+            lam.init_mutable_var_flags(flags)
+        return lam
+
+    def read_var(self):
+        var = self.read_node()
+        if not isinstance(var, Var):
+            raise BinaryFormatError("expected a variable in cached module")
+        return var
+
+    def read_node(self):
+        tag = self.read_byte()
+        if tag == NODE_MODULE:
+            name = self.read_str()
+            config = {}
+            for i in range(self.read_length()):
+                key = self.read_str()
+                config[key] = self.read_str()
+            lang = self.read_optional_node()
+            requires = self.read_nodes()
+            body = self.read_nodes()
+            module = Module(name, body, config, lang=lang)
+            # the requires were collected from the original body, keep them
+            # in their original order
+            module.requires = requires
+            return module
+        if tag == NODE_REQUIRE:
+            fname = self.read_str()
+            loader = self.loader if self.read_bool() else None
+            path = self.read_optional_strs()
+            return Require(fname, loader, path=path)
+        if tag == NODE_QUOTE:
+            return Quote(self.read_value())
+        if tag == NODE_QUOTE_SYNTAX:
+            return QuoteSyntax(self.read_value())
+        if tag == NODE_VARIABLE_REFERENCE:
+            var = self.read_optional_node()
+            path = self.read_optional_str()
+            is_mut = self.read_bool()
+            return VariableReference(var, path, is_mut)
+        if tag == NODE_WCM:
+            key = self.read_node()
+            value = self.read_node()
+            body = self.read_node()
+            return WithContinuationMark(key, value, body)
+        if tag == NODE_APP:
+            rator = self.read_node()
+            rands = self.read_nodes()
+            env_structure = self.read_optional_env()
+            return App.make(rator, rands, env_structure)
+        if tag == NODE_BEGIN:
+            ast = Begin(self.read_body())
+            self.read_pruning(ast)
+            return ast
+        if tag == NODE_BEGIN0:
+            first = self.read_node()
+            ast = Begin0(first, self.read_body())
+            self.read_pruning(ast)
+            return ast
+        if tag == NODE_BEGIN_FOR_SYNTAX:
+            return BeginForSyntax(self.read_nodes())
+        if tag == NODE_CELL:
+            expr = self.read_node()
+            return Cell(expr, self.read_optional_bools())
+        if tag == NODE_CELL_REF:
+            sym = self.read_symbol()
+            return CellRef(sym, self.read_optional_env())
+        if tag == NODE_LEXICAL_VAR:
+            sym = self.read_symbol()
+            return LexicalVar(sym, self.read_optional_env())
+        if tag == NODE_MODULE_VAR:
+            sym = self.read_symbol()
+            srcmod = self.read_optional_str()
+            srcsym = self.read_symbol()
+            path = self.read_optional_strs()
+            return ModuleVar(sym, srcmod, srcsym, path=path)
+        if tag == NODE_TOPLEVEL_VAR:
+            sym = self.read_symbol()
+            return ToplevelVar(sym, self.read_optional_env())
+        if tag == NODE_SET_BANG:
+            var = self.read_var()
+            return SetBang(var, self.read_node())
+        if tag == NODE_IF:
+            tst = self.read_node()
+            thn = self.read_node()
+            els = self.read_node()
+            return If.make(tst, thn, els)
+        if tag == NODE_CASE_LAMBDA:
+            lams = [self.read_lambda() for i in range(self.read_length())]
+            return CaseLambda(lams, self.read_optional_symbol())
+        if tag == NODE_LAMBDA:
+            return self.read_lambda_fields()
+        if tag == NODE_LETREC:
+            args = self.read_env()
+            counts = self.read_ints()
+            rhss = self.read_nodes()
+            ast = Letrec(args, counts, rhss, self.read_body())
+            self.read_pruning(ast)
+            return ast
+        if tag == NODE_LET:
+            args = self.read_env()
+            counts = self.read_ints()
+            rhss = self.read_nodes()
+            body = self.read_body()
+            ast = Let.make(args, counts, rhss, body, self.read_ints())
+            self.read_pruning(ast)
+            flags = self.read_optional_bools()
+            if flags is not None:
+                ast.init_mutable_var_flags(flags)
+            return ast
+        if tag == NODE_DEFINE_VALUES:
+            names = self.read_symbols()
+            rhs = self.read_node()
+            return DefineValues(names, rhs, self.read_symbols())
+        raise BinaryFormatError("unknown node tag %d in cached module" % tag)
+
+    def read_bigint(self):
+        try:
+            return rbigint.fromdecimalstr(self.read_str())
+        except ParseStringError:
+            raise BinaryFormatError("malformed number in cached module")
+
+    def read_real(self):
+        w_val = self.read_value()
+        if not isinstance(w_val, values.W_Real):
+            raise BinaryFormatError("expected a real number in cached module")
+        return w_val
+
+    def read_value(self):
+        tag = self.read_byte()
+        if tag == VALUE_FALSE:
+            return values.w_false
+        if tag == VALUE_TRUE:
+            return values.w_true
+        if tag == VALUE_VOID:
+            return values.w_void
+        if tag == VALUE_NULL:
+            return values.w_null
+        if tag == VALUE_FIXNUM:
+            return values.W_Fixnum(self.read_int())
+        if tag == VALUE_FLONUM:
+            return values.W_Flonum(string_to_float(self.read_str()))
+        if tag == VALUE_BIGNUM:
+            return values.W_Bignum(self.read_bigint())
+        if tag == VALUE_RATIONAL:
+            num = self.read_bigint()
+            return values.W_Rational(num, self.read_bigint())
+        if tag == VALUE_COMPLEX:
+            real = self.read_real()
+            return values.W_Complex(real, self.read_real())
+        if tag == VALUE_SYMBOL:
+            return self.read_symbol()
+        if tag == VALUE_STRING:
+            return values_string.W_String.make(self.read_str())
+        if tag == VALUE_KEYWORD:
+            return values.W_Keyword.make(self.read_str())
+        if tag == VALUE_CHAR:
+            return values.W_Character(unichr(self.read_length()))
+        if tag == VALUE_LIST:
+            elems = [self.read_value() for i in range(self.read_length())]
+            return values.to_improper(elems, self.read_value())
+        if tag == VALUE_VECTOR:
+            elems = [self.read_value() for i in range(self.read_length())]
+            return vector.W_Vector.fromelements(elems, immutable=True)
+        if tag == VALUE_BOX:
+            return values.W_IBox(self.read_value())
+        if tag == VALUE_PATH:
+            return values.W_Path(self.read_str())
+        if tag == VALUE_BYTES:
+            return values.W_ImmutableBytes(list(self.read_str()))
+        if tag == VALUE_REGEXP:
+            return values_regex.W_Regexp(self.read_str())
+        if tag == VALUE_PREGEXP:
+            return values_regex.W_PRegexp(self.read_str())
+        if tag == VALUE_BYTE_REGEXP:
+            return values_regex.W_ByteRegexp(self.read_str())
+        if tag == VALUE_BYTE_PREGEXP:
+            return values_regex.W_BytePRegexp(self.read_str())
+        if tag == VALUE_HASH:
+            keys = []
+            vals = []
+            for i in range(self.read_length()):
+                keys.append(self.read_value())
+                vals.append(self.read_value())
+            return make_immutable_equal_table(keys, vals)
+        raise BinaryFormatError("unknown value tag %d in cached module" % tag)
+
+def loads(data, loader):
+    """ Decode a cached module, `loader` is used by its requires """
+    decoder = ModuleDecoder(data, loader)
+    expected = header()
+    if data[:len(expected) - 1] == expected[:len(expected) - 1] and not data.startswith(expected):
+        raise BinaryFormatError("module cached with different AST pass options")
+    decoder.read_header(expected)
+    decoder.read_string_table()
+    decoder.read_symbol_table()
+    decoder.read_env_table()
+    module = decoder.read_node()
+    if not isinstance(module, Module):
+        raise BinaryFormatError("cached module is not a module")
+    if decoder.pos != len(data):
+        raise BinaryFormatError("extra data after cached module")
+    return module
+
+#### ========================== Files
+
+def try_dump_file(fname, module):
+    """ Best effort: modules that cannot be cached are not written """
+    try:
+        data = dumps(module)
+    except ModuleCacheError:
+        return False
+    return binary_ast.try_write_file(fname, data)
+
+def try_load_file(fname, loader):
+    """ Returns the cached module in `fname`, or None if there is no usable one """
+    try:
+        data = binary_ast.readfile(fname)
+    except (OSError, streamio.StreamError):
+        return None
+    if not is_module_cache(data):
+        return None
+    try:
+        return loads(data, loader)
+    except BinaryFormatError:
+        return None
@@ -0,0 +1,142 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Non-tail calls on the native stack, used when translating with
+# --stack-continuations.
+#
+# Normally the right-hand side of a let is evaluated with a LetCont as its
+# continuation, so every non-tail call allocates a continuation frame. In this
+# mode Let.interpret runs the right-hand side in a nested interpreter loop
+# instead and binds its values when the loop returns. The continuation of the
+# nested loop is a StackFrameCont, which stands for the let on the native
+# stack: plugging it while the let is still waiting raises StackReturn to the
+# nested loop of that let.
+#
+# The frames are taken from a pool with one frame per depth, so that a call
+# that returns normally allocates nothing. A frame stays valid as long as no
+# heap object refers to it. The constructors of continuations and continuation
+# mark sets call escape(), and the frames that are active at that point are
+# never reused: once their let has returned, plugging them continues like the
+# LetCont they stand for. A let that is left by an exception, or by jumping to
+# an outer frame, gives up its frame as well.
+#
+# The depth is bounded by MAX_DEPTH and by the size of the native stack. Beyond
+# that, lets use heap continuations as usual. The nested loops have no JIT
+# merge points, so this mode is meant for builds without the JIT; traces
+# always use heap continuations.
+
+from rpython.rlib             import rstack
+from rpython.rlib.objectmodel import we_are_translated
+from pycket.cont              import Cont, get_forward_mark
+from pycket.profiler          import profiler, poll as profile_poll
+
+MAX_DEPTH = 1000
+
+# the untranslated interpreter runs out of Python stack much earlier
+UNTRANSLATED_MAX_DEPTH = 50
+
+class StackReturn(Exception):
+    def __init__(self, frame, vals):
+        self.frame = frame
+        self.vals = vals
+
+class StackFrameCont(Cont):
+    """ The continuation of the right-hand side of a let that waits on the
+    native stack. The fields are reset whenever the frame is reused, which is
+    safe because nothing else refers to a frame that can be reused. """
+    _attrs_ = ["ast", "active"]
+
+    def __init__(self):
+        Cont.__init__(self, None, None)
+        self.ast = None
+        self.active = False
+
+    def reset(self, ast, env, prev):
+        self.marks = get_forward_mark(prev)
+        self.env = env
+        self.prev = prev
+        self.ast = ast
+        self.active = True
+
+    def heap_cont(self):
+        from pycket.interpreter import Let, LetCont
+        ast = self.ast
+        assert isinstance(ast, Let)
+        return LetCont.make(None, ast, 0, self.env, self.prev)
+
+    def _clone(self):
+        return self.heap_cont()
+
+    def get_ast(self):
+        return self.ast
+
+    def get_next_executed_ast(self):
+        return self.ast.body[0]
+
+    def plug_reduce(self, vals, env):
+        if self.active:
+            raise StackReturn(self, vals)
+        # the let has returned already, the frame escaped before
+        return self.heap_cont().plug_reduce(vals, env)
+
+class NativeStack(object):
+
+    def __init__(self):
+        self.depth = 0
+        self.frames = [None] * MAX_DEPTH
+        # the frames below this depth are referenced from the heap
+        self.escaped_depth = 0
+
+    def enter(self, ast, env, prev):
+        """ A frame for the let ast, or None if the stack is full """
+        depth = self.depth
+        if stack_full(depth):
+            return None
+        frame = self.frames[depth]
+        if frame is None:
+            frame = self.frames[depth] = StackFrameCont()
+        frame.reset(ast, env, prev)
+        self.depth = depth + 1
+        return frame
+
+    def leave(self, frame, returned):
+        self.depth -= 1
+        depth = self.depth
+        frame.active = False
+        if depth < self.escaped_depth:
+            self.escaped_depth = depth
+            returned = False
+        if not returned:
+            self.frames[depth] = None
+
+    def escape(self):
+        """ The current continuation is stored in the heap """
+        self.escaped_depth = self.depth
+
+    def run(self, frame, ast, env):
+        """ The values of ast, evaluated with frame as its continuation """
+        returned = False
+        try:
+            try:
+                cont = frame
+                while True:
+                    ast, env, cont = ast.interpret(env, cont)
+                    if profiler.active:
+                        profile_poll(ast, cont)
+            except StackReturn, ret:
+                if ret.frame is not frame:
+                    raise
+                returned = True
+                return ret.vals
+        finally:
+            self.leave(frame, returned)
+
+def stack_full(depth):
+    if not we_are_translated():
+        return depth >= UNTRANSLATED_MAX_DEPTH
+    return depth >= MAX_DEPTH or rstack.stack_almost_full()
+
+native_stack = NativeStack()
+
+def escape():
+    native_stack.escape()
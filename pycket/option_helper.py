@@ -2,10 +2,14 @@
 # -*- coding: utf-8 -*-
 #
 import os
+import rpath
 
 from .expand import (expand_file_to_json, expand_code_to_json, _expand_file_to_json,
-                     ensure_json_ast_eval, ensure_json_ast_run, _json_name, _BE,
-                     PermException, SchemeException)
+                     ensure_json_ast_eval, ensure_json_ast_run, _json_name, _BE, _FN,
+                     _strip_bundle_suffix, PermException, SchemeException)
+
+from .parallel_expand import expand_dependencies, parse_jobs
+from . import startup_stats
 
 from rpython.rlib import jit
 
@@ -39,9 +43,36 @@ def print_help(argv):
   -p <package> : Like -e '(require (planet "<package>")'
   -u <file>, --require-script <file> : Same as -t <file> -N <file> --
   -b (-R) <file> : run pycket with bytecode expansion, optional -R flag enables recursive bytecode expansion
-  -c <file> : run pycket with complete expansion, expanding every dependent module and put everything into one single json. <file> can also be a json pre-generated with -c option, in this case pycket doesn't need to expand anything at all.
+  -c <file> : run pycket with complete expansion, expanding every dependent module and put everything into one single json. <file> can also be a json pre-generated with -c option, in this case pycket doesn't need to expand anything at all. The modules are also cached next to the json in a .bundle.bin bundle, which is loaded lazily and can be given instead of the json.
  Configuration options:
   --stdlib: Use Pycket's version of stdlib (only applicable for -e)
+  --cache-dir <dir> : Store expanded modules in <dir>, defaults to
+                      $PYCKET_CACHE_DIR or ~/.cache/pycket
+  --cache-size <mb> : Evict old expanded modules beyond <mb> megabytes
+  --no-expansion-cache : Store expanded modules as <file>.json next to
+                         the source instead of in the cache directory
+  --expand-jobs <n> : Expand up to <n> uncached dependencies at a time,
+                      defaults to the number of processors
+  --lazy-lambda-bodies : Convert the body of a function only when it is
+                         called for the first time
+  --eliminate-dead-definitions : Do not evaluate the pure definitions
+                                 (functions and constants) of required
+                                 modules that the program never references
+  --startup-stats : Print the time and memory spent in every startup phase
+                    (expansion, AST conversion, module instantiation, ...)
+                    per module when the program exits
+  --startup-stats-json <file> : Like --startup-stats, but write the
+                                statistics to <file> as JSON
+  --profile : Sample the running program and print the time spent per
+              source location when it exits
+  --profile-output <file> : Like --profile, and write the samples to <file>
+                            as collapsed stacks for flame graphs
+  --jit-stats : Print the compiled loops, bridges, aborted traces and
+                guard failures per loop when the program exits
+  --save-callgraph-json <file> : Write the call graph with the sampled
+                                 number of calls per edge to <file> as JSON
+  --callgraph-hot-headers : Start tracing a cycle of the call graph at its
+                            most frequently called function
  Meta options:
   --jit <jitargs> : Set RPython JIT options may be 'default', 'off',
                     or 'param=value,param=value' list
@@ -149,6 +180,62 @@ def parse_args(argv):
         elif argv[i] == '--save-callgraph':
             config['save-callgraph'] = True
 
+        elif argv[i] == '--save-callgraph-json':
+            if to <= i + 1:
+                print "missing argument after --save-callgraph-json"
+                retval = 5
+                break
+            i += 1
+            names['save-callgraph-json'] = argv[i]
+
+        elif argv[i] == '--callgraph-hot-headers':
+            config['callgraph-hot-headers'] = True
+
+        elif argv[i] in ["--cache-dir", "--cache-size", "--expand-jobs"]:
+            arg = argv[i]
+            if to <= i + 1:
+                print "missing argument after %s" % arg
+                retval = 5
+                break
+            i += 1
+            names[arg[2:]] = argv[i]
+
+        elif argv[i] == '--no-expansion-cache':
+            config['expansion-cache'] = False
+
+        elif argv[i] == '--lazy-lambda-bodies':
+            config['lazy-lambda-bodies'] = True
+
+        elif argv[i] == '--eliminate-dead-definitions':
+            config['eliminate-dead-definitions'] = True
+
+        elif argv[i] == '--startup-stats':
+            config['startup-stats'] = True
+
+        elif argv[i] == '--startup-stats-json':
+            if to <= i + 1:
+                print "missing argument after --startup-stats-json"
+                retval = 5
+                break
+            i += 1
+            config['startup-stats'] = True
+            names['startup-stats-json'] = argv[i]
+
+        elif argv[i] == '--profile':
+            config['profile'] = True
+
+        elif argv[i] == '--profile-output':
+            if to <= i + 1:
+                print "missing argument after --profile-output"
+                retval = 5
+                break
+            i += 1
+            config['profile'] = True
+            names['profile-output'] = argv[i]
+
+        elif argv[i] == '--jit-stats':
+            config['jit-stats'] = True
+
         else:
             if 'file' in names:
                 break
@@ -178,22 +265,25 @@ def _temporary_file():
             warnings.simplefilter("ignore")
             return os.tmpnam()
 
-def ensure_json_ast(config, names):
+def ensure_json_ast(config, names, cache=None):
     stdlib = config.get('stdlib', False)
     # mcons = config.get('mcons', False)
     # assert not mcons
 
     if 'multiple-modules' in names:
         file_name = names['multiple-modules']
-        assert file_name.endswith('.json') or file_name.endswith('.rkt') or file_name.endswith('.rktl')
+        assert (file_name.endswith('.json') or file_name.endswith('.bin') or
+                file_name.endswith('.rkt') or file_name.endswith('.rktl'))
         json_file = file_name
         
         if file_name.endswith('.rkt') or file_name.endswith('.rktl'):
             json_file = _json_name(file_name)
             _expand_file_to_json(file_name, json_file, byte_flag=False, multi_flag=True)
+        elif file_name.endswith('.bundle.bin'):
+            file_name = _strip_bundle_suffix(file_name)
         else:
-            # strip the json
-            to = len(file_name) - 5
+            # strip the .json
+            to = file_name.rfind('.')
             assert to > 0
             file_name = file_name[:to]
         
@@ -220,14 +310,20 @@ def ensure_json_ast(config, names):
         assert 'file' in names
         file_name = names['file']
 
-        if file_name.endswith('.json'):
+        if file_name.endswith('.json') or file_name.endswith('.bin'):
+            # a pre-expanded AST, either as JSON or in the binary format
             json_file = file_name
-            to = len(file_name) - 5
+            to = file_name.rfind('.')
             assert to > 0
             file_name = file_name[:to]
         else:
+            if cache is not None:
+                abs_name = rpath.realpath(os.path.abspath(file_name))
+                timer = startup_stats.start("expand-parallel", abs_name)
+                expand_dependencies(abs_name, cache, _FN, jobs=parse_jobs(names))
+                startup_stats.stop(timer)
             try:
-                json_file = ensure_json_ast_run(file_name)
+                json_file = ensure_json_ast_run(file_name, cache=cache)
             except PermException:
                 json_file = None
     else:
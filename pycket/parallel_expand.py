@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Parallel expansion of the dependency graph of a module.
+#
+# Normally dependencies are discovered one at a time while the program runs:
+# `Require.find_module` calls `JsonLoader.lazy_load`, which expands the
+# required module if it is not cached yet. On a cold cache, startup therefore
+# costs one expander run after another, one per module.
+#
+# Before running a program, `expand_dependencies` walks the graph of requires
+# instead and keeps up to `jobs` expander processes busy. Every finished
+# expansion is stored in the expansion cache and its requires are queued, so
+# modules that are independent of each other are expanded at the same time.
+# The later lazy loads then only hit the cache.
+#
+# This pass is only a warm-up: a module that fails to expand is skipped here,
+# and the error is reported when the module is loaded in the normal way.
+
+import os
+import rpath
+
+from rpython.rlib import streamio
+from pycket       import pycket_json
+
+def default_jobs():
+    """ The number of online processors, or 1 if it cannot be determined """
+    try:
+        f = streamio.open_file_as_stream("/proc/cpuinfo")
+        try:
+            data = f.readall()
+        finally:
+            f.close()
+    except (OSError, streamio.StreamError):
+        return 1
+    count = 0
+    for line in data.split("\n"):
+        if line.startswith("processor"):
+            count += 1
+    return max(count, 1)
+
+def parse_jobs(names):
+    jobs = names.get('expand-jobs', "")
+    if jobs:
+        try:
+            return int(jobs)
+        except ValueError:
+            print "ignoring invalid number of expansion jobs %s" % jobs
+    return default_jobs()
+
+class ExpansionJob(object):
+    def __init__(self, file_name, output, log):
+        self.file_name = file_name
+        self.output = output
+        self.log = log
+
+class ParallelExpander(object):
+    _immutable_fields_ = ["cache", "lib", "byte_flag", "jobs"]
+
+    def __init__(self, cache, lib, byte_flag=False, jobs=1):
+        self.cache = cache
+        self.lib = lib
+        self.byte_flag = byte_flag
+        self.jobs = max(jobs, 1)
+        self.seen = {}
+        self.pending = []
+        self.running = {}
+        self.counter = 0
+        self.expanded = 0
+
+    def command(self, file_name, output, log):
+        return "racket %s --output \"%s\" \"%s\" > \"%s\" 2>&1" % (self.lib, output, file_name, log)
+
+    def _tmp_name(self, suffix):
+        self.counter += 1
+        return "%s/expand-%d-%d%s" % (self.cache.directory, os.getpid(), self.counter, suffix)
+
+    def enqueue(self, file_name):
+        file_name = rpath.realpath(file_name)
+        if file_name in self.seen:
+            return
+        self.seen[file_name] = None
+        if not os.access(file_name, os.R_OK):
+            return
+        deps = self.cache.cached_dependencies(file_name, self.byte_flag)
+        if deps is None:
+            self.pending.append(file_name)
+            return
+        # still walk the dependencies of a cached module, they may have changed
+        for dep in deps:
+            self.enqueue(dep)
+
+    def start(self, file_name):
+        output = self._tmp_name(".json")
+        log = self._tmp_name(".log")
+        cmd = self.command(file_name, output, log)
+        print "Expanding %s into %s" % (file_name, self.cache.directory)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.execv("/bin/sh", ["/bin/sh", "-c", cmd])
+            finally:
+                os._exit(127)
+        self.running[pid] = ExpansionJob(file_name, output, log)
+
+    def finish(self, job, succeeded):
+        try:
+            if succeeded:
+                self.store(job)
+        finally:
+            for fname in [job.output, job.log]:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+
+    def store(self, job):
+        try:
+            f = streamio.open_file_as_stream(job.output)
+            try:
+                data = f.readall()
+            finally:
+                f.close()
+        except (OSError, streamio.StreamError):
+            return
+        try:
+            json = pycket_json.loads(data)
+        except ValueError:
+            # a truncated or garbled expansion, the module is expanded again
+            # when it is loaded
+            return
+        if self.cache.store(job.file_name, self.byte_flag, json) is None:
+            return
+        self.expanded += 1
+        deps = self.cache.cached_dependencies(job.file_name, self.byte_flag)
+        if deps is not None:
+            for dep in deps:
+                self.enqueue(dep)
+
+    def run(self, file_name):
+        """ Expand `file_name` and everything it requires into the cache.
+        Returns the number of modules that were expanded. """
+        self.enqueue(file_name)
+        while self.pending or self.running:
+            while self.pending and len(self.running) < self.jobs:
+                self.start(self.pending.pop())
+            pid, status = os.waitpid(-1, 0)
+            job = self.running.get(pid, None)
+            if job is None:
+                continue
+            del self.running[pid]
+            succeeded = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+            self.finish(job, succeeded)
+        return self.expanded
+
+def expand_dependencies(file_name, cache, lib, byte_flag=False, jobs=1):
+    """ Expand the module `file_name` (an absolute path) and its dependencies
+    into `cache`, running up to `jobs` expanders at a time. """
+    if jobs <= 1:
+        # the sequential lazy loading does the same work without the overhead
+        return 0
+    return ParallelExpander(cache, lib, byte_flag, jobs).run(file_name)
@@ -30,9 +30,16 @@ EqualInfo.IMPERSONATOR_SINGLETON = EqualInfo(EqualInfo.IMPERSONATOR)
 
 @expose("equal?", [values.W_Object] * 2, simple=False)
 def equalp(a, b, env, cont):
-    # FIXME: broken for cycles, etc
-    info = EqualInfo.BASIC_SINGLETON
-    return equal_func_unroll_n(a, b, info, env, cont, n=5)
+    from pycket.interpreter import return_value
+    if a.eqv(b):
+        return return_value(values.w_true, env, cont)
+    try:
+        result = equalp_logic(a, b, EqualState())
+    except EqualFallback:
+        # FIXME: broken for cycles, etc
+        info = EqualInfo.BASIC_SINGLETON
+        return equal_func_unroll_n(a, b, info, env, cont, n=5)
+    return return_value(values.W_Bool.make(result), env, cont)
 
 @expose("equal?/recur", [values.W_Object, values.W_Object, procedure])
 def eqp_recur(v1, v2, recur_proc):
@@ -203,6 +210,150 @@ def equal_hash_args(w_prop):
         return lst[0], lst[1], lst[2]
     raise SchemeException("invalid prop:equal+hash arg " + w_prop.tostring())
 
+# equal? without continuations, for values without impersonators. It raises
+# EqualFallback when it meets a value that needs equal_func: an impersonator
+# or chaperone, a struct with prop:equal+hash, or nesting deeper than
+# MAX_NATIVE_DEPTH.
+#
+# Cycles are handled like in Racket's bool.c: after UNION_CHECK_BUDGET
+# compound values, the pairs of values being compared are merged in a
+# union-find structure, and a pair whose values are in the same set already is
+# assumed to be equal.
+
+UNION_CHECK_BUDGET = 64
+MAX_NATIVE_DEPTH = 500
+
+class EqualFallback(Exception):
+    pass
+
+class EqualState(object):
+    _attrs_ = ["budget", "depth", "parents"]
+
+    def __init__(self):
+        self.budget = UNION_CHECK_BUDGET
+        self.depth = 0
+        self.parents = None
+
+    def union_check(self, a, b):
+        """ Whether a and b can be assumed to be equal, because their
+        comparison is in progress already """
+        if self.budget > 0:
+            self.budget -= 1
+            return False
+        if self.parents is None:
+            self.parents = {}
+        a = self.find(a)
+        b = self.find(b)
+        if a is b:
+            return True
+        self.parents[a] = b
+        return False
+
+    def find(self, w_obj):
+        parents = self.parents
+        while True:
+            w_parent = parents.get(w_obj, None)
+            if w_parent is None:
+                return w_obj
+            w_grandparent = parents.get(w_parent, None)
+            if w_grandparent is not None:
+                parents[w_obj] = w_grandparent
+            w_obj = w_parent
+
+@jit.dont_look_inside
+def equalp_logic(a, b, state):
+    state.depth += 1
+    if state.depth > MAX_NATIVE_DEPTH:
+        raise EqualFallback
+    try:
+        return _equalp_logic(a, b, state)
+    finally:
+        state.depth -= 1
+
+def _equalp_logic(a, b, state):
+    while True:
+        if a.eqv(b):
+            return True
+        if a.is_proxy() or b.is_proxy():
+            raise EqualFallback
+
+        if isinstance(a, values_string.W_String) and isinstance(b, values_string.W_String):
+            return a.equal(b)
+
+        if isinstance(a, values.W_Bytes) and isinstance(b, values.W_Bytes):
+            return a.equal(b)
+
+        if ((isinstance(a, values.W_Cons) and isinstance(b, values.W_Cons)) or
+            (isinstance(a, values.W_MCons) and isinstance(b, values.W_MCons))):
+            if state.union_check(a, b):
+                return True
+            if (isinstance(a, values.W_UnwrappedFixnumCons) and
+                isinstance(b, values.W_UnwrappedFixnumCons)):
+                if a._car != b._car:
+                    return False
+            elif not equalp_logic(a.car(), b.car(), state):
+                return False
+            a, b = a.cdr(), b.cdr()
+            continue
+
+        if isinstance(a, values.W_Box) and isinstance(b, values.W_Box):
+            if state.union_check(a, b):
+                return True
+            a, b = unbox_logic(a), unbox_logic(b)
+            continue
+
+        if isinstance(a, values_vector.W_Vector) and isinstance(b, values_vector.W_Vector):
+            if a.length() != b.length():
+                return False
+            if state.union_check(a, b):
+                return True
+            return equal_vector_logic(a, b, state)
+
+        if isinstance(a, values_struct.W_RootStruct) and isinstance(b, values_struct.W_RootStruct):
+            a_type = a.struct_type()
+            b_type = b.struct_type()
+            if (a_type.read_prop(values_struct.w_prop_equal_hash) or
+                b_type.read_prop(values_struct.w_prop_equal_hash)):
+                raise EqualFallback
+            if not a_type.isopaque and not b_type.isopaque:
+                # compares like struct2vector
+                if a_type.name is not b_type.name:
+                    return False
+                if state.union_check(a, b):
+                    return True
+                return equal_list_logic(a.vals(), b.vals(), state)
+
+        return a.equal(b)
+
+def unbox_logic(w_box):
+    if isinstance(w_box, values.W_MBox):
+        return w_box.value
+    assert isinstance(w_box, values.W_IBox)
+    return w_box.value
+
+def equal_vector_logic(a, b, state):
+    """ Compares unwrapped fixnum and character storage directly """
+    a_strategy = a.get_strategy()
+    b_strategy = b.get_strategy()
+    if (isinstance(a_strategy, values_vector.FixnumVectorStrategy) and
+        isinstance(b_strategy, values_vector.FixnumVectorStrategy)):
+        return a_strategy._storage(a) == b_strategy._storage(b)
+    if (isinstance(a_strategy, values_vector.CharacterVectorStrategy) and
+        isinstance(b_strategy, values_vector.CharacterVectorStrategy)):
+        return a_strategy._storage(a) == b_strategy._storage(b)
+    for i in range(a.length()):
+        if not equalp_logic(a.ref(i), b.ref(i), state):
+            return False
+    return True
+
+def equal_list_logic(a_vals, b_vals, state):
+    if len(a_vals) != len(b_vals):
+        return False
+    for i in range(len(a_vals)):
+        if not equalp_logic(a_vals[i], b_vals[i], state):
+            return False
+    return True
+
 def eqp_logic(a, b):
     if a is b:
         return True
@@ -5,6 +5,28 @@ from pycket.arity import Arity
 
 prim_env = {}
 
+# Primitives without side effects whose result only depends on their arguments
+# and is never a fresh mutable object. Their applications to constants are
+# evaluated when a module is loaded, see pycket.constant_fold.
+PURE_PRIM_NAMES = [
+    "not", "eq?", "eqv?",
+    "null?", "pair?", "symbol?", "number?", "fixnum?", "flonum?", "integer?",
+    "exact-integer?", "exact?", "inexact?", "real?", "boolean?", "string?",
+    "bytes?", "char?", "void?", "vector?", "box?", "procedure?",
+    "car", "cdr", "caar", "cadr", "cdar", "cddr",
+    "add1", "sub1", "abs", "zero?", "even?", "odd?", "positive?", "negative?",
+    "exact->inexact", "char->integer",
+    "fx+", "fx-", "fx*", "fxmin", "fxmax",
+    "fx<", "fx<=", "fx>", "fx>=", "fx=",
+    "fl+", "fl-", "fl*", "flmin", "flmax",
+    "fl<", "fl<=", "fl>", "fl>=", "fl=",
+]
+
+pure_prims = {}
+
+def is_pure_prim(w_prim):
+    return w_prim in pure_prims
+
 SAFE = 0
 UNSAFE = 1
 SUBCLASS_UNSAFE = 2
@@ -97,15 +119,15 @@ def _make_arg_unwrapper(func, argstypes, funcname, has_self=False, simple=False)
         aritystring = "%s to %s" % (min_arg, max_arity)
     errormsg_arity = "expected %s arguments to %s, got " % (
         aritystring, funcname)
-    if min_arg == max_arity and not has_self and min_arg in (1, 2) and simple:
-        func_arg_unwrap, call1, call2 = make_direct_arg_unwrapper(
+    if min_arg == max_arity and not has_self and min_arg in (1, 2, 3) and simple:
+        func_arg_unwrap, call1, call2, call3 = make_direct_arg_unwrapper(
             func, min_arg, unroll_argtypes, errormsg_arity)
     else:
         func_arg_unwrap = make_list_arg_unwrapper(
             func, has_self, min_arg, max_arity, unroll_argtypes, errormsg_arity)
-        call1 = call2 = None
+        call1 = call2 = call3 = None
     _arity = Arity.oneof(*range(min_arg, max_arity+1))
-    return func_arg_unwrap, _arity, call1, call2
+    return func_arg_unwrap, _arity, call1, call2, call3
 
 def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
     # fast paths that allow the calling without constructing an args list
@@ -119,9 +141,11 @@ def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
             raise SchemeException(errormsg_arity + str(lenargs))
         if num_args == 1:
             return func_direct_unwrap(args[0], *rest)
-        else:
-            assert num_args == 2
+        elif num_args == 2:
             return func_direct_unwrap(args[0], args[1], *rest)
+        else:
+            assert num_args == 3
+            return func_direct_unwrap(args[0], args[1], args[2], *rest)
     func_arg_unwrap.func_name = "%s_arg_unwrap%s" % (func.func_name, num_args)
     if num_args == 1:
         (i, unwrapper, default, default_value, type_errormsg), = list(unroll_argtypes)
@@ -133,9 +157,8 @@ def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
                 raise SchemeException(type_errormsg + arg1.tostring())
             return func(typed_arg1, *rest)
         func_direct_unwrap.func_name = "%s_fast1" % (func.func_name, )
-        return func_arg_unwrap, func_direct_unwrap, None
-    else:
-        assert num_args == 2
+        return func_arg_unwrap, func_direct_unwrap, None, None
+    elif num_args == 2:
         ((i1, unwrapper1, default1, default_value1, type_errormsg1),
          (i2, unwrapper2, default2, default_value2, type_errormsg2)
             ) = list(unroll_argtypes)
@@ -155,7 +178,28 @@ def make_direct_arg_unwrapper(func, num_args, unroll_argtypes, errormsg_arity):
                 arg = arg1
             raise SchemeException(type_errormsg + arg.tostring())
         func_direct_unwrap.func_name = "%s_fast2" % (func.func_name, )
-        return func_arg_unwrap, None, func_direct_unwrap
+        return func_arg_unwrap, None, func_direct_unwrap, None
+    else:
+        assert num_args == 3
+        ((i1, unwrapper1, default1, default_value1, type_errormsg1),
+         (i2, unwrapper2, default2, default_value2, type_errormsg2),
+         (i3, unwrapper3, default3, default_value3, type_errormsg3)
+            ) = list(unroll_argtypes)
+        assert i1 == 0 and i2 == 1 and i3 == 2
+        assert not default1 and not default2 and not default3
+        def func_direct_unwrap(arg1, arg2, arg3, *rest):
+            typed_arg1 = unwrapper1(arg1)
+            if typed_arg1 is None:
+                raise SchemeException(type_errormsg1 + arg1.tostring())
+            typed_arg2 = unwrapper2(arg2)
+            if typed_arg2 is None:
+                raise SchemeException(type_errormsg2 + arg2.tostring())
+            typed_arg3 = unwrapper3(arg3)
+            if typed_arg3 is None:
+                raise SchemeException(type_errormsg3 + arg3.tostring())
+            return func(typed_arg1, typed_arg2, typed_arg3, *rest)
+        func_direct_unwrap.func_name = "%s_fast3" % (func.func_name, )
+        return func_arg_unwrap, None, None, func_direct_unwrap
 
 
 def make_list_arg_unwrapper(func, has_self, min_arg, max_arity, unroll_argtypes, errormsg_arity):
@@ -223,7 +267,7 @@ def make_procedure(n="<procedure>", argstypes=None, simple=True, arity=None):
         names = [n] if isinstance(n, str) else n
         name = names[0]
         if argstypes is not None:
-            func_arg_unwrap, _arity, _, _ = _make_arg_unwrapper(func, argstypes, name, simple=simple)
+            func_arg_unwrap, _arity, _, _, _ = _make_arg_unwrapper(func, argstypes, name, simple=simple)
             if arity is not None:
                 _arity = arity
         else:
@@ -264,14 +308,14 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=Fal
         name = names[0]
         if extra_info:
             assert not simple
-        call1 = call2 = None
+        call1 = call2 = call3 = None
         if nyi:
             def func_arg_unwrap(*args):
                 raise SchemeException(
                     "primitive %s is not yet implemented" % name)
             _arity = arity or Arity.unknown
         elif argstypes is not None:
-            func_arg_unwrap, _arity, call1, call2 = _make_arg_unwrapper(
+            func_arg_unwrap, _arity, call1, call2, call3 = _make_arg_unwrapper(
                     func, argstypes, name, simple=simple)
             if arity is not None:
                 _arity = arity
@@ -282,14 +326,18 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=Fal
         if not extra_info:
             func_result_handling = make_remove_extra_info(func_result_handling)
         result_arity = Arity.ONE if simple else None
+        simple_call = func_arg_unwrap if simple else None
         p = values.W_Prim(name, func_result_handling,
                           arity=_arity, result_arity=result_arity,
-                          simple1=call1, simple2=call2)
+                          simple1=call1, simple2=call2, simple3=call3,
+                          simple_call=simple_call)
         for nam in names:
             sym = values.W_Symbol.make(nam)
             if sym in prim_env:
                 raise SchemeException("name %s already defined" % nam)
             prim_env[sym] = p
+        if name in PURE_PRIM_NAMES:
+            pure_prims[p] = None
         func_arg_unwrap.w_prim = p
         return func_arg_unwrap
     return wrapper
@@ -297,7 +345,7 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False, extra_info=Fal
 def make_call_method(argstypes=None, arity=None, simple=True, name="<method>"):
     def wrapper(func):
         if argstypes is not None:
-            func_arg_unwrap, _, _, _ = _make_arg_unwrapper(
+            func_arg_unwrap, _, _, _, _ = _make_arg_unwrapper(
                 func, argstypes, name, has_self=True)
         else:
             func_arg_unwrap = func
@@ -14,9 +14,13 @@ from pycket import vector as values_vector
 from pycket.error import SchemeException, UserException
 from pycket.foreign import W_CPointer, W_CType
 from pycket.hash.base import W_HashTable
+from pycket.hash.weak import W_WeakHashTable
 from pycket.hash.simple import (W_EqImmutableHashTable, make_simple_immutable_table)
 from pycket.prims.expose import (unsafe, default, expose, expose_val, prim_env,
                                  procedure, define_nyi, subclass_unsafe)
+from pycket.profiler import profiler
+from pycket import jit_stats
+from pycket import inline_cache
 
 
 from rpython.rlib         import jit, objectmodel, unroll
@@ -112,7 +116,7 @@ for args in [
         ("hash-eq?", W_HashTable),
         ("hash-eqv?", W_HashTable),
         ("hash-equal?", W_HashTable),
-        ("hash-weak?", W_HashTable),
+        ("hash-weak?", W_WeakHashTable),
         ("cpointer?", W_CPointer),
         ("ctype?", W_CType),
         ("continuation-prompt-tag?", values.W_ContinuationPromptTag),
@@ -654,6 +658,49 @@ def time_apply(a, args, env, cont, extra_call_info):
                                    env, time_apply_cont(initial, env, cont),
                                    extra_call_info)
 
+@continuation
+def profile_cont(started, env, cont, vals):
+    from pycket.interpreter import return_multi_vals
+    if started:
+        profiler.stop()
+    return return_multi_vals(vals, env, cont)
+
+@expose("pycket-profile", [procedure], simple=False, extra_info=True)
+def pycket_profile(thunk, env, cont, extra_call_info):
+    """ Sample the execution of `thunk`, the profile is reported at exit """
+    started = profiler.start()
+    return thunk.call_with_extra_info([], env, profile_cont(started, env, cont),
+                                      extra_call_info)
+
+@expose("pycket-jit-stats", [])
+def pycket_jit_stats():
+    result = []
+    for entry in jit_stats.stats.entries():
+        result.append(values_vector.W_Vector.fromelements([
+            values_string.W_String.fromstr_utf8(entry.location),
+            values.W_Fixnum(entry.loops),
+            values.W_Fixnum(entry.bridges),
+            values.W_Fixnum(entry.aborts),
+            values.W_Fixnum(entry.guard_failures)]))
+    return values.to_list(result)
+
+@expose("pycket-inline-cache-stats", [])
+def pycket_inline_cache_stats():
+    return values.Values.make([values.W_Fixnum(inline_cache.stats.hits),
+                               values.W_Fixnum(inline_cache.stats.misses)])
+
+@expose("pycket-callgraph", [], simple=False)
+def pycket_callgraph(env, cont):
+    from pycket.interpreter import return_value
+    from pycket.profiler import lambda_label
+    result = []
+    for src, dst, count in env.toplevel_env().callgraph.edges():
+        result.append(values_vector.W_Vector.fromelements([
+            values_string.W_String.fromstr_utf8(lambda_label(src)),
+            values_string.W_String.fromstr_utf8(lambda_label(dst)),
+            values.W_Fixnum(count)]))
+    return return_value(values.to_list(result), env, cont)
+
 @expose("apply", simple=False, extra_info=True)
 def apply(args, env, cont, extra_call_info):
     if not args:
@@ -1443,9 +1490,20 @@ class ReaderGraphBuilder(object):
             empty._set(key, val)
         return empty
 
+    def reader_graph_loop_immutable_equal_hash(self, v):
+        from pycket.hash.equal import (
+            W_EqualImmutableHashTable, make_immutable_equal_table)
+        assert isinstance(v, W_EqualImmutableHashTable)
+        self.state[v] = v
+        keys = [self.reader_graph_loop(key) for key in v.keys()]
+        vals = [self.reader_graph_loop(val) for val in v.vals()]
+        result = make_immutable_equal_table(keys, vals)
+        self.state[v] = result
+        return result
+
     def reader_graph_loop(self, v):
         assert v is not None
-        from pycket.hash.equal import W_EqualHashTable
+        from pycket.hash.equal import W_EqualHashTable, W_EqualImmutableHashTable
         if v in self.state:
             return self.state[v]
         if v.is_proxy():
@@ -1458,6 +1516,8 @@ class ReaderGraphBuilder(object):
             return self.reader_graph_loop_struct(v)
         if isinstance(v, W_EqualHashTable):
             return self.reader_graph_loop_equal_hash(v)
+        if isinstance(v, W_EqualImmutableHashTable):
+            return self.reader_graph_loop_immutable_equal_hash(v)
         if isinstance(v, values.W_Placeholder):
             return self.reader_graph_loop(v.value)
         # XXX FIXME: doesn't handle stuff
@@ -8,11 +8,16 @@ from pycket.hash.simple  import (
     W_EqvImmutableHashTable, W_EqImmutableHashTable,
     make_simple_mutable_table, make_simple_mutable_table_assocs,
     make_simple_immutable_table, make_simple_immutable_table_assocs)
-from pycket.hash.equal   import W_EqualHashTable
+from pycket.hash.equal   import (
+    W_EqualHashTable, W_EqualImmutableHashTable,
+    is_direct_key, make_immutable_equal_table, tagged_hash)
+from pycket.hash.weak    import (
+    W_WeakHashTable, W_WeakEqHashTable, W_WeakEqualHashTable)
 from pycket.cont         import continuation, loop_label
 from pycket.error        import SchemeException
 from pycket.prims.expose import default, expose, procedure, define_nyi
 from rpython.rlib        import jit, objectmodel
+from rpython.rlib.rarithmetic import intmask
 
 _KEY = 0
 _VALUE = 1
@@ -31,6 +36,9 @@ def prefix_hash_names(base):
 def hash_iterate_first(ht):
     if ht.length() == 0:
         return values.w_false
+    if isinstance(ht, W_WeakHashTable):
+        # the first entries may have been collected
+        return values.wrap(ht.hash_iterate_first())
     return values.W_Fixnum.ZERO
 
 @expose(prefix_hash_names("hash-iterate-next"), [W_HashTable, values.W_Fixnum])
@@ -142,19 +150,37 @@ def from_assocs(assocs, fname):
 
 @expose("make-weak-hasheq", [])
 def make_weak_hasheq():
-    # FIXME: not actually weak
-    return make_simple_mutable_table(W_EqvMutableHashTable, None, None)
+    return W_WeakEqHashTable()
 
-@expose(["make-weak-hash", "make-late-weak-hasheq"], [default(values.W_List, None)])
-def make_weak_hash(assocs):
-    if assocs is None:
-        return W_EqualHashTable([], [], immutable=False)
-    return W_EqualHashTable(*from_assocs(assocs, "make-weak-hash"), immutable=False)
+@expose("make-late-weak-hasheq", [default(values.W_List, values.w_null)])
+def make_late_weak_hasheq(assocs):
+    table = W_WeakEqHashTable()
+    keys, vals = from_assocs(assocs, "make-late-weak-hasheq")
+    for i, key in enumerate(keys):
+        table._set(key, vals[i])
+    return table
+
+@expose("make-weak-hash", [default(values.W_List, values.w_null)], simple=False)
+def make_weak_hash(assocs, env, cont):
+    keys, vals = from_assocs(assocs, "make-weak-hash")
+    return hash_set_loop(W_WeakEqualHashTable(), keys, vals, 0, env, cont)
+
+@loop_label
+def hash_set_loop(table, keys, vals, idx, env, cont):
+    from pycket.interpreter import return_value
+    if idx >= len(keys):
+        return return_value(table, env, cont)
+    return table.hash_set(keys[idx], vals[idx], env,
+            hash_set_loop_cont(table, keys, vals, idx, env, cont))
+
+@continuation
+def hash_set_loop_cont(table, keys, vals, idx, env, cont, _vals):
+    return hash_set_loop(table, keys, vals, idx + 1, env, cont)
 
 @expose("make-immutable-hash", [default(values.W_List, values.w_null)])
 def make_immutable_hash(assocs):
     keys, vals = from_assocs(assocs, "make-immutable-hash")
-    return W_EqualHashTable(keys, vals, immutable=True)
+    return make_immutable_equal_table(keys, vals)
 
 @expose("make-immutable-hasheq", [default(values.W_List, values.w_null)])
 def make_immutable_hasheq(assocs):
@@ -170,7 +196,7 @@ def hash(args):
         raise SchemeException("hash: key does not have a corresponding value")
     keys = [args[i] for i in range(0, len(args), 2)]
     vals = [args[i] for i in range(1, len(args), 2)]
-    return W_EqualHashTable(keys, vals, immutable=True)
+    return make_immutable_equal_table(keys, vals)
 
 @expose("hasheq")
 def hasheq(args):
@@ -223,6 +249,9 @@ def hash_set(table, key, val, env, cont):
     if not table.immutable():
         raise SchemeException("hash-set: not given an immutable table")
 
+    if isinstance(table, W_EqualImmutableHashTable) and not is_direct_key(key):
+        return table.hash_set_persistent(key, val, env, cont)
+
     # Fast path
     if isinstance(table, W_ImmutableHashTable):
         new_table = table.assoc(key, val)
@@ -286,6 +315,8 @@ def hash_copy_loop(keys, idx, src, new, env, cont):
 
 def hash_copy(src, env, cont):
     from pycket.interpreter import return_value
+    if isinstance(src, W_EqualImmutableHashTable):
+        return return_value(W_EqualHashTable(src.keys(), src.vals()), env, cont)
     new = src.make_empty()
     if isinstance(src, W_ImmutableHashTable):
         return return_value(new, env, cont)
@@ -295,14 +326,15 @@ def hash_copy(src, env, cont):
 
 expose("hash-copy", [W_HashTable], simple=False)(hash_copy)
 
-# FIXME: not implemented
 @expose("equal-hash-code", [values.W_Object])
 def equal_hash_code(v):
-    return values.W_Fixnum.ZERO
+    return values.W_Fixnum(tagged_hash(v))
 
 @expose("equal-secondary-hash-code", [values.W_Object])
 def equal_secondary_hash_code(v):
-    return values.W_Fixnum.ZERO
+    x = tagged_hash(v)
+    x = intmask((x ^ (x >> 16)) * 0x45d9f3b)
+    return values.W_Fixnum(x ^ (x >> 16))
 
 @expose("eq-hash-code", [values.W_Object])
 def eq_hash_code(v):
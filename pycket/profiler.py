@@ -0,0 +1,261 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A sampling profiler for Racket code.
+#
+# While profiling is active, a SIGPROF timer fires every few milliseconds of
+# CPU time. The signal handler only sets a flag; the interpreter loop checks
+# it and takes a sample of the AST it is about to execute and of the
+# continuation chain that waits for it. Every AST and continuation is
+# attributed to the source location of its surrounding lambda, so a sample is
+# a stack of source locations, innermost first.
+#
+# The samples are reported as collapsed stacks, one line per distinct stack
+# with the frames outermost first, separated by semicolons and followed by
+# the number of samples, as read by flamegraph.pl, and as a table with the
+# number of samples in which each source location was executing (self) or on
+# the stack (total).
+#
+# When profiling is off, the check in the interpreter loop reads a
+# quasi-immutable field, so JIT compiled code does not pay for it.
+
+import os
+
+from rpython.rlib          import jit, streamio
+from rpython.rlib.listsort import make_timsort_class
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rlib.rfloat   import formatd
+
+# seconds of CPU time between samples
+SAMPLE_INTERVAL = 0.001
+
+# continuations deeper than this are not included in a sample
+MAX_DEPTH = 1024
+
+TOPLEVEL_LABEL = "<toplevel>"
+
+class SrclocStats(object):
+    def __init__(self, label):
+        self.label = label
+        self.self_count = 0
+        self.total_count = 0
+
+BaseSrclocSorter = make_timsort_class()
+
+class SrclocSorter(BaseSrclocSorter):
+    def lt(self, a, b):
+        # hottest first
+        if a.self_count != b.self_count:
+            return a.self_count > b.self_count
+        return a.total_count > b.total_count
+
+def lambda_label(lam):
+    """ The source location of a lambda as file:line:column """
+    if lam is None:
+        return TOPLEVEL_LABEL
+    info = lam.sourceinfo
+    if info is None:
+        return "<unknown>"
+    file = info.sourcefile or "<unknown>"
+    if info.line >= 0:
+        return "%s:%d:%d" % (file, info.line, info.column)
+    if info.position >= 0:
+        return "%s:%d" % (file, info.position)
+    return file
+
+def ast_label(ast):
+    return lambda_label(ast.surrounding_lambda)
+
+def snapshot(ast, cont):
+    """ The source locations of the current AST and of the ASTs waiting on
+    the continuation chain, innermost first. Consecutive continuations in the
+    same lambda are one frame. """
+    frames = [ast_label(ast)] if ast is not None else []
+    depth = 0
+    while cont is not None and depth < MAX_DEPTH:
+        waiting = cont.get_ast()
+        if waiting is not None:
+            label = ast_label(waiting)
+            if not frames or frames[-1] != label:
+                frames.append(label)
+        cont = cont.get_previous_continuation()
+        depth += 1
+    if not frames:
+        frames.append(TOPLEVEL_LABEL)
+    return frames
+
+class Profiler(object):
+
+    _immutable_fields_ = ["active?"]
+
+    def __init__(self):
+        self.active = False
+        self.output_file = ""
+        self.samples = 0
+        self.stacks = {}
+        self.srclocs = {}
+        # set by the signal handler when running untranslated
+        self.pending = False
+
+    def enable(self, output_file=""):
+        """ Profile the whole program and report when it exits """
+        self.output_file = output_file
+        self.start()
+
+    def start(self):
+        """ Start sampling, returns False if it is already running """
+        if self.active:
+            return False
+        self.active = True
+        _start_timer(self, SAMPLE_INTERVAL)
+        return True
+
+    def stop(self):
+        if not self.active:
+            return
+        _stop_timer()
+        self.active = False
+
+    def poll(self, ast, cont):
+        if _timer_fired(self):
+            self.sample(ast, cont)
+
+    def sample(self, ast, cont):
+        self.record(snapshot(ast, cont))
+
+    def record(self, frames):
+        self.samples += 1
+        stack = [""] * len(frames)
+        for i in range(len(frames)):
+            stack[len(frames) - 1 - i] = frames[i]
+        key = ";".join(stack)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.srcloc(frames[0]).self_count += 1
+        # recursive calls count once towards the total
+        counted = {}
+        for label in frames:
+            if label not in counted:
+                counted[label] = None
+                self.srcloc(label).total_count += 1
+
+    def srcloc(self, label):
+        stats = self.srclocs.get(label, None)
+        if stats is None:
+            stats = self.srclocs[label] = SrclocStats(label)
+        return stats
+
+    def format_collapsed(self):
+        lines = []
+        for stack, count in self.stacks.items():
+            lines.append("%s %d\n" % (stack, count))
+        return "".join(lines)
+
+    def format_table(self):
+        entries = self.srclocs.values()
+        SrclocSorter(entries).sort()
+        lines = ["Profile (%d samples)" % self.samples,
+                 "",
+                 _row("self", "self %", "total", "total %", "source location")]
+        for entry in entries:
+            lines.append(_row(str(entry.self_count),
+                              _percent(entry.self_count, self.samples),
+                              str(entry.total_count),
+                              _percent(entry.total_count, self.samples),
+                              entry.label))
+        lines.append("")
+        return "\n".join(lines)
+
+    def report(self):
+        if self.samples == 0:
+            return
+        os.write(2, self.format_table())
+        if self.output_file:
+            try:
+                f = streamio.open_file_as_stream(self.output_file, "w")
+                try:
+                    f.write(self.format_collapsed())
+                finally:
+                    f.close()
+            except (OSError, streamio.StreamError):
+                print "could not write the profile to %s" % self.output_file
+
+def _pad_left(s, width):
+    return " " * max(width - len(s), 0) + s
+
+def _row(self_count, self_percent, total_count, total_percent, label):
+    return "%s %s %s %s  %s" % (_pad_left(self_count, 8), _pad_left(self_percent, 7),
+                                _pad_left(total_count, 8), _pad_left(total_percent, 7),
+                                label)
+
+def _percent(count, samples):
+    if samples == 0:
+        return "0.0"
+    return formatd(count * 100.0 / samples, 'f', 1)
+
+def _start_timer(profiler, interval):
+    if not we_are_translated():
+        import signal
+        def handler(signum, frame):
+            profiler.pending = True
+        signal.signal(signal.SIGPROF, handler)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        return
+    from rpython.rlib import rsignal
+    rsignal.pypysig_setflag(rsignal.SIGPROF)
+    _setitimer(interval)
+
+def _stop_timer():
+    if not we_are_translated():
+        import signal
+        signal.setitimer(signal.ITIMER_PROF, 0.0, 0.0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        return
+    from rpython.rlib import rsignal
+    _setitimer(0.0)
+    rsignal.pypysig_ignore(rsignal.SIGPROF)
+
+def _setitimer(interval):
+    from rpython.rlib import rsignal
+    from rpython.rtyper.lltypesystem import lltype, rffi
+    seconds = int(interval)
+    microseconds = int((interval - seconds) * 1000000.0)
+    with lltype.scoped_alloc(rsignal.itimervalP.TO, 1) as new:
+        rffi.setintfield(new[0].c_it_value, 'c_tv_sec', seconds)
+        rffi.setintfield(new[0].c_it_value, 'c_tv_usec', microseconds)
+        rffi.setintfield(new[0].c_it_interval, 'c_tv_sec', seconds)
+        rffi.setintfield(new[0].c_it_interval, 'c_tv_usec', microseconds)
+        rsignal.c_setitimer(rsignal.ITIMER_PROF, new,
+                            lltype.nullptr(rsignal.itimervalP.TO))
+
+def _timer_fired(profiler):
+    if not we_are_translated():
+        fired = profiler.pending
+        profiler.pending = False
+        return fired
+    from rpython.rlib import rsignal
+    occurred = rsignal.pypysig_getaddr_occurred()
+    if occurred.c_value >= 0:
+        return False
+    occurred.c_value = 0
+    fired = False
+    while True:
+        signum = rsignal.pypysig_poll()
+        if signum < 0:
+            break
+        if signum == rsignal.SIGPROF:
+            fired = True
+    return fired
+
+profiler = Profiler()
+
+def configure(config, names):
+    if config.get('profile', False):
+        profiler.enable(names.get('profile-output', ""))
+
+@jit.dont_look_inside
+def poll(ast, cont):
+    profiler.poll(ast, cont)
+
+def report(config, env):
+    profiler.stop()
+    profiler.report()
@@ -1,5 +1,6 @@
-from rpython.rlib.runicode import unicode_encode_utf_8
-from rpython.rlib.objectmodel import specialize
+from rpython.rlib.rarithmetic import string_to_int
+from rpython.rlib.rfloat import string_to_float
+from rpython.rlib.rstring import StringBuilder, ParseStringError, ParseStringOverflowError
 from rpython.tool.pairtype import extendabletype
 
 # Union-Object to represent a json structure in a static way
@@ -158,114 +159,401 @@ json_true = JsonTrue()
 json_false = JsonFalse()
 
 
-class FakeSpace(object):
-
-    w_None = json_null
-    w_True = json_true
-    w_False = json_false
-    w_ValueError = ValueError
-    w_UnicodeDecodeError = UnicodeDecodeError
-    w_UnicodeEncodeError = UnicodeEncodeError
-    w_int = JsonInt
-    w_float = JsonFloat
-
-    def newtuple(self, items):
-        return None
-
-    def newdict(self):
-        return JsonObject({})
-
-    def newlist(self, items):
-        return JsonArray([])
-
-    def call_method(self, obj, name, arg):
-        assert name == 'append'
-        assert isinstance(obj, JsonArray)
-        obj.value.append(arg)
-    call_method._dont_inline_ = True
-
-    def call_function(self, w_func, *args_w):
-        assert 0
-
-    def setitem(self, d, key, value):
-        assert isinstance(d, JsonObject)
-        assert isinstance(key, JsonString)
-        d.value[key.value_string()] = value
-
-    def newunicode(self, x):
-        return JsonString(unicode_encode_utf_8(x, len(x), "strict"))
+def loads(s):
+    builder = JsonTreeBuilder(JsonEventReader(s))
+    result = builder.read_value()
+    builder.finish()
+    return result
+
+#### ========================== Event based decoding
+
+# The reader below produces a stream of events that consumers such as the
+# JsonLoader can act on directly, without building the tree first. `loads`
+# builds the tree from the same events. The keys written by the expander are
+# known in advance and are returned as pre-interned strings without allocating.
+
+EVENT_EOF          = 0
+EVENT_NULL         = 1
+EVENT_TRUE         = 2
+EVENT_FALSE        = 3
+EVENT_INT          = 4
+EVENT_FLOAT        = 5
+EVENT_STRING       = 6
+EVENT_START_ARRAY  = 7
+EVENT_END_ARRAY    = 8
+EVENT_START_OBJECT = 9
+EVENT_KEY          = 10
+EVENT_END_OBJECT   = 11
+
+KNOWN_KEYS = [
+    "%mpi", "%p", "begin-for-syntax", "begin0", "begin0-rest", "body",
+    "body-forms", "box", "byte-pregexp", "byte-regexp", "bytecode-expand",
+    "bytes", "case-lambda", "char", "column", "config", "define-values",
+    "define-values-body", "define-values-names", "denominator", "else",
+    "extended-real", "hash-keys", "hash-vals", "imag-part", "improper",
+    "integer", "keyword", "lambda", "language", "let-bindings", "let-body",
+    "letrec-bindings", "letrec-body", "lexical", "line", "module",
+    "module-name", "number", "numerator", "operands", "operator", "path",
+    "position", "prefab-key", "pregexp", "quote", "quote-syntax", "real",
+    "real-part", "regexp", "require", "require-for-syntax", "source",
+    "source-module", "source-name", "span", "string", "struct", "test",
+    "then", "toplevel", "variable-reference", "vector", "void", "wcm-body",
+    "wcm-key", "wcm-val",
+]
+
+def _known_key_table():
+    # keys grouped by length and first character, so that a key can be looked
+    # up by comparing it in place
+    table = {}
+    for key in KNOWN_KEYS:
+        table.setdefault((len(key), key[0]), []).append(key)
+    return table
+
+KNOWN_KEY_TABLE = _known_key_table()
+
+class EventReader(object):
+    """
+    A source of events. Every call to `next` returns the next event; the
+    payload of the event is available as `key`, `string_value`, `int_value`
+    or `float_value`.
+    """
 
-    def newtext(self, x):
-        return JsonString(x)
-    newbytes = newtext
+    def __init__(self):
+        self.key = None
+        self.string_value = None
+        self.int_value = 0
+        self.float_value = 0.0
 
-    def unicode_w(self, s):
-        assert isinstance(s, JsonString)
-        string = s.value_string()
-        return string.decode('utf-8')
+    def next(self):
+        raise NotImplementedError("abstract method")
 
-    def newint(self, x):
-        return JsonInt(x)
+    def error(self, msg):
+        raise NotImplementedError("abstract method")
 
-    def newfloat(self, x):
-        return JsonFloat(x)
+class JsonEventReader(EventReader):
+    """ A pull parser for JSON text """
 
-fakespace = FakeSpace()
+    def __init__(self, s):
+        EventReader.__init__(self)
+        self.s = s
+        self.pos = 0
+        # one entry per open container, True for objects
+        self.stack = []
+        self.after_value = False
+        self.just_opened = False
+        self.other_keys = {}
+
+    def error(self, msg):
+        raise ValueError("%s at char %d" % (msg, self.pos))
+
+    def skip_whitespace(self, i):
+        s = self.s
+        while i < len(s) and s[i] in " \t\n\r":
+            i += 1
+        return i
 
-from pypy.module._pypyjson.interp_decoder import JSONDecoder
+    def next(self):
+        s = self.s
+        i = self.skip_whitespace(self.pos)
+        self.pos = i
+        if self.after_value:
+            if not self.stack:
+                if i < len(s):
+                    self.error("Extra data")
+                return EVENT_EOF
+            if i >= len(s):
+                self.error("Unterminated container")
+            ch = s[i]
+            in_object = self.stack[-1]
+            if ch == ',':
+                i = self.skip_whitespace(i + 1)
+                self.pos = i
+                self.after_value = False
+                if in_object:
+                    return self._read_key(i)
+            elif ch == ']' and not in_object:
+                return self._close(i, EVENT_END_ARRAY)
+            elif ch == '}' and in_object:
+                return self._close(i, EVENT_END_OBJECT)
+            else:
+                self.error("Expected ',' or the end of the container")
+        elif self.just_opened:
+            self.just_opened = False
+            in_object = self.stack[-1]
+            if i < len(s):
+                ch = s[i]
+                if ch == ']' and not in_object:
+                    return self._close(i, EVENT_END_ARRAY)
+                if ch == '}' and in_object:
+                    return self._close(i, EVENT_END_OBJECT)
+            if in_object:
+                return self._read_key(i)
+        return self._read_value(i)
+
+    def _close(self, i, event):
+        self.stack.pop()
+        self.pos = i + 1
+        self.after_value = True
+        return event
+
+    def _read_key(self, i):
+        s = self.s
+        if i >= len(s) or s[i] != '"':
+            self.error("Expected a key")
+        start = i + 1
+        end = start
+        while end < len(s) and s[end] != '"' and s[end] != '\\':
+            end += 1
+        if end < len(s) and s[end] == '"':
+            self.key = self._intern_key(start, end)
+            i = end + 1
+        else:
+            self.key = self._decode_escaped(start)
+            i = self.pos
+        i = self.skip_whitespace(i)
+        if i >= len(s) or s[i] != ':':
+            self.pos = i
+            self.error("Expected ':'")
+        self.pos = i + 1
+        return EVENT_KEY
+
+    def _intern_key(self, start, end):
+        s = self.s
+        length = end - start
+        if length > 0:
+            candidates = KNOWN_KEY_TABLE.get((length, s[start]), None)
+            if candidates is not None:
+                for key in candidates:
+                    j = 1
+                    while j < length and key[j] == s[start + j]:
+                        j += 1
+                    if j == length:
+                        return key
+        key = s[start:end]
+        result = self.other_keys.get(key, None)
+        if result is None:
+            self.other_keys[key] = result = key
+        return result
 
-class OwnJSONDecoder(JSONDecoder):
-    def __init__(self, s):
-        self.space = fakespace
-        JSONDecoder.__init__(self, fakespace, s)
+    def _read_value(self, i):
+        s = self.s
+        if i >= len(s):
+            self.error("Unexpected end of data")
+        ch = s[i]
+        self.after_value = True
+        if ch == '{':
+            self.stack.append(True)
+            self.after_value = False
+            self.just_opened = True
+            self.pos = i + 1
+            return EVENT_START_OBJECT
+        if ch == '[':
+            self.stack.append(False)
+            self.after_value = False
+            self.just_opened = True
+            self.pos = i + 1
+            return EVENT_START_ARRAY
+        if ch == '"':
+            self.string_value = self._read_string(i + 1)
+            return EVENT_STRING
+        if ch == 'n':
+            return self._read_literal(i, "null", EVENT_NULL)
+        if ch == 't':
+            return self._read_literal(i, "true", EVENT_TRUE)
+        if ch == 'f':
+            return self._read_literal(i, "false", EVENT_FALSE)
+        if ch == '-' or '0' <= ch <= '9':
+            return self._read_number(i)
+        self.error("Unexpected character %s" % ch)
+        assert 0
 
-    @specialize.arg(1)
-    def _raise(self, msg, *args):
-        raise ValueError(msg % args)
+    def _read_literal(self, i, literal, event):
+        end = i + len(literal)
+        if self.s[i:end] != literal:
+            self.error("Invalid literal")
+        self.pos = end
+        return event
 
-    def decode_float(self, i):
+    def _read_number(self, i):
+        s = self.s
         start = i
-        while self.ll_chars[i] in "+-0123456789.eE":
+        if s[i] == '-':
+            i += 1
+        is_float = False
+        while i < len(s):
+            ch = s[i]
+            if '0' <= ch <= '9':
+                pass
+            elif ch in ".eE+-":
+                is_float = True
+            else:
+                break
             i += 1
         self.pos = i
-        return self.space.newfloat(float(self.getslice(start, i)))
-
-    def decode_string(self, i):
+        number = s[start:i]
+        if is_float:
+            try:
+                self.float_value = string_to_float(number)
+            except ParseStringError:
+                self.error("Invalid number")
+            return EVENT_FLOAT
+        try:
+            self.int_value = string_to_int(number, 10)
+        except ParseStringError:
+            self.error("Invalid number")
+        except ParseStringOverflowError:
+            self.float_value = string_to_float(number)
+            return EVENT_FLOAT
+        return EVENT_INT
+
+    def _read_string(self, i):
+        s = self.s
         start = i
-        while True:
-            # this loop is a fast path for strings which do not contain escape
-            # characters
-            ch = self.ll_chars[i]
-            i += 1
+        while i < len(s):
+            ch = s[i]
             if ch == '"':
-                content_utf8 = self.getslice(start, i-1)
-                self.last_type = 1
+                self.pos = i + 1
+                return s[start:i]
+            if ch == '\\':
+                return self._decode_escaped(start)
+            if ch < '\x20':
                 self.pos = i
-                return JsonString(content_utf8)
-            elif ch == '\\':
-                self.pos = i-1
-                return self.decode_string_escaped(start)
-            elif ch < '\x20':
-                self._raise("Invalid control character at char %d", self.pos-1)
-
-    def _create_dict(self, dct):
-        d = {}
-        for key, value in dct.iteritems():
-            d[unicode_encode_utf_8(key, len(key), "strict")] = value
-        return JsonObject(d)
-
+                self.error("Invalid control character")
+            i += 1
+        self.error("Unterminated string")
+        assert 0
 
+    def _decode_escaped(self, start):
+        s = self.s
+        builder = StringBuilder()
+        i = start
+        while i < len(s):
+            ch = s[i]
+            i += 1
+            if ch == '"':
+                self.pos = i
+                return builder.build()
+            if ch != '\\':
+                builder.append(ch)
+                continue
+            if i >= len(s):
+                break
+            ch = s[i]
+            i += 1
+            if ch == 'n':
+                builder.append('\n')
+            elif ch == 't':
+                builder.append('\t')
+            elif ch == 'r':
+                builder.append('\r')
+            elif ch == 'b':
+                builder.append('\b')
+            elif ch == 'f':
+                builder.append('\f')
+            elif ch in '"\\/':
+                builder.append(ch)
+            elif ch == 'u':
+                code = self._read_hex(i)
+                i += 4
+                if (0xd800 <= code < 0xdc00 and s[i:i + 2] == "\\u"):
+                    low = self._read_hex(i + 2)
+                    if 0xdc00 <= low < 0xe000:
+                        code = 0x10000 + ((code - 0xd800) << 10) + (low - 0xdc00)
+                        i += 6
+                encode_utf8(builder, code)
+            else:
+                self.pos = i
+                self.error("Invalid escape")
+        self.error("Unterminated string")
+        assert 0
 
-def loads(s):
-    decoder = OwnJSONDecoder(s)
-    try:
-        w_res = decoder.decode_any(0)
-        i = decoder.skip_whitespace(decoder.pos)
-        if i < len(s):
-            start = i
-            end = len(s) - 1
-            raise ValueError("Extra data: char %d - %d" % (start, end))
-        return w_res
-    finally:
-        decoder.close()
+    def _read_hex(self, i):
+        s = self.s
+        if i + 4 > len(s):
+            self.pos = i
+            self.error("Truncated \\u escape")
+        code = 0
+        for j in range(i, i + 4):
+            ch = s[j]
+            if '0' <= ch <= '9':
+                digit = ord(ch) - ord('0')
+            elif 'a' <= ch <= 'f':
+                digit = ord(ch) - ord('a') + 10
+            elif 'A' <= ch <= 'F':
+                digit = ord(ch) - ord('A') + 10
+            else:
+                self.pos = j
+                self.error("Invalid \\u escape")
+                assert 0
+            code = code * 16 + digit
+        return code
+
+def encode_utf8(builder, code):
+    if code < 0x80:
+        builder.append(chr(code))
+    elif code < 0x800:
+        builder.append(chr(0xc0 | (code >> 6)))
+        builder.append(chr(0x80 | (code & 0x3f)))
+    elif code < 0x10000:
+        builder.append(chr(0xe0 | (code >> 12)))
+        builder.append(chr(0x80 | ((code >> 6) & 0x3f)))
+        builder.append(chr(0x80 | (code & 0x3f)))
+    else:
+        builder.append(chr(0xf0 | (code >> 18)))
+        builder.append(chr(0x80 | ((code >> 12) & 0x3f)))
+        builder.append(chr(0x80 | ((code >> 6) & 0x3f)))
+        builder.append(chr(0x80 | (code & 0x3f)))
+
+class JsonTreeBuilder(object):
+    """ Builds JsonBase values from the events of an EventReader """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.strings = {}
+
+    def make_string(self, s):
+        # the expander output repeats the same names over and over
+        w_str = self.strings.get(s, None)
+        if w_str is None:
+            self.strings[s] = w_str = JsonString(s)
+        return w_str
+
+    def read_value(self):
+        return self.build(self.reader.next())
+
+    def build(self, event):
+        reader = self.reader
+        if event == EVENT_NULL:
+            return json_null
+        if event == EVENT_TRUE:
+            return json_true
+        if event == EVENT_FALSE:
+            return json_false
+        if event == EVENT_INT:
+            return JsonInt(reader.int_value)
+        if event == EVENT_FLOAT:
+            return JsonFloat(reader.float_value)
+        if event == EVENT_STRING:
+            return self.make_string(reader.string_value)
+        if event == EVENT_START_ARRAY:
+            lst = []
+            while True:
+                event = reader.next()
+                if event == EVENT_END_ARRAY:
+                    return JsonArray(lst)
+                lst.append(self.build(event))
+        if event == EVENT_START_OBJECT:
+            dct = {}
+            while True:
+                event = reader.next()
+                if event == EVENT_END_OBJECT:
+                    return JsonObject(dct)
+                assert event == EVENT_KEY
+                key = reader.key
+                dct[key] = self.read_value()
+        reader.error("Unexpected end of container")
+        assert 0
 
+    def finish(self):
+        if self.reader.next() != EVENT_EOF:
+            self.reader.error("Extra data")
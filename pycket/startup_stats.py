@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Where does the startup time go?
+#
+# With --startup-stats every startup phase (running the expander, reading its
+# output, converting it to an AST, normalization, assignment conversion, and
+# instantiating modules) is timed per module, and a report is printed when the
+# program exits. Phases nest: a module that is loaded while another one is
+# instantiated is not counted against the outer module. Every phase therefore
+# records its own time, and the phases add up to the total startup time.
+#
+# Besides wall-clock time, every phase records how much the resident memory of
+# the process grew, as an approximation of what it allocated.
+
+import os
+import time
+
+from rpython.rlib          import jit, streamio
+from rpython.rlib.jit      import Counters
+from rpython.rlib.listsort import make_timsort_class
+from rpython.rlib.objectmodel import we_are_translated
+from rpython.rlib.rfloat   import formatd
+
+class PhaseTimer(object):
+    def __init__(self, phase, module, start_time, start_memory):
+        self.phase = phase
+        self.module = module
+        self.start_time = start_time
+        self.start_memory = start_memory
+        self.child_time = 0.0
+        self.child_memory = 0
+
+class PhaseStats(object):
+    def __init__(self, phase, module):
+        self.phase = phase
+        self.module = module
+        self.time = 0.0
+        self.memory = 0
+        self.count = 0
+
+    def add(self, elapsed, memory):
+        self.time += elapsed
+        self.memory += memory
+        self.count += 1
+
+BasePhaseSorter = make_timsort_class()
+
+class PhaseSorter(BasePhaseSorter):
+    def lt(self, a, b):
+        # most expensive first
+        return a.time > b.time
+
+def memory_usage():
+    """ The resident memory of the process in kilobytes, or 0 if unknown """
+    try:
+        f = streamio.open_file_as_stream("/proc/self/status")
+        try:
+            data = f.readall()
+        finally:
+            f.close()
+    except (OSError, streamio.StreamError):
+        return 0
+    for line in data.split("\n"):
+        if line.startswith("VmRSS:"):
+            parts = line[len("VmRSS:"):].split()
+            if parts:
+                try:
+                    return int(parts[0])
+                except ValueError:
+                    return 0
+    return 0
+
+def jit_time():
+    """ Time spent tracing and compiling, if the JIT profiler is enabled """
+    if not we_are_translated():
+        return 0.0
+    from rpython.rlib import jit_hooks
+    return (jit_hooks.stats_get_times_value(None, Counters.TRACING) +
+            jit_hooks.stats_get_times_value(None, Counters.BACKEND))
+
+class StartupStats(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.json_file = ""
+        self.start_time = 0.0
+        self.start_memory = 0
+        self.entries = {}
+        self.stack = []
+
+    def enable(self, json_file=""):
+        self.enabled = True
+        self.json_file = json_file
+        self.start_time = time.time()
+        self.start_memory = memory_usage()
+
+    def start(self, phase, module):
+        timer = PhaseTimer(phase, module, time.time(), memory_usage())
+        self.stack.append(timer)
+        return timer
+
+    def stop(self, timer):
+        now = time.time()
+        memory = memory_usage()
+        # timers that were left open by an exception are dropped as well
+        while self.stack:
+            if self.stack.pop() is timer:
+                break
+        elapsed = now - timer.start_time
+        grown = memory - timer.start_memory
+        self.record(timer.phase, timer.module,
+                    elapsed - timer.child_time, grown - timer.child_memory)
+        if self.stack:
+            parent = self.stack[-1]
+            parent.child_time += elapsed
+            parent.child_memory += grown
+
+    def record(self, phase, module, elapsed, memory):
+        key = (phase, module)
+        entry = self.entries.get(key, None)
+        if entry is None:
+            entry = self.entries[key] = PhaseStats(phase, module)
+        entry.add(elapsed, memory)
+
+    def phase_totals(self):
+        totals = {}
+        for entry in self.entries.values():
+            total = totals.get(entry.phase, None)
+            if total is None:
+                total = totals[entry.phase] = PhaseStats(entry.phase, "")
+            total.time += entry.time
+            total.memory += entry.memory
+            total.count += entry.count
+        result = totals.values()
+        PhaseSorter(result).sort()
+        return result
+
+    def module_entries(self):
+        result = self.entries.values()
+        PhaseSorter(result).sort()
+        return result
+
+    def format_table(self):
+        total_time = time.time() - self.start_time
+        total_memory = memory_usage() - self.start_memory
+        lines = ["Startup statistics (%s ms, %d KB resident memory growth)" %
+                     (_ms(total_time), total_memory),
+                 "",
+                 _row("phase", "ms", "KB", "count")]
+        accounted = 0.0
+        for entry in self.phase_totals():
+            accounted += entry.time
+            lines.append(_row(entry.phase, _ms(entry.time), str(entry.memory),
+                              str(entry.count)))
+        lines.append(_row("other", _ms(total_time - accounted), "", ""))
+        jit_seconds = jit_time()
+        if jit_seconds > 0.0:
+            lines.append(_row("jit", _ms(jit_seconds), "", "") + "  (part of the phases above)")
+        lines.append("")
+        lines.append(_row("phase", "ms", "KB", "module"))
+        for entry in self.module_entries():
+            lines.append(_row(entry.phase, _ms(entry.time), str(entry.memory),
+                              entry.module))
+        lines.append("")
+        return "\n".join(lines)
+
+    def format_json(self):
+        total_time = time.time() - self.start_time
+        parts = ['{"total": %s, "jit": %s, "phases": [' % (_seconds(total_time),
+                                                          _seconds(jit_time()))]
+        entries = []
+        for entry in self.phase_totals():
+            entries.append('{"phase": %s, "time": %s, "memory": %d, "count": %d}' %
+                           (_json_string(entry.phase), _seconds(entry.time),
+                            entry.memory, entry.count))
+        parts.append(", ".join(entries))
+        parts.append('], "modules": [')
+        entries = []
+        for entry in self.module_entries():
+            entries.append('{"phase": %s, "module": %s, "time": %s, "memory": %d, "count": %d}' %
+                           (_json_string(entry.phase), _json_string(entry.module),
+                            _seconds(entry.time), entry.memory, entry.count))
+        parts.append(", ".join(entries))
+        parts.append(']}\n')
+        return "".join(parts)
+
+    def report(self):
+        if self.json_file:
+            try:
+                f = streamio.open_file_as_stream(self.json_file, "w")
+                try:
+                    f.write(self.format_json())
+                finally:
+                    f.close()
+            except (OSError, streamio.StreamError):
+                print "could not write startup statistics to %s" % self.json_file
+        else:
+            os.write(2, self.format_table())
+
+def _pad_right(s, width):
+    return s + " " * max(width - len(s), 0)
+
+def _pad_left(s, width):
+    return " " * max(width - len(s), 0) + s
+
+def _row(phase, ms, kb, last):
+    return "%s %s %s  %s" % (_pad_right(phase, 16), _pad_left(ms, 10),
+                             _pad_left(kb, 10), last)
+
+def _ms(seconds):
+    return formatd(seconds * 1000.0, 'f', 1)
+
+def _seconds(seconds):
+    return formatd(seconds, 'f', 6)
+
+_HEX_DIGITS = "0123456789abcdef"
+
+def _json_string(s):
+    result = ['"']
+    for c in s:
+        if c == '"' or c == '\\':
+            result.append('\\' + c)
+        elif ord(c) < 0x20:
+            result.append('\\u00' + _HEX_DIGITS[ord(c) >> 4] + _HEX_DIGITS[ord(c) & 0xf])
+        else:
+            result.append(c)
+    result.append('"')
+    return "".join(result)
+
+stats = StartupStats()
+
+def configure(config, names):
+    if config.get('startup-stats', False):
+        stats.enable(names.get('startup-stats-json', ""))
+
+@jit.dont_look_inside
+def start(phase, module):
+    """ Start timing `phase` of `module`, returns None unless enabled """
+    if not stats.enabled:
+        return None
+    return stats.start(phase, module)
+
+@jit.dont_look_inside
+def stop(timer):
+    if timer is not None:
+        stats.stop(timer)
+
+def report(config, env):
+    if stats.enabled:
+        stats.report()
@@ -8,7 +8,9 @@ from pycket.expand import parse_module
 from pycket.interpreter import (LexicalVar, ModuleVar, Done, CaseLambda,
                                 variable_set, variables_equal,
                                 Lambda, Letrec, Let, Quote, App, If, Begin,
-                                SimplePrimApp1, SimplePrimApp2,
+                                SimplePrimApp1, SimplePrimApp2, SimplePrimApp3,
+                                IfSimplePrim1, IfSimplePrim2, SimplePrimLet,
+                                KnownCallApp,
                                 WithContinuationMark, SetBang,
                                 )
 from pycket.test.testhelper import format_pycket_mod, run_mod
@@ -21,8 +23,17 @@ def make_symbols(d):
         v[ModuleVar(W_Symbol.make(i), None, W_Symbol.make(i))] = j
     return v
 
-def expr_ast(s):
-    m = parse_module(expand_string(format_pycket_mod(s, extra="(define x 0)")))
+def expr_ast(s, fold=None):
+    # tests that look at the shape of lets binding constants, which constant
+    # folding removes, pass fold=False
+    from pycket import config
+    old = config.constant_folding
+    if fold is not None:
+        config.constant_folding = fold
+    try:
+        m = parse_module(expand_string(format_pycket_mod(s, extra="(define x 0)")))
+    finally:
+        config.constant_folding = old
     return m.body[-1]
 
 def test_symlist_depth():
@@ -55,7 +66,7 @@ def test_cache_lambda_if_no_frees():
     assert w_cl1.closure._get_list(0).toplevel_env() is toplevel
 
 def test_env_structure_apps():
-    p = expr_ast("(let ([a 1] [b 2]) (+ a b))")
+    p = expr_ast("(let ([a 1] [b 2]) (+ a b))", fold=False)
     a = W_Symbol.make("a")
     b = W_Symbol.make("b")
     assert isinstance(p, Let)
@@ -83,7 +94,7 @@ def test_remove_let():
     p = expr_ast("(let ([g cons]) (g 5 5))")
     assert isinstance(p, Let)
 
-    p = expr_ast("(let ([a 1]) (if a + -))")
+    p = expr_ast("(let ([a 1]) (if a + -))", fold=False)
     assert isinstance(p, Let)
 
 def test_remove_simple_if():
@@ -95,21 +106,21 @@ def test_remove_simple_if():
 def test_remove_simple_begin():
     p = expr_ast("(begin #f #t)")
     assert isinstance(p, Quote) and p.w_val is w_true
-    p = expr_ast("(let ([a 1]) a a a)")
+    p = expr_ast("(let ([a 1]) a a a)", fold=False)
     assert isinstance(p, Let) and len(p.body) == 1
     p = expr_ast("(begin0 #t #f #f #f)")
     assert isinstance(p, Quote) and p.w_val is w_true
-    p = expr_ast("(let ([a 1]) (equal? 1 2) (let ([b 2]) (equal? 1 2) (let ([c 3]) (equal? 1 2) (begin (equal? b c) (equal? a b)))))")
+    p = expr_ast("(let ([a 1]) (equal? 1 2) (let ([b 2]) (equal? 1 2) (let ([c 3]) (equal? 1 2) (begin (equal? b c) (equal? a b)))))", fold=False)
     assert isinstance(p, Let)
     assert p.body[-1].body[-1]._sequenced_remove_num_envs == [0, 0, 1]
 
 def test_let_remove_num_envs():
-    p = expr_ast("(let ([b 1]) (let ([a (+ b 1)]) (sub1 a)))")
+    p = expr_ast("(let ([b 1]) (let ([a (+ b 1)]) (sub1 a)))", fold=False)
     assert isinstance(p, Let)
     assert p.remove_num_envs == [0, 0]
     assert p.body[0].remove_num_envs == [0, 1]
 
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a d))))")
+    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a d))))", fold=False)
     assert p.body[0].body[0].remove_num_envs == [0, 1, 2]
 
 def test_let_remove_num_envs_edge_case():
@@ -137,19 +148,19 @@ def test_let_remove_num_envs_edge_case():
     assert type(m.defs[d]) is W_Fixnum and m.defs[d].value == 3
 
 def test_copy_to_env():
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))")
+    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))", fold=False)
     inner_let = p.body[0].body[0]
     assert inner_let.remove_num_envs == [0, 0, 1, 2]
     assert len(inner_let.args.elems) == 3
     assert str(inner_let.args.elems[-3]).startswith('b')
 
     # can't copy env, because of the mutation
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (set! b (+ b 1)) (+ a b))))")
+    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (set! b (+ b 1)) (+ a b))))", fold=False)
     inner_let = p.body[0].body[0]
     assert inner_let.remove_num_envs == [0, 0, 0, 0]
 
     # can't copy env, because of the mutation
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (set! b (+ b 1)) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))")
+    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (set! b (+ b 1)) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))", fold=False)
     inner_let = p.body[0].body[0]
     assert inner_let._sequenced_remove_num_envs == [0, 1]
 
@@ -161,7 +172,7 @@ def test_prune_sequenced_body():
           (equal? d 1)
           (equal? b 1)
           (equal? c 1))))
-    """)
+    """, fold=False)
     inner_let = p.body[0].body[0]
     assert inner_let._sequenced_remove_num_envs == [0, 1, 2]
 
@@ -262,6 +273,226 @@ def test_simple_prim_calls_are_simple_expressions():
     p = expr_ast("(car (cons 1 2))")
     assert isinstance(p, SimplePrimApp1)
 
+def test_superinstructions():
+    p = expr_ast("(bytes-set! (make-bytes 3) 1 2)")
+    assert isinstance(p, SimplePrimApp3)
+
+    p = expr_ast("(if (zero? x) 1 2)")
+    assert isinstance(p, IfSimplePrim1)
+
+    p = expr_ast("(if (eq? x 1) (car 1) 2)")
+    assert isinstance(p, IfSimplePrim2)
+
+    p = expr_ast("(let ([y (cons x 1)]) (cons y y))")
+    assert isinstance(p, SimplePrimLet)
+    assert isinstance(p.body[0], SimplePrimApp2)
+
+def test_superinstructions_run():
+    m = run_mod("""
+    #lang pycket
+    (define (count n)
+      (let loop ([i 0] [acc '()])
+        (if (< i n)
+            (let ([j (* i i)])
+              (loop (+ i 1) (if (even? j) (cons j acc) acc)))
+            acc)))
+    (define b (make-bytes 2 0))
+    (bytes-set! b 1 7)
+    (define result (list (count 5) (bytes-ref b 1) (let ([v (void)]) (if (void? v) 1 2))))
+    """)
+    ov = m.defs[W_Symbol.make("result")]
+    assert ov.tostring() == "((16 4 0) 7 1)"
+
+def test_pure_prims_are_simple():
+    from pycket.prims.expose import PURE_PRIM_NAMES, prim_env
+    for name in PURE_PRIM_NAMES:
+        w_prim = prim_env[W_Symbol.make(name)]
+        assert w_prim.simple1 is not None or w_prim.simple2 is not None
+
+def test_constant_folding():
+    p = expr_ast("(fx+ (add1 1) 3)", fold=True)
+    assert isinstance(p, Quote) and p.w_val.value == 5
+
+    p = expr_ast("(if (zero? (sub1 1)) 'then 'else)", fold=True)
+    assert isinstance(p, Quote) and p.w_val is W_Symbol.make("then")
+
+    # errors are raised at run time
+    p = expr_ast("(car 1)", fold=True)
+    assert isinstance(p, SimplePrimApp1)
+
+    # impure primitives are not evaluated
+    p = expr_ast("(cons 1 2)", fold=True)
+    assert isinstance(p, SimplePrimApp2)
+
+def test_constant_propagation():
+    p = expr_ast("(let ([a 1]) (let ([b (add1 a)]) (if (fx< b x) b a)))", fold=True)
+    assert isinstance(p, IfSimplePrim2)
+    assert p.rand1.w_val.value == 2
+    assert isinstance(p.thn, Quote) and p.thn.w_val.value == 2
+    assert isinstance(p.els, Quote) and p.els.w_val.value == 1
+
+    # mutated variables are kept
+    p = expr_ast("(let ([a 1]) (set! a 2) a)", fold=True)
+    assert isinstance(p, Let)
+
+    # inner bindings shadow the constant
+    p = expr_ast("(let ([a 1]) (lambda (a) (add1 a)))", fold=True)
+    assert isinstance(p, CaseLambda)
+    assert isinstance(p.lams[0].body[0], SimplePrimApp1)
+
+def test_constant_folding_run():
+    m = run_mod("""
+    #lang pycket
+    (define (f y)
+      (let ([a 10] [b (fx* 2 3)])
+        (if (fx< b a) (fx+ y b) (fx- y a))))
+    (define result (list (f 1) (not (eq? 'a 'a)) (cadr '(1 2 3))))
+    """)
+    ov = m.defs[W_Symbol.make("result")]
+    assert ov.tostring() == "(7 #f 2)"
+
+def test_known_call():
+    from pycket.interpreter import BOUND, UNKNOWN
+    m = run_mod("""
+    #lang pycket
+    (define f (case-lambda [(a) a] [(a b) (+ a b)]))
+    (define h (lambda (a) a))
+    (set! h (lambda (a) (+ a 1)))
+    (define (call-f) (f 1 2))
+    (define (call-h) (h 1))
+    (define (call-later) (later 3))
+    (define later (lambda (a) (* a 2)))
+    (define result (list (call-f) (call-h) (call-later) (call-f)))
+    """)
+    def tail_call(name):
+        lam = m.defs[W_Symbol.make(name)].closure.caselam.lams[0]
+        app = lam.body[0]
+        assert isinstance(app, KnownCallApp)
+        return app
+    f_call = tail_call("call-f")
+    assert f_call.state == BOUND and f_call.lam_index == 1
+    assert f_call.w_closure is m.defs[W_Symbol.make("f")].closure
+    # mutated module variables are looked up on every call
+    h_call = tail_call("call-h")
+    assert h_call.state == UNKNOWN and h_call.w_closure is None
+    assert tail_call("call-later").state == BOUND
+    ov = m.defs[W_Symbol.make("result")]
+    assert ov.tostring() == "(3 2 6 3)"
+
+def test_lambda_lifting():
+    p = expr_ast("""
+    (lambda (n)
+      (let loop ([i 0])
+        (if (fx< i n) (loop (fx+ i 1)) i)))
+    """)
+    let = p.lams[0].body[0]
+    assert isinstance(let, Let)
+    loop = let.rhss[0]
+    assert isinstance(loop, CaseLambda)
+    assert not loop.any_frees
+    assert len(loop.lams[0].formals) == 2
+    call = let.body[0]
+    assert isinstance(call, App) and len(call.rands) == 2
+
+    # loop escapes
+    p = expr_ast("(lambda (n) (let loop ([i 0]) (if (fx< i n) loop i)))")
+    loop = p.lams[0].body[0].rhss[0]
+    assert loop.any_frees and len(loop.lams[0].formals) == 1
+
+    # n is mutated
+    p = expr_ast("""
+    (lambda (n)
+      (let loop ([i 0])
+        (set! n (fx- n 1))
+        (if (fx< i n) (loop (fx+ i 1)) i)))
+    """)
+    loop = p.lams[0].body[0].rhss[0]
+    assert loop.any_frees and len(loop.lams[0].formals) == 1
+
+def test_lambda_lifting_run():
+    m = run_mod("""
+    #lang pycket
+    (define (sum n)
+      (let loop ([i 0] [acc 0])
+        (if (< i n) (loop (+ i 1) (+ acc i)) acc)))
+    (define (count-even lst k)
+      (define (go lst acc)
+        (cond [(null? lst) acc]
+              [(even? (+ k (car lst))) (go (cdr lst) (add1 acc))]
+              [else (go (cdr lst) acc)]))
+      (go lst 0))
+    (define result (list (sum 10) (count-even '(1 2 3 4 5) 1)))
+    """)
+    ov = m.defs[W_Symbol.make("result")]
+    assert ov.tostring() == "(45 3)"
+
+def test_bytecode():
+    from pycket.bytecode import compile_lambda, NotCompilable
+    p = expr_ast("""
+    (lambda (n acc)
+      (let ([a (< n 1)])
+        (if a acc (f (- n 1) (car acc)))))
+    """)
+    body = compile_lambda(p.lams[0])
+    ops = [line.split()[1] for line in body.disassemble().splitlines()]
+    assert "PRIMN" in ops and "PRIM1" in ops
+    assert ops[-1] == "TAIL_CALL"
+    assert "RETURN" in ops
+    # a call that is not in tail position needs a continuation
+    p = expr_ast("(lambda (n) (car (f n)))")
+    with pytest.raises(NotCompilable):
+        compile_lambda(p.lams[0])
+
+def test_bytecode_run(monkeypatch):
+    from pycket import config
+    monkeypatch.setattr(config, "bytecode_interpreter", True)
+    m = run_mod("""
+    #lang pycket
+    (define (sum n)
+      (let loop ([i 0] [acc 0])
+        (if (< i n) (loop (+ i 1) (+ acc i)) acc)))
+    (define (classify x)
+      (let ([y (if (pair? x) (car x) x)])
+        (if (number? y) (* y 2) 'other)))
+    (define (safe-div a b)
+      (with-handlers ([exn:fail? (lambda (e) 'error)])
+        (quotient a b)))
+    (define (split x) (values x (add1 x)))
+    (define result
+      (list (sum 100) (classify '(4)) (classify "s") (safe-div 1 0)
+            (call-with-values (lambda () (split 1)) list)))
+    """)
+    ov = m.defs[W_Symbol.make("result")]
+    assert ov.tostring() == "(4950 8 other error (1 2))"
+
+def test_stack_continuations_run(monkeypatch):
+    from pycket import config
+    from pycket.native_stack import native_stack
+    monkeypatch.setattr(config, "stack_continuations", True)
+    m = run_mod("""
+    #lang pycket
+    (define (count n) (if (zero? n) 0 (add1 (count (sub1 n)))))
+    (define saved #f)
+    (define (reenter)
+      (let ([x (call/cc (lambda (k) (set! saved k) 1))])
+        (if (< x 3) (saved (add1 x)) x)))
+    (define (escape)
+      (let/ec k (let ([y (k 'escaped)]) 'not-reached)))
+    (define (marks)
+      (with-continuation-mark 'key 'outer
+        (let ([m (with-continuation-mark 'key 'inner
+                   (continuation-mark-set->list (current-continuation-marks) 'key))])
+          m)))
+    (define (safe-car x)
+      (with-handlers ([exn:fail? (lambda (e) 'error)])
+        (let ([v (car x)]) v)))
+    (define result
+      (list (count 200) (reenter) (escape) (marks) (safe-car 1)))
+    """)
+    ov = m.defs[W_Symbol.make("result")]
+    assert ov.tostring() == "(200 3 escaped (inner outer) error)"
+    assert native_stack.depth == 0
+
 def test_nested_lets():
     p = expr_ast("(let ([x (let ([y (equal? 1 2)]) y)]) (equal? #t x))")
     assert isinstance(p, Let)
@@ -613,6 +613,29 @@ def test_callgraph_reconstruction_through_primitives():
 
     assert env.callgraph.calls == {g: {f: None}, f: {h: None}}
 
+def test_callgraph_call_counts():
+    from pycket.expand    import expand_string, parse_module
+    from pycket           import config
+    from pycket.callgraph import SAMPLE_INTERVAL
+    str = """
+        #lang pycket
+        (define (f x) (g x))
+        (define (g x) (if (= x 0) 0 (f (- x 1))))
+        (f 1000)
+        """
+
+    ast = parse_module(expand_string(str))
+    env = ToplevelEnv(config.get_testing_config(**{"pycket.callgraph":True}))
+    m = interpret_module(ast, env)
+    f = m.defs[W_Symbol.make("f")].closure.caselam.lams[0]
+    g = m.defs[W_Symbol.make("g")].closure.caselam.lams[0]
+
+    # f calls g 1001 times, g calls f 1000 times
+    for calls, exact in [(env.callgraph.call_count(f, g), 1001),
+                         (env.callgraph.call_count(g, f), 1000)]:
+        assert exact - SAMPLE_INTERVAL < calls <= exact
+        assert calls % SAMPLE_INTERVAL == 0
+
 def test_should_enter_downrecursion():
     from pycket.expand import expand_string, parse_module
     from pycket        import config
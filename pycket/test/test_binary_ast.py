@@ -0,0 +1,114 @@
+import pytest
+from pycket.pycket_json import loads
+from pycket import binary_ast
+
+def _roundtrip(string):
+    json = loads(string)
+    data = binary_ast.dumps(json)
+    assert binary_ast.is_binary(data)
+    result = binary_ast.loads(data)
+    assert result._unpack_deep() == json._unpack_deep()
+    return result
+
+def test_simple():
+    _roundtrip("1")
+    _roundtrip("-1")
+    _roundtrip("0")
+    _roundtrip("\"abc\"")
+    _roundtrip("1.25")
+    _roundtrip("true")
+    _roundtrip("false")
+    _roundtrip("null")
+
+def test_large_ints():
+    import sys
+    _roundtrip(str(sys.maxint))
+    _roundtrip(str(-sys.maxint - 1))
+    _roundtrip("[127, 128, 16383, 16384, -64, -65]")
+
+def test_array():
+    _roundtrip("[]")
+    _roundtrip("[1, 2.0, 3.0, \"abc\", [10.0, \"def\"]]")
+
+def test_object():
+    _roundtrip("{}")
+    _roundtrip("{\"a\": 1, \"123\": \"ab\", \"subobj\": {\"d\": 12.0}, \"subarr\": [1]}")
+
+def test_escaped_string():
+    _roundtrip('"\\n\\t\\b\\f\\r\\\\"')
+    _roundtrip('"\\u00e9"')
+
+def test_strings_are_shared():
+    json = _roundtrip('[{"lexical": "x"}, {"lexical": "x"}]')
+    a, b = json.value_array()
+    assert a.value_object()["lexical"] is b.value_object()["lexical"]
+
+def test_srcloc():
+    _roundtrip('{"lambda": [], "body": [], "position": 1234, "line": 12, '
+               '"column": 0, "span": 99, "source": {"%p": "/tmp/foo.rkt"}}')
+
+def _events(reader):
+    from pycket import pycket_json as pj
+    events = []
+    while True:
+        event = reader.next()
+        payload = {pj.EVENT_KEY: reader.key, pj.EVENT_STRING: reader.string_value,
+                   pj.EVENT_INT: reader.int_value,
+                   pj.EVENT_FLOAT: reader.float_value}.get(event, None)
+        events.append((event, payload))
+        if event == pj.EVENT_EOF:
+            return events
+
+def test_events_match_json():
+    from pycket.pycket_json import JsonEventReader
+    string = ('{"module-name": "m", "body-forms": [{"lexical": "x"}, [], {}, '
+              '[1, -2, 3.5, null, true, false, "s", [[{"a": {"b": []}}]]]]}')
+    data = binary_ast.dumps(loads(string))
+    json_events = _events(JsonEventReader(string))
+    binary_events = _events(binary_ast.BinaryEventReader(data))
+    # objects are encoded in dict order
+    assert sorted(binary_events) == sorted(json_events)
+    assert len(binary_events) == len(json_events)
+    assert binary_events[0] == json_events[0]
+    assert binary_events[-1] == json_events[-1]
+
+def test_bad_data():
+    data = binary_ast.dumps(loads("[1, 2, 3]"))
+    with pytest.raises(binary_ast.BinaryFormatError):
+        binary_ast.loads(data[:-1])
+    with pytest.raises(binary_ast.BinaryFormatError):
+        binary_ast.loads(data + "\x00")
+    with pytest.raises(binary_ast.BinaryFormatError):
+        binary_ast.loads(binary_ast.MAGIC + chr(binary_ast.FORMAT_VERSION + 1))
+
+def test_file_roundtrip(tmpdir):
+    fname = str(tmpdir / "prog.rkt.bin")
+    json = loads('{"module-name": "prog", "body-forms": []}')
+    binary_ast.dump_file(fname, json)
+    assert binary_ast.is_current_file(fname)
+    with open(fname) as f:
+        assert binary_ast.loads(f.read())._unpack_deep() == json._unpack_deep()
+    assert not binary_ast.is_current_file(str(tmpdir / "missing.bin"))
+
+def test_bundle(tmpdir):
+    fname = str(tmpdir / "prog.rkt.bundle.bin")
+    names = ["/tmp/a.rkt", "/tmp/b.rkt"]
+    modules = [loads('{"module-name": "a", "body-forms": [1, 2]}'),
+               loads('{"module-name": "b", "body-forms": ["x"]}')]
+    binary_ast.write_file(fname, binary_ast.dump_bundle(names, modules))
+    assert binary_ast.is_current_bundle(fname)
+    assert not binary_ast.is_current_file(fname)
+
+    bundle = binary_ast.ModuleBundle(fname)
+    assert sorted(bundle.module_names()) == names
+    assert bundle.has_module("/tmp/b.rkt")
+    assert not bundle.has_module("/tmp/c.rkt")
+    for name, mod in zip(names, modules):
+        assert bundle.get_module(name)._unpack_deep() == mod._unpack_deep()
+    bundle.close()
+
+def test_empty_bundle(tmpdir):
+    fname = str(tmpdir / "empty.bin")
+    binary_ast.write_file(fname, binary_ast.dump_bundle([], []))
+    bundle = binary_ast.ModuleBundle(fname)
+    assert bundle.module_names() == []
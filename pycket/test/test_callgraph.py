@@ -0,0 +1,76 @@
+from pycket.callgraph import (CallGraph, LOOP_HEADER, LOOP_PARTICIPANT,
+                              SAMPLE_INTERVAL)
+
+class FakeLambda(object):
+    def __init__(self, name):
+        self.name = name
+        self.jitting = False
+
+    def enable_jitting(self):
+        self.jitting = True
+
+class FakeApp(object):
+    def __init__(self, lam):
+        self.surrounding_lambda = lam
+
+class FakeCont(object):
+    def get_next_executed_ast(self):
+        return None
+
+def call(graph, caller, callee, times=1):
+    for i in range(times):
+        graph.register_call(callee, FakeApp(caller), FakeCont(), None)
+
+def test_sampled_counts():
+    graph = CallGraph()
+    f, g = FakeLambda("f"), FakeLambda("g")
+    call(graph, f, g, SAMPLE_INTERVAL * 3)
+    assert graph.call_count(f, g) == SAMPLE_INTERVAL * 3
+    assert graph.call_count(g, f) == 0
+    call(graph, g, f)
+    assert graph.edges() != []
+    assert sorted([count for _, _, count in graph.edges()]) == [0, SAMPLE_INTERVAL * 3]
+
+def test_header_closes_the_cycle():
+    graph = CallGraph()
+    f, g, h = FakeLambda("f"), FakeLambda("g"), FakeLambda("h")
+    call(graph, f, g, 100)
+    call(graph, g, h, 5)
+    call(graph, h, f)
+    assert graph.recursive[h] == LOOP_HEADER
+    assert h.jitting and not g.jitting
+
+def test_prefer_hot_headers():
+    graph = CallGraph()
+    graph.prefer_hot_headers = True
+    f, g, h = FakeLambda("f"), FakeLambda("g"), FakeLambda("h")
+    call(graph, f, g, 100)
+    call(graph, g, h, 5)
+    call(graph, h, f)
+    # f -> g is the hottest edge of the cycle
+    assert graph.recursive[g] == LOOP_HEADER
+    assert graph.recursive[h] == LOOP_PARTICIPANT
+    assert graph.recursive[f] == LOOP_PARTICIPANT
+    assert g.jitting and not h.jitting
+
+def test_to_json():
+    class FakeSourceInfo(object):
+        sourcefile, line, column, position = "a.rkt", 1, 2, 0
+    graph = CallGraph()
+    f, g = FakeLambda("f"), FakeLambda("g")
+    f.sourceinfo = g.sourceinfo = FakeSourceInfo()
+    call(graph, f, g, SAMPLE_INTERVAL)
+    data = graph.to_json()._unpack_deep()
+    assert data["sample_interval"] == SAMPLE_INTERVAL
+    assert data["edges"] == [{"from": 0, "to": 1, "calls": SAMPLE_INTERVAL}]
+    assert [node["srcloc"] for node in data["nodes"]] == ["a.rkt:1:2"] * 2
+    assert [node["status"] for node in data["nodes"]] == ["none"] * 2
+
+def test_ping_pong_counts_both_edges():
+    graph = CallGraph()
+    f, g = FakeLambda("f"), FakeLambda("g")
+    for i in range(SAMPLE_INTERVAL * 10):
+        call(graph, f, g)
+        call(graph, g, f)
+    assert graph.call_count(f, g) == SAMPLE_INTERVAL * 10
+    assert graph.call_count(g, f) == SAMPLE_INTERVAL * 10
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pycket import values
+from pycket.dead_definitions import (
+    DeadDefinitionEliminator, IncompleteReferences, eliminate_dead_definitions)
+from pycket.expand import expand_string, parse_module
+from pycket.interpreter import DefineValues, ModuleVar
+from pycket.test.testhelper import format_pycket_mod, run_ast
+
+LIB = """
+    (module lib pycket
+      (provide used unused data)
+      (define (helper x) (+ x 1))
+      (define (used x) (helper x))
+      (define (unused x) (* x 2))
+      (define data '(1 2 3)))
+    (require (submod "." lib))
+"""
+
+def mod(s, lazy=False):
+    return parse_module(expand_string(format_pycket_mod(s)), lazy_lambda_bodies=lazy)
+
+def defined_names(module):
+    return [name.variable_name() for form in module.body
+            if isinstance(form, DefineValues) for name in form.names]
+
+def test_unreferenced_definitions_are_removed():
+    m = mod(LIB + "(define result (used 41))")
+    assert eliminate_dead_definitions(m) >= 2
+    lib = m.resolve_submodule_path(["lib"])
+    names = defined_names(lib)
+    assert "used" in names and "helper" in names
+    assert "unused" not in names and "data" not in names
+    assert values.W_Symbol.make("unused") not in lib.defs
+    m = run_ast(m)
+    assert m.defs[values.W_Symbol.make("result")].value == 42
+
+def test_main_module_definitions_are_kept():
+    m = mod(LIB + "(define (f) 1) (define result 0)")
+    eliminate_dead_definitions(m)
+    assert defined_names(m) == ["f", "result"]
+
+def test_variable_reference_keeps_module():
+    m = mod("""
+        (module lib pycket
+          (provide unused ref)
+          (define (unused x) x)
+          (define ref (#%variable-reference)))
+        (require (submod "." lib))
+        (define result ref)
+    """)
+    eliminate_dead_definitions(m)
+    assert "unused" in defined_names(m.resolve_submodule_path(["lib"]))
+
+def test_lazy_bodies_disable_elimination():
+    m = mod(LIB + "(define result (used 41))", lazy=True)
+    assert eliminate_dead_definitions(m) == 0
+    assert "unused" in defined_names(m.resolve_submodule_path(["lib"]))
+
+def test_unknown_module_disables_elimination():
+    m = mod(LIB + "(define result (used 41))")
+    sym = values.W_Symbol.make("x")
+    var = ModuleVar(sym, "/not/loaded.rkt", sym, [])
+    with pytest.raises(IncompleteReferences):
+        DeadDefinitionEliminator(m).resolve(var, m)
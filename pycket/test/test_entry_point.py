@@ -157,6 +157,74 @@ class TestOptions(object):
         assert names1['multiple-modules'] == f_name
         assert args1 == []
 
+    def test_cache_options(self, empty_json):
+        argv = ['arg0', '--cache-dir', '/tmp/cache', '--cache-size', '10', empty_json]
+        config, names, args, retval = parse_args(argv)
+        assert retval == 0
+        assert names['cache-dir'] == '/tmp/cache'
+        assert names['cache-size'] == '10'
+        assert names['file'] == empty_json
+        assert config.get('expansion-cache', True)
+
+        argv = ['arg0', '--no-expansion-cache', empty_json]
+        config, names, args, retval = parse_args(argv)
+        assert retval == 0
+        assert not config['expansion-cache']
+
+        config, names, args, retval = parse_args(['arg0', '--expand-jobs', '4', empty_json])
+        assert retval == 0
+        assert names['expand-jobs'] == '4'
+
+        config, names, args, retval = parse_args(['arg0', '--cache-dir'])
+        assert retval == 5
+
+    def test_eliminate_dead_definitions_option(self, empty_json):
+        config, names, args, retval = parse_args(['arg0', empty_json])
+        assert not config.get('eliminate-dead-definitions', False)
+        argv = ['arg0', '--eliminate-dead-definitions', empty_json]
+        config, names, args, retval = parse_args(argv)
+        assert retval == 0
+        assert config['eliminate-dead-definitions']
+
+    def test_startup_stats_options(self, empty_json):
+        config, names, args, retval = parse_args(['arg0', '--startup-stats', empty_json])
+        assert retval == 0
+        assert config['startup-stats']
+        assert 'startup-stats-json' not in names
+
+        argv = ['arg0', '--startup-stats-json', 'stats.json', empty_json]
+        config, names, args, retval = parse_args(argv)
+        assert retval == 0
+        assert config['startup-stats']
+        assert names['startup-stats-json'] == 'stats.json'
+        assert names['file'] == empty_json
+
+    def test_profile_options(self, empty_json):
+        config, names, args, retval = parse_args(['arg0', '--profile', empty_json])
+        assert retval == 0
+        assert config['profile']
+        assert 'profile-output' not in names
+
+        argv = ['arg0', '--profile-output', 'out.folded', empty_json]
+        config, names, args, retval = parse_args(argv)
+        assert retval == 0
+        assert config['profile']
+        assert names['profile-output'] == 'out.folded'
+
+    def test_jit_stats_option(self, empty_json):
+        config, names, args, retval = parse_args(['arg0', '--jit-stats', empty_json])
+        assert retval == 0
+        assert config['jit-stats']
+        assert names['file'] == empty_json
+
+    def test_callgraph_options(self, empty_json):
+        argv = ['arg0', '--save-callgraph-json', 'cg.json', '--callgraph-hot-headers', empty_json]
+        config, names, args, retval = parse_args(argv)
+        assert retval == 0
+        assert names['save-callgraph-json'] == 'cg.json'
+        assert config['callgraph-hot-headers']
+        assert not config.get('save-callgraph', False)
+
 class TestCommandline(object):
     """These are quire similar to TestOptions but targeted at the higher level
     entry_point interface. At that point, we only have the program exit code.
@@ -179,6 +247,17 @@ class TestCommandline(object):
         assert entry_point(
             ['arg0', empty_json, '--jit', 'trace_limit=13000']) == 0
 
+    def test_module_bundle(self, tmpdir):
+        import os
+        from pycket import binary_ast
+        from pycket.pycket_json import loads
+        prog = os.path.realpath(str(tmpdir / "prog.rkt"))
+        module = loads('{"module-name": "prog", "body-forms": [], "language": []}')
+        bundle = prog + ".bundle.bin"
+        binary_ast.write_file(bundle, binary_ast.dump_bundle([prog], [module]))
+        # the module is looked up under the name without the .bundle.bin
+        assert entry_point(['arg0', '-c', bundle]) == 0
+
     def test_eval(self, capfd):
         printval = 42
         assert entry_point(['arg0', '-e', '(display "%s")' % printval]) == 0
@@ -0,0 +1,54 @@
+import os
+import socket
+import threading
+import pytest
+from pycket.expander_client import ExpanderClient, ExpanderError, parse_response
+
+def test_parse_response():
+    assert parse_response("ok 2\n[]") == "[]"
+    assert parse_response("ok 0\n") == ""
+    with pytest.raises(ExpanderError):
+        parse_response("error 3\nbad")
+    # truncated or malformed responses mean the server is unusable
+    assert parse_response("ok 5\n[]") is None
+    assert parse_response("ok\n[]") is None
+    assert parse_response("") is None
+
+def serve_once(path, response):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    requests = []
+    def run():
+        conn, _ = server.accept()
+        data = ""
+        while not data.endswith("\n"):
+            data += conn.recv(1024)
+        requests.append(data)
+        conn.sendall(response)
+        conn.close()
+        server.close()
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, requests
+
+def test_expand(tmpdir):
+    path = str(tmpdir / "expander.sock")
+    thread, requests = serve_once(path, 'ok 18\n{"body-forms": []}')
+    client = ExpanderClient(path)
+    assert client.available()
+    assert client.expand("/tmp/prog.rkt") == '{"body-forms": []}'
+    thread.join()
+    assert requests == ["expand /tmp/prog.rkt\n"]
+
+def test_expand_error(tmpdir):
+    path = str(tmpdir / "expander.sock")
+    thread, requests = serve_once(path, "error 4\noops")
+    with pytest.raises(ExpanderError):
+        ExpanderClient(path).expand("/tmp/prog.rkt")
+    thread.join()
+
+def test_no_server(tmpdir):
+    client = ExpanderClient(str(tmpdir / "missing.sock"))
+    assert not client.available()
+    assert client.expand("/tmp/prog.rkt") is None
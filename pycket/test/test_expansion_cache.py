@@ -0,0 +1,149 @@
+import os
+import pytest
+from pycket.pycket_json import loads
+from pycket.expansion_cache import ExpansionCache, collect_dependencies, make_expansion_cache
+from pycket import binary_ast
+
+MODULE = """{"module-name": "prog", "body-forms": [
+  {"require": [["%s"], ["#%%kernel"], ["."]]},
+  {"module-name": "sub", "body-forms": [{"require": [["%s", "sub"]]}]}]}"""
+
+def make_module(tmpdir):
+    dep1 = tmpdir / "dep1.rkt"
+    dep1.write("#lang racket/base")
+    dep2 = tmpdir / "dep2.rkt"
+    dep2.write("#lang racket/base")
+    prog = tmpdir / "prog.rkt"
+    prog.write("#lang racket/base (require \"dep1.rkt\")")
+    json = loads(MODULE % (dep1, dep2))
+    return str(prog), str(dep1), str(dep2), json
+
+def test_collect_dependencies(tmpdir):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    deps = {}
+    collect_dependencies(json, deps)
+    assert sorted(deps.keys()) == sorted([dep1, dep2])
+
+def test_store_and_lookup(tmpdir):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    assert cache.ensure_directory()
+    assert cache.lookup(prog, False) is None
+
+    entry = cache.store(prog, False, json)
+    assert entry is not None
+    with open(entry) as f:
+        assert binary_ast.loads(f.read())._unpack_deep() == json._unpack_deep()
+
+    assert ExpansionCache(cache.directory, 1024 * 1024).lookup(prog, False) == entry
+    # the bytecode expansion is cached separately
+    assert cache.lookup(prog, True) is None
+
+def test_invalidation(tmpdir):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    assert cache.ensure_directory()
+    entry = cache.store(prog, False, json)
+
+    # touching a file does not invalidate the entry
+    os.utime(prog, None)
+    assert ExpansionCache(cache.directory, 1024 * 1024).lookup(prog, False) == entry
+
+    # changing a dependency does
+    with open(dep2, "a") as f:
+        f.write(" ")
+    assert ExpansionCache(cache.directory, 1024 * 1024).lookup(prog, False) is None
+
+    # and so does changing the source itself
+    cache = ExpansionCache(cache.directory, 1024 * 1024)
+    cache.store(prog, False, json)
+    with open(prog, "a") as f:
+        f.write(" ")
+    assert ExpansionCache(cache.directory, 1024 * 1024).lookup(prog, False) is None
+
+def test_syntax_dependencies(tmpdir):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    json = loads("""{"module-name": "prog", "body-forms": [
+      {"require": [["%s"]], "require-for-syntax": [["%s"], ["#%%kernel"]]}]}""" % (dep1, dep2))
+    deps = {}
+    collect_dependencies(json, deps)
+    assert sorted(deps.keys()) == sorted([dep1, dep2])
+
+def test_transitive_invalidation(tmpdir):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    dep3 = tmpdir / "dep3.rkt"
+    dep3.write("#lang racket/base")
+    dep1_json = loads("""{"module-name": "dep1", "body-forms": [{"require": [["%s"]]}]}""" % dep3)
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    assert cache.ensure_directory()
+    # the module is stored before its dependency
+    entry = cache.store(prog, False, json)
+    cache.store(dep1, False, dep1_json)
+    assert ExpansionCache(cache.directory, 1024 * 1024).lookup(prog, False) == entry
+
+    # changing a dependency of a dependency invalidates the entry
+    dep3.write(" ", mode="a")
+    cache = ExpansionCache(cache.directory, 1024 * 1024)
+    assert cache.lookup(dep1, False) is None
+    assert cache.lookup(prog, False) is None
+
+    cache.store(dep1, False, dep1_json)
+    entry = cache.store(prog, False, json)
+    assert ExpansionCache(cache.directory, 1024 * 1024).lookup(prog, False) == entry
+
+def test_store_keeps_unrelated_dependency_hashes(tmpdir):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    dep1_json = loads("""{"module-name": "dep1", "body-forms": []}""")
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    assert cache.ensure_directory()
+    cache.store(prog, False, json)
+    cache.dependency_hash(prog, False)
+    assert prog in cache.dependency_hashes and dep2 in cache.dependency_hashes
+    cache.store(dep1, False, dep1_json)
+    # the hash of prog includes the one of dep1, which changed
+    assert dep2 in cache.dependency_hashes
+    assert prog not in cache.dependency_hashes
+    assert ExpansionCache(cache.directory, 1024 * 1024).lookup(prog, False) is not None
+
+def test_eviction_lists_directory_once(tmpdir, monkeypatch):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    listed = []
+    listdir = os.listdir
+    def counting_listdir(path):
+        listed.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, "listdir", counting_listdir)
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    assert cache.ensure_directory()
+    cache.store(prog, False, json)
+    cache.store(dep1, False, loads("""{"module-name": "dep1", "body-forms": []}"""))
+    cache.store(dep2, False, loads("""{"module-name": "dep2", "body-forms": []}"""))
+    assert len(listed) == 1
+
+def test_eviction(tmpdir):
+    prog, dep1, dep2, json = make_module(tmpdir)
+    directory = tmpdir / "cache"
+    cache = ExpansionCache(str(directory), 1)
+    assert cache.ensure_directory()
+    old = directory / "old.bin"
+    old.write("x" * 100)
+    os.utime(str(old), (0, 0))
+    entry = cache.store(prog, False, json)
+    assert not old.check()
+    # the new entry survives even though it is larger than the cache
+    assert cache.lookup(prog, False) == entry
+
+def test_make_expansion_cache(tmpdir):
+    directory = str(tmpdir / "a" / "b")
+    cache = make_expansion_cache({}, {'cache-dir': directory, 'cache-size': '5'})
+    assert cache.directory == directory
+    assert cache.max_size == 5 * 1024 * 1024
+    assert os.path.isdir(directory)
+    assert make_expansion_cache({'expansion-cache': False}, {'cache-dir': directory}) is None
+
+def test_module_entry(tmpdir):
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    entry = cache.directory + "/abc-def.bin"
+    assert cache.module_entry(entry) == cache.directory + "/abc-def.ast"
+    assert cache.module_entry(str(tmpdir / "prog.rkt.bin")) is None
+    assert cache.module_entry(cache.directory + "/abc.deps") is None
@@ -432,6 +432,26 @@ def test_persistent_hash_collisions2():
     for k, v in acc.iteritems():
         assert acc.val_at(k, None) is v
 
+def test_persistent_hash_entries_with_hash():
+    HashTable = make_persistent_hash_type(hashfun=lambda x: r_uint(x % 40))
+    acc = HashTable.EMPTY
+    for i in range(400):
+        acc = acc.assoc(i, -i)
+    for h in range(40):
+        entries = sorted(acc.entries_with_hash(r_uint(h)))
+        assert entries == [(k, -k) for k in range(h, 400, 40)]
+    assert acc.entries_with_hash(r_uint(41)) == []
+
+    def equal(a, b):
+        assert False, "distinct hashes need no key comparison"
+    HashTable = make_persistent_hash_type(hashfun=lambda x: r_uint(x * 2654435761), equal=equal)
+    acc = HashTable.EMPTY
+    for i in range(1000):
+        acc = acc.assoc(i, i)
+    for i in range(1000):
+        assert acc.entries_with_hash(r_uint(i * 2654435761)) == [(i, i)]
+    assert HashTable.EMPTY.entries_with_hash(r_uint(1)) == []
+
 def test_persistent_hash_removal():
     HashTable = make_persistent_hash_type()
     acc = HashTable.EMPTY
@@ -545,3 +565,193 @@ def test_hash_iterate_functions(doctest):
     > (hash-iterate-next equal-table3 (hash-iterate-first equal-table3))
     #f
     """
+
+def test_immutable_equal_hash(doctest):
+    """
+    ! (define h (hash (vector-immutable 1 2) 'a "x" 'b (box-immutable 3) 'c))
+    ! (define v (chaperone-vector (vector 1 2) (lambda (v i x) x) (lambda (v i x) x)))
+    > (hash-ref h (vector 1 2))
+    'a
+    > (hash-ref h (string #\\x))
+    'b
+    > (hash-ref h (box 3))
+    'c
+    > (hash-ref h v)
+    'a
+    > (hash-count (hash-remove h v))
+    2
+    > (hash-ref (hash-set h v 'd) (vector 1 2))
+    'd
+    > (hash-count (hash-set h v 'd))
+    3
+    > (hash-ref (hash-set h (vector 3) 'e) (vector 3))
+    'e
+    > (hash-ref (hash-set h (vector v) 'e) (vector (vector 1 2)))
+    'e
+    > (hash-ref (hash-remove h "x") "x" #f)
+    #f
+    > (hash-ref (make-immutable-hash (list (cons v 1))) (vector 1 2))
+    1
+    """
+
+def test_immutable_equal_hash_mutable_keys(doctest):
+    """
+    ! (define b (box 1))
+    ! (define h (hash b 1 2 2))
+    ! (set-box! b (chaperone-box (box 0) (lambda (b v) v) (lambda (b v) v)))
+    > (hash-ref h 2)
+    2
+    > (hash-ref h (box (box 0)) #f)
+    1
+    """
+
+def test_immutable_equal_hash_direct_keys():
+    from pycket.hash.equal import (
+        W_EqualImmutableHashTable, is_direct_key, make_immutable_equal_table)
+    from pycket.values_string import W_String
+    key = values.W_Cons.make(values.W_Fixnum(1), W_String.fromstr_utf8("a"))
+    same = values.W_Cons.make(values.W_Fixnum(1), W_String.fromstr_utf8("a"))
+    assert is_direct_key(key)
+    table = make_immutable_equal_table([key], [values.w_true])
+    assert isinstance(table, W_EqualImmutableHashTable)
+    assert table.val_at(same, None) is values.w_true
+
+    cell = values.W_MCons(values.W_Fixnum(1), values.w_null)
+    cell.set_cdr(cell)
+    assert not is_direct_key(cell)
+    table = make_immutable_equal_table([cell], [values.w_true])
+    assert not isinstance(table, W_EqualImmutableHashTable)
+
+    box = values.W_MBox(values.W_Fixnum(1))
+    assert not is_direct_key(box)
+    assert is_direct_key(values.W_IBox(values.W_Fixnum(1)))
+
+def test_weak_hash(doctest):
+    """
+    ! (define wh (make-weak-hash))
+    ! (define weq (make-weak-hasheq))
+    ! (define key (list 1 2))
+    ! (hash-set! wh key 'a)
+    ! (hash-set! wh (list 1 2) 'b)
+    ! (hash-set! weq key 'a)
+    ! (hash-set! weq 1 'c)
+    > (hash-weak? wh)
+    #t
+    > (hash-weak? (make-hash))
+    #f
+    > (hash-ref wh (list 1 2))
+    'b
+    > (hash-count wh)
+    1
+    > (hash-ref weq key)
+    'a
+    > (hash-ref weq (list 1 2) #f)
+    #f
+    > (hash-ref weq 1)
+    'c
+    > (begin (hash-remove! weq key) (hash-count weq))
+    1
+    > (hash-ref (make-late-weak-hasheq (list (cons 'x 1))) 'x)
+    1
+    """
+
+def test_weak_hash_collects_keys():
+    import gc
+    from pycket.hash.weak import W_WeakEqHashTable
+    table = W_WeakEqHashTable()
+    keys = [values.W_Cons.make(values.W_Fixnum(i), values.w_null) for i in range(20)]
+    for key in keys:
+        table._set(key, values.w_true)
+    table._set(values.W_Fixnum(42), values.w_false)
+    assert table.length() == 21
+    del keys[:10]
+    gc.collect()
+    assert table.length() == 11
+    assert len(table.hash_items()) == 11
+    first = table.hash_iterate_first()
+    assert table.get_item(first)[0] is keys[0]
+    # dead entries are dropped when the table grows
+    for i in range(20):
+        table._set(values.W_Cons.make(values.W_Fixnum(i), values.w_null), values.w_true)
+    gc.collect()
+    table._set(values.W_Fixnum(43), values.w_false)
+    assert table.length() == 12
+    assert len(table.entries) < 30
+
+def test_equal_hash_code(doctest):
+    """
+    ! (struct p (x y) #:transparent)
+    ! (define h (make-hash))
+    ! (hash-set! h (p 1 (vector 2 "x")) 'a)
+    ! (define v (chaperone-vector (vector 1 2) (lambda (v i x) x) (lambda (v i x) x)))
+    ! (define i (impersonate-vector (vector 1 2) (lambda (v i x) x) (lambda (v i x) x)))
+    > (= (equal-hash-code (list 1 (vector 2 "x"))) (equal-hash-code (list 1 (vector 2 (string #\\x)))))
+    #t
+    > (= (equal-hash-code v) (equal-hash-code (vector 1 2)))
+    #t
+    > (begin (hash-set! h i 'b) (hash-ref h i #f))
+    'b
+    > (= (equal-secondary-hash-code (box 1)) (equal-secondary-hash-code (box 1)))
+    #t
+    > (hash-ref h (p 1 (vector 2 (string #\\x))) #f)
+    'a
+    > (fixnum? (equal-hash-code (vector->list (make-vector 100000 1))))
+    #t
+    """
+
+def test_impersonated_keys(doctest):
+    """
+    ! (define (imp v) (impersonate-vector v (lambda (v i x) x) (lambda (v i x) x)))
+    ! (define h (make-hash))
+    ! (hash-set! h (imp (vector 1 2)) 'a)
+    ! (hash-set! h (list 3 (vector 4)) 'b)
+    ! (define w (make-weak-hash))
+    ! (hash-set! w (vector 1 2) 'a)
+    ! (define ph (hash (vector-immutable 1 2) 'a))
+    ! (define ih (hash 1 'a (list 3 (imp (vector 4))) 'b))
+    > (hash-ref h (vector 1 2) #f)
+    'a
+    > (hash-ref h (list 3 (imp (vector 4))) #f)
+    'b
+    > (begin (hash-set! h (vector 1 2) 'c) (list (hash-count h) (hash-ref h (imp (vector 1 2)))))
+    '(2 c)
+    > (hash-ref w (imp (vector 1 2)) #f)
+    'a
+    > (hash-ref ph (imp (vector 1 2)) #f)
+    'a
+    > (hash-ref ih (list 3 (vector 4)) #f)
+    'b
+    """
+
+def test_equal_hash_budget():
+    from pycket.hash.equal import equal_hash
+    from pycket.vector import W_Vector
+    elems = [values.W_Fixnum(i) for i in range(100000)]
+    assert equal_hash(values.to_list(elems)) == equal_hash(values.to_list(elems + elems))
+    cycle = values.W_MCons(values.W_Fixnum(1), values.w_null)
+    cycle.set_cdr(cycle)
+    equal_hash(cycle)
+    vector = W_Vector.fromelements(elems, immutable=True)
+    assert equal_hash(vector) == equal_hash(W_Vector.fromelements(elems))
+
+def test_compact_storage():
+    from pycket.hash.equal import CompactStorage
+    storage = CompactStorage()
+    for i in range(100):
+        # many colliding hashes
+        storage.append(i % 7, values.W_Fixnum(i), values.W_Fixnum(-i))
+    assert storage.length() == 100
+    assert len(storage.index) >= 150
+    assert storage.lookup(3) == range(3, 100, 7)
+    assert storage.lookup(12) == []
+    assert [w_key.value for w_key in storage.keys] == range(100)
+
+def test_compact_storage_unhashable():
+    from pycket.hash.equal import CompactStorage, UNHASHABLE_TAG
+    storage = CompactStorage()
+    storage.append(6, values.W_Fixnum(0), values.w_false)
+    storage.append(UNHASHABLE_TAG, values.W_Fixnum(1), values.w_false)
+    storage.append(8, values.W_Fixnum(2), values.w_false)
+    assert storage.candidates(6) == [0, 1]
+    assert storage.candidates(10) == [1]
+    assert storage.candidates(UNHASHABLE_TAG) == [0, 1, 2]
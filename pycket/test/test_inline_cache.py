@@ -0,0 +1,40 @@
+from pycket import inline_cache
+from pycket.inline_cache import CACHE_SIZE, CacheEntry, InlineCache
+
+def test_lookup_and_eviction():
+    cache = InlineCache()
+    keys = [object() for i in range(CACHE_SIZE + 1)]
+    for i, key in enumerate(keys):
+        cache.add(CacheEntry(key, i, None, True))
+    assert len(cache.entries) == CACHE_SIZE
+    # the oldest entry was dropped
+    assert cache.lookup(keys[0]) is None
+    assert cache.lookup(keys[-1]).lam_index == CACHE_SIZE
+
+def test_case_lambda_call_sites():
+    from pycket.test.testhelper import run_mod_expr
+    hits = inline_cache.stats.hits
+    result = run_mod_expr("""
+        (let ([f (case-lambda [(x) x] [(x y) (+ x y)] [(x . r) (length r)])])
+          (let loop ([i 0] [acc 0])
+            (if (< i 10)
+                (loop (+ i 1) (+ acc (f 1) (f 2 3) (f 1 2 3 4)))
+                acc)))
+    """, wrap=True)
+    assert result.value == 90
+    assert inline_cache.stats.hits > hits
+
+def test_closure_as_env_call_sites():
+    from pycket.test.testhelper import run_mod_expr
+    hits = inline_cache.stats.hits
+    result = run_mod_expr("""
+        (let* ([n 2]
+               [f (lambda (x) (+ x n))]
+               [g (lambda (x . r) (+ x n (length r)))])
+          (let loop ([i 0] [acc 0])
+            (if (< i 10)
+                (loop (+ i 1) (+ acc (f 1) (g 1 2 3)))
+                acc)))
+    """, wrap=True)
+    assert result.value == 80
+    assert inline_cache.stats.hits > hits
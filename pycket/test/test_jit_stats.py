@@ -0,0 +1,28 @@
+from rpython.rlib.jit import Counters
+from pycket.jit_stats import JitStats
+
+def test_bridges_belong_to_their_loop():
+    stats = JitStats()
+    stats.record_loop(1, "(loop i) from (f 1)")
+    stats.record_loop(2, "(g x)")
+    stats.record_bridge(1, 10)
+    stats.record_bridge(1, 11)
+    stats.record_bridge(3, 12)
+    stats.record_guard_failures(10, 5)
+    stats.record_guard_failures(11, 7)
+    stats.record_guard_failures(99, 1)
+    loop = stats.locations["(loop i) from (f 1)"]
+    assert (loop.loops, loop.bridges, loop.guard_failures) == (1, 2, 12)
+    assert stats.locations["<unknown loop>"].bridges == 1
+    assert [e.location for e in stats.entries()] == [
+        "(loop i) from (f 1)", "<unknown loop>", "(g x)"]
+
+def test_format_table():
+    stats = JitStats()
+    stats.record_loop(1, "(g x)")
+    stats.record_abort("(h y)", Counters.ABORT_TOO_LONG)
+    stats.record_abort("(h y)", Counters.ABORT_TOO_LONG)
+    lines = stats.format_table().splitlines()
+    assert lines[3].split() == ["1", "0", "2", "0", "total"]
+    assert lines[4].split() == ["0", "0", "2", "0", "(h", "y)"]
+    assert "       2 abort_too_long" in lines
@@ -44,3 +44,60 @@ def test_bug():
             [{"quote" : { "string": "\\" }},{"quote" : { "string": "Hi" }}])
 
     _compare(r'{"string" : "\\\\"}', {"string": "\\\\"})
+
+def _events(string):
+    from pycket import pycket_json
+    reader = pycket_json.JsonEventReader(string)
+    events = []
+    while True:
+        event = reader.next()
+        if event == pycket_json.EVENT_EOF:
+            return events
+        if event == pycket_json.EVENT_KEY:
+            events.append(("key", reader.key))
+        elif event == pycket_json.EVENT_STRING:
+            events.append(("string", reader.string_value))
+        elif event == pycket_json.EVENT_INT:
+            events.append(("int", reader.int_value))
+        else:
+            events.append(event)
+
+def test_events():
+    from pycket import pycket_json as pj
+    assert _events('{"a": [1, "x"], "b": {}}') == [
+        pj.EVENT_START_OBJECT, ("key", "a"), pj.EVENT_START_ARRAY, ("int", 1),
+        ("string", "x"), pj.EVENT_END_ARRAY, ("key", "b"), pj.EVENT_START_OBJECT,
+        pj.EVENT_END_OBJECT, pj.EVENT_END_OBJECT]
+    assert _events(' [ ] ') == [pj.EVENT_START_ARRAY, pj.EVENT_END_ARRAY]
+    assert _events('null') == [pj.EVENT_NULL]
+
+def test_known_keys_are_interned():
+    from pycket import pycket_json as pj
+    reader = pj.JsonEventReader('{"source-name": 1}')
+    reader.next()
+    assert reader.next() == pj.EVENT_KEY
+    assert reader.key is pj.KNOWN_KEY_TABLE[(11, "s")][0]
+
+def test_unicode_escapes():
+    _compare('"\\u00e9"', u"\xe9".encode("utf-8"))
+    _compare('"\\ud83d\\ude00"', u"\U0001f600".encode("utf-8"))
+    _compare('{"\\u0061": 1}', {"a": 1})
+
+def test_numbers():
+    _compare("-12", -12)
+    _compare("[0, -0.5, 1e3]", [0, -0.5, 1000.0])
+
+def test_errors():
+    for string in ['[1,]', '[1 2]', '{"a" 1}', '{"a": 1,}', '[', '"abc', 'tru',
+                   '[1]]', '{1: 2}', '', '[1}', '{"a": 1]', '1e', '-.', '[1.2.3]']:
+        with pytest.raises(ValueError):
+            loads(string)
+
+def test_module_from_string():
+    from pycket.expand import JsonLoader, expand_string
+    from pycket.test.testhelper import format_pycket_mod
+    data = expand_string(format_pycket_mod("(define (f x) (+ x 1)) (f 2)"))
+    tree = JsonLoader().to_module(loads(data))
+    streamed = JsonLoader().to_module_from_string(data)
+    assert streamed.name == tree.name
+    assert [b.tostring() for b in streamed.body] == [b.tostring() for b in tree.body]
@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pycket import values
+from pycket.expand import expand_string, parse_module
+from pycket.interpreter import CaseLambda, DefineValues, LazyBody, ModuleVar
+from pycket.test.testhelper import format_pycket_mod, run_ast
+
+def lazy_mod(s):
+    return parse_module(expand_string(format_pycket_mod(s)), lazy_lambda_bodies=True)
+
+def run_lazy(s, name="result"):
+    m = run_ast(lazy_mod(s))
+    return m.defs[values.W_Symbol.make(name)]
+
+def lazy_lambda(m, name):
+    for form in m.body:
+        if isinstance(form, DefineValues) and form.names[0].variable_name() == name:
+            lam = form.rhs
+            assert isinstance(lam, CaseLambda)
+            body = lam.lams[0].body
+            assert len(body) == 1 and isinstance(body[0], LazyBody)
+            return body[0]
+    assert False
+
+def test_body_is_converted_on_first_call():
+    m = lazy_mod("""
+        (define (f x) (+ x 1))
+        (define (g x) (* x 2))
+        (define result (f 1))
+    """)
+    f = lazy_lambda(m, "f")
+    g = lazy_lambda(m, "g")
+    assert f.forced is None and g.forced is None
+    run_ast(m)
+    assert f.forced is not None
+    assert f.json is None
+    assert g.forced is None
+
+def test_closures():
+    result = run_lazy("""
+        (define (adder n) (lambda (x) (+ x n)))
+        (define result ((adder 40) 2))
+    """)
+    assert result.value == 42
+
+def test_free_variables():
+    m = lazy_mod("""
+        (define (f a b) (let ([c (+ a 1)]) (lambda (d) (+ a c d))))
+        (define result 0)
+    """)
+    f = lazy_lambda(m, "f")
+    # c and d are bound inside the body, the lambda removes its own arguments
+    assert sorted([v.variable_name() for v in f.frees.keys()]) == ["a"]
+    assert f.surrounding_lambda.frees.elems == []
+
+def test_mutated_free_variable():
+    result = run_lazy("""
+        (define (counter)
+          (let ([n 0])
+            (lambda () (set! n (+ n 1)) n)))
+        (define c (counter))
+        (define result (begin (c) (c) (c)))
+    """)
+    assert result.value == 3
+
+def test_mutated_module_variable():
+    m = lazy_mod("""
+        (define x 1)
+        (define (bump!) (set! x (+ x 1)))
+        (define result (begin (bump!) (bump!) x))
+    """)
+    bump = lazy_lambda(m, "bump!")
+    assert [v.srcsym.variable_name() for v in bump.muts.keys()
+            if isinstance(v, ModuleVar)] == ["x"]
+    m = run_ast(m)
+    assert m.defs[values.W_Symbol.make("result")].value == 3
+
+def test_recursion():
+    result = run_lazy("""
+        (define (fact n) (if (= n 0) 1 (* n (fact (- n 1)))))
+        (define result
+          (letrec ([even? (lambda (n) (if (= n 0) #t (odd? (- n 1))))]
+                   [odd? (lambda (n) (if (= n 0) #f (even? (- n 1))))])
+            (if (even? 10) (fact 5) 0)))
+    """)
+    assert result.value == 120
+
+def test_case_lambda():
+    result = run_lazy("""
+        (define f (case-lambda [(x) x] [(x y) (+ x y)] [(x . r) (length r)]))
+        (define result (+ (f 1) (f 2 3) (f 1 2 3 4)))
+    """)
+    assert result.value == 9
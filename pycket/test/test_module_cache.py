@@ -0,0 +1,94 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+from pycket import values, module_cache
+from pycket.expand import expand_string, parse_module, JsonLoader
+from pycket.expansion_cache import ExpansionCache
+from pycket.interpreter import Lambda, Let, SequencedBodyAST
+from pycket.test.testhelper import format_pycket_mod, run_ast
+
+def roundtrip(m):
+    return module_cache.loads(module_cache.dumps(m), None)
+
+def mod(s):
+    return parse_module(expand_string(format_pycket_mod(s)))
+
+def all_nodes(ast):
+    yield ast
+    for child in ast.direct_children():
+        for node in all_nodes(child):
+            yield node
+
+def test_roundtrip_tostring():
+    m = mod("""
+        (define (f x . rest) (let ([y (+ x 1)]) (set! y (* y 2)) (list y rest)))
+        (define g (case-lambda [(a) a] [(a b) (begin0 a b)]))
+        (define result (f 1 2 3))
+    """)
+    assert roundtrip(m).tostring() == m.tostring()
+
+def test_roundtrip_runs():
+    m = roundtrip(mod("""
+        (define (counter)
+          (let ([n 0])
+            (lambda () (set! n (+ n 1)) n)))
+        (define c (counter))
+        (define (fact n) (if (= n 0) 1 (* n (fact (- n 1)))))
+        (define result (+ (begin (c) (c) (c)) (fact 5)))
+    """))
+    m = run_ast(m)
+    assert m.defs[values.W_Symbol.make("result")].value == 123
+
+def test_quoted_values():
+    m = roundtrip(mod("""
+        (define result
+          (list 1 2.5 10000000000000000000000 1/3 1+2i 'sym "str" #:kw #\\a
+                '(1 . 2) #(1 2) #&3 #"bytes" #rx"a+" #px"b+" #hash((1 . 2))))
+    """))
+    m = run_ast(m)
+    result = m.defs[values.W_Symbol.make("result")]
+    assert result.tostring() == run_ast(mod("""
+        (define result
+          (list 1 2.5 10000000000000000000000 1/3 1+2i 'sym "str" #:kw #\\a
+                '(1 . 2) #(1 2) #&3 #"bytes" #rx"a+" #px"b+" #hash((1 . 2))))
+    """)).defs[values.W_Symbol.make("result")].tostring()
+
+def test_sharing_is_preserved():
+    m = mod("""
+        (define (f a b) (let ([c (+ a b)]) (lambda (d) (+ a c d))))
+        (define result 0)
+    """)
+    m2 = roundtrip(m)
+    envs = {}
+    for node in all_nodes(m2):
+        if isinstance(node, Lambda):
+            # the arguments are the environment structure of the body
+            assert node.env_structure is node.args
+        if isinstance(node, SequencedBodyAST) and node._sequenced_env_structure is not None:
+            envs[node._sequenced_env_structure] = None
+    assert envs
+    flags = [node._mutable_var_flags for node in all_nodes(m2) if isinstance(node, Let)]
+    assert flags == [node._mutable_var_flags for node in all_nodes(m) if isinstance(node, Let)]
+
+def test_load_from_expansion_cache(tmpdir):
+    source = tmpdir / "prog.rkt"
+    source.write(format_pycket_mod("(define result (+ 1 2))"))
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    assert cache.ensure_directory()
+
+    m = JsonLoader(expansion_cache=cache).expand_file_cached(str(source))
+    entries = [f.basename for f in (tmpdir / "cache").listdir()]
+    assert len([e for e in entries if e.endswith(".ast")]) == 1
+
+    cached = JsonLoader(expansion_cache=cache).expand_file_cached(str(source))
+    assert cached.tostring() == m.tostring()
+    assert run_ast(cached).defs[values.W_Symbol.make("result")].value == 3
+
+def test_prune_env_is_a_header_option(monkeypatch):
+    from pycket import config
+    data = module_cache.dumps(mod("(define (f x) (lambda () x))"))
+    monkeypatch.setattr(config, "prune_env", not config.prune_env)
+    assert module_cache.header() != data[:len(module_cache.header())]
+    with pytest.raises(module_cache.BinaryFormatError):
+        module_cache.loads(data, None)
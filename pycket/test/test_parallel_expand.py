@@ -0,0 +1,71 @@
+import os
+from pycket.expansion_cache import ExpansionCache
+from pycket.parallel_expand import ParallelExpander, expand_dependencies
+
+MODULE = '{"module-name": "%s", "body-forms": [{"require": [%s]}]}'
+
+class CopyingExpander(ParallelExpander):
+    # stands in for racket: the expansion of x.rkt is read from x.rkt.out
+    def command(self, file_name, output, log):
+        return "cp \"%s.out\" \"%s\" 2> \"%s\"" % (file_name, output, log)
+
+def make_program(tmpdir):
+    # prog requires a and b, which both require c
+    graph = {"prog": ["a", "b"], "a": ["c"], "b": ["c"], "c": []}
+    files = {}
+    for name in graph:
+        files[name] = os.path.realpath(str(tmpdir / (name + ".rkt")))
+    for name, deps in graph.items():
+        with open(files[name], "w") as f:
+            f.write("#lang racket/base")
+        requires = ", ".join(['["%s"]' % files[dep] for dep in deps])
+        with open(files[name] + ".out", "w") as f:
+            f.write(MODULE % (name, requires))
+    return files
+
+def make_cache(tmpdir):
+    cache = ExpansionCache(str(tmpdir / "cache"), 1024 * 1024)
+    assert cache.ensure_directory()
+    return cache
+
+def test_expand_graph(tmpdir):
+    files = make_program(tmpdir)
+    cache = make_cache(tmpdir)
+    assert CopyingExpander(cache, "", jobs=2).run(files["prog"]) == 4
+    for fname in files.values():
+        assert cache.lookup(fname, False) is not None
+    assert sorted(cache.cached_dependencies(files["prog"], False)) == sorted([files["a"], files["b"]])
+    # no temporary files are left behind
+    assert not [f for f in os.listdir(cache.directory) if f.startswith("expand-")]
+
+    # a warm cache needs no expansion at all
+    assert CopyingExpander(make_cache(tmpdir), "", jobs=2).run(files["prog"]) == 0
+
+def test_changed_dependency(tmpdir):
+    files = make_program(tmpdir)
+    CopyingExpander(make_cache(tmpdir), "", jobs=2).run(files["prog"])
+    with open(files["c"], "a") as f:
+        f.write(" ")
+    # c and the modules requiring it, directly or not, are expanded again
+    assert CopyingExpander(make_cache(tmpdir), "", jobs=2).run(files["prog"]) == 4
+    assert CopyingExpander(make_cache(tmpdir), "", jobs=2).run(files["prog"]) == 0
+
+def test_failed_expansion(tmpdir):
+    files = make_program(tmpdir)
+    os.remove(files["b"] + ".out")
+    cache = make_cache(tmpdir)
+    assert CopyingExpander(cache, "", jobs=3).run(files["prog"]) == 3
+    assert cache.lookup(files["b"], False) is None
+
+def test_invalid_expansion(tmpdir):
+    files = make_program(tmpdir)
+    with open(files["b"] + ".out", "w") as f:
+        f.write('{"module-name": "b", "body-forms": [')
+    cache = make_cache(tmpdir)
+    # the other modules are still expanded
+    assert CopyingExpander(cache, "", jobs=3).run(files["prog"]) == 3
+    assert cache.lookup(files["b"], False) is None
+
+def test_sequential(tmpdir):
+    files = make_program(tmpdir)
+    assert expand_dependencies(files["prog"], make_cache(tmpdir), "", jobs=1) == 0
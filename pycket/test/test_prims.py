@@ -56,6 +56,47 @@ def test_equal2(doctest):
     #f
     """
 
+def test_equal_cycles(doctest):
+    """
+    ! (define a (mcons 1 2))
+    ! (set-mcdr! a a)
+    ! (define b (mcons 1 (mcons 1 2)))
+    ! (set-mcdr! (mcdr b) b)
+    ! (define c (mcons 2 2))
+    ! (set-mcdr! c c)
+    ! (define v (make-vector 2 1))
+    ! (vector-set! v 1 v)
+    ! (define w (make-vector 2 1))
+    ! (vector-set! w 1 w)
+    > (equal? a b)
+    #t
+    > (equal? a c)
+    #f
+    > (equal? v w)
+    #t
+    > (equal? (list v 1) (list w 2))
+    #f
+    """
+
+def test_equal_fallback(doctest):
+    """
+    ! (struct p (x y) #:transparent)
+    ! (struct q (x) #:property prop:equal+hash (list (lambda (a b r) #t) (lambda (a r) 1) (lambda (a r) 1)))
+    ! (define v (chaperone-vector (vector 1 2) (lambda (v i x) x) (lambda (v i x) x)))
+    > (equal? (vector 1 2) (vector 1 2))
+    #t
+    > (equal? (vector #\\a #\\b) (vector #\\a #\\c))
+    #f
+    > (equal? (list (p 1 "x") (box 2)) (list (p 1 "x") (box 2)))
+    #t
+    > (equal? (p 1 2) (p 1 3))
+    #f
+    > (equal? (list (q 1)) (list (q 2)))
+    #t
+    > (equal? (list 1 v) (list 1 (vector 1 2)))
+    #t
+    """
+
 ###############################################################################
 
 def test_append_single(doctest):
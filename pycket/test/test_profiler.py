@@ -0,0 +1,86 @@
+import time
+from pycket.profiler import Profiler, lambda_label, snapshot
+
+class FakeSourceInfo(object):
+    def __init__(self, sourcefile, line, column, position=0):
+        self.sourcefile = sourcefile
+        self.line = line
+        self.column = column
+        self.position = position
+
+class FakeLambda(object):
+    def __init__(self, sourceinfo):
+        self.sourceinfo = sourceinfo
+
+class FakeAST(object):
+    def __init__(self, lam):
+        self.surrounding_lambda = lam
+
+class FakeCont(object):
+    def __init__(self, ast, prev):
+        self.ast = ast
+        self.prev = prev
+
+    def get_ast(self):
+        return self.ast
+
+    def get_previous_continuation(self):
+        return self.prev
+
+f = FakeLambda(FakeSourceInfo("a.rkt", 3, 2))
+g = FakeLambda(FakeSourceInfo("a.rkt", 7, 0))
+
+def test_lambda_label():
+    assert lambda_label(f) == "a.rkt:3:2"
+    assert lambda_label(None) == "<toplevel>"
+    assert lambda_label(FakeLambda(FakeSourceInfo(None, -1, -1, 42))) == "<unknown>:42"
+
+def test_snapshot():
+    # g waits on f, which waits twice on the top level
+    cont = FakeCont(FakeAST(f), FakeCont(FakeAST(f), FakeCont(FakeAST(None), None)))
+    cont = FakeCont(None, cont)
+    assert snapshot(FakeAST(g), cont) == ["a.rkt:7:0", "a.rkt:3:2", "<toplevel>"]
+    assert snapshot(None, None) == ["<toplevel>"]
+
+def test_report():
+    profiler = Profiler()
+    profiler.record(["g", "f", "<toplevel>"])
+    profiler.record(["g", "f", "<toplevel>"])
+    profiler.record(["f", "f", "<toplevel>"])
+    assert profiler.samples == 3
+    collapsed = sorted(profiler.format_collapsed().splitlines())
+    assert collapsed == ["<toplevel>;f;f 1", "<toplevel>;f;g 2"]
+    assert profiler.srclocs["f"].self_count == 1
+    # recursion is counted once
+    assert profiler.srclocs["f"].total_count == 3
+    lines = profiler.format_table().splitlines()
+    assert lines[0] == "Profile (3 samples)"
+    assert lines[3].split() == ["2", "66.7", "2", "66.7", "g"]
+    assert lines[4].split() == ["1", "33.3", "3", "100.0", "f"]
+
+def test_timer_fires():
+    profiler = Profiler()
+    assert profiler.start()
+    assert not profiler.start()
+    try:
+        end = time.time() + 5
+        while not profiler.pending and time.time() < end:
+            pass
+        profiler.poll(FakeAST(f), None)
+    finally:
+        profiler.stop()
+    assert not profiler.active
+    assert profiler.samples == 1
+    assert profiler.stacks == {"a.rkt:3:2": 1}
+
+def test_pycket_profile_primitive():
+    from pycket.test.testhelper import run_mod_expr
+    result = run_mod_expr("""
+        (pycket-profile
+          (lambda ()
+            (let loop ([i 0] [acc 0])
+              (if (< i 100000) (loop (+ i 1) (+ acc i)) acc))))
+    """, wrap=True)
+    assert result.value == 4999950000
+    from pycket.profiler import profiler
+    assert not profiler.active
@@ -0,0 +1,46 @@
+import json
+from pycket.startup_stats import StartupStats, memory_usage
+
+def test_nested_phases_are_exclusive(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr("pycket.startup_stats.time.time", lambda: clock[0])
+    stats = StartupStats()
+    stats.enable()
+    outer = stats.start("instantiate", "a.rkt")
+    clock[0] += 1.0
+    inner = stats.start("expand", "b.rkt")
+    clock[0] += 3.0
+    stats.stop(inner)
+    clock[0] += 0.5
+    stats.stop(outer)
+    assert stats.entries[("instantiate", "a.rkt")].time == 1.5
+    assert stats.entries[("expand", "b.rkt")].time == 3.0
+    assert [e.phase for e in stats.phase_totals()] == ["expand", "instantiate"]
+
+def test_unbalanced_timers(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr("pycket.startup_stats.time.time", lambda: clock[0])
+    stats = StartupStats()
+    stats.enable()
+    outer = stats.start("load", "a.rkt")
+    # an exception skipped the stop of this one
+    stats.start("to-ast", "a.rkt")
+    clock[0] += 2.0
+    stats.stop(outer)
+    assert stats.stack == []
+    assert stats.entries[("load", "a.rkt")].time == 2.0
+
+def test_reports():
+    stats = StartupStats()
+    stats.enable()
+    for phase, module in [("expand", "a.rkt"), ("expand", "b.rkt"), ("to-ast", 'c "d".rkt')]:
+        stats.stop(stats.start(phase, module))
+    table = stats.format_table()
+    assert "expand" in table and "other" in table and "b.rkt" in table
+    data = json.loads(stats.format_json())
+    expand, = [p for p in data["phases"] if p["phase"] == "expand"]
+    assert expand["count"] == 2
+    assert 'c "d".rkt' in [m["module"] for m in data["modules"]]
+
+def test_memory_usage():
+    assert memory_usage() >= 0
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from pycket                   import config
+from pycket                   import native_stack
 from pycket.arity             import Arity
 from pycket.base              import W_Object, W_ProtoObject, UnhashableType
 from pycket.cont              import continuation, label, NilCont
@@ -185,6 +186,7 @@ class W_ContinuationMarkSet(W_Object):
     _attrs_ = _immutable_fields_ = ["cont", "prompt_tag"]
 
     def __init__(self, cont, prompt_tag):
+        native_stack.escape()
         self.cont = cont
         self.prompt_tag = prompt_tag
 
@@ -310,12 +312,8 @@ class W_Cons(W_List):
         return True
 
     def hash_equal(self, info=None):
-        x = 0x345678
-        while isinstance(self, W_Cons):
-            car, self = self.car(), self.cdr()
-            y = car.hash_equal(info=info)
-            x = rarithmetic.intmask((1000003 * x) ^ y)
-        return x
+        from pycket.hash.equal import equal_hash
+        return equal_hash(self)
 
     def equal(self, other):
         if not isinstance(other, W_Cons):
@@ -1266,9 +1264,9 @@ class W_ThunkProcCMK(W_Procedure):
 
 
 class W_Prim(W_Procedure):
-    _attrs_ = _immutable_fields_ = ["name", "code", "arity", "result_arity", "simple1", "simple2"]
+    _attrs_ = _immutable_fields_ = ["name", "code", "arity", "result_arity", "simple1", "simple2", "simple3", "simple_call"]
 
-    def __init__ (self, name, code, arity=Arity.unknown, result_arity=None, simple1=None, simple2=None):
+    def __init__ (self, name, code, arity=Arity.unknown, result_arity=None, simple1=None, simple2=None, simple3=None, simple_call=None):
         self.name = W_Symbol.make(name)
         self.code = code
         assert isinstance(arity, Arity)
@@ -1276,6 +1274,9 @@ class W_Prim(W_Procedure):
         self.result_arity = result_arity
         self.simple1 = simple1
         self.simple2 = simple2
+        self.simple3 = simple3
+        # takes the list of arguments, for simple primitives of any arity
+        self.simple_call = simple_call
 
     def get_arity(self, promote=False):
         if promote:
@@ -1376,6 +1377,7 @@ class W_Continuation(W_Procedure):
     escape = False
 
     def __init__(self, cont, prompt_tag=None):
+        native_stack.escape()
         self.cont = cont
         self.prompt_tag = prompt_tag
 
@@ -1401,6 +1403,7 @@ class W_ComposableContinuation(W_Procedure):
     _attrs_ = _immutable_fields_ = ["cont", "prompt_tag"]
 
     def __init__(self, cont, prompt_tag=None):
+        native_stack.escape()
         self.cont = cont
         self.prompt_tag = prompt_tag
 
@@ -1467,12 +1470,27 @@ class W_Closure(W_Procedure):
         raise SchemeException("No matching arity in case-lambda")
 
     def call_with_extra_info(self, args, env, cont, calling_app):
+        jit.promote(self.caselam)
+        (actuals, frees, lam) = self._find_lam(args)
+        return self._call_lam(lam, actuals, frees, env, cont, calling_app)
+
+    def call_lam_index(self, index, args, env, cont, calling_app):
+        """ Call the lambda at `index`, which is known to accept `args` """
+        lam = self.caselam.lams[index]
+        actuals = lam.match_args(args)
+        assert actuals is not None
+        return self.call_lam(index, lam, actuals, env, cont, calling_app)
+
+    def call_lam(self, index, lam, actuals, env, cont, calling_app):
+        """ Call the lambda at `index` with arguments it has already matched """
+        return self._call_lam(lam, actuals, self._get_list(index), env, cont,
+                              calling_app)
+
+    def _call_lam(self, lam, actuals, frees, env, cont, calling_app):
         env_structure = None
         if calling_app is not None:
             env_structure = calling_app.env_structure
-        jit.promote(self.caselam)
         jit.promote(env_structure)
-        (actuals, frees, lam) = self._find_lam(args)
         if not jit.we_are_jitted() and env.pycketconfig().callgraph:
             env.toplevel_env().callgraph.register_call(lam, calling_app, cont, env)
         # specialize on the fact that often we end up executing in the
@@ -1523,17 +1541,22 @@ class W_Closure1AsEnv(ConsEnv):
         return caselam.get_arity()
 
     def call_with_extra_info(self, args, env, cont, calling_app):
+        jit.promote(self.caselam)
+        lam = self.caselam.lams[0]
+        actuals = lam.match_args(args)
+        if actuals is None:
+            lam.raise_nice_error(args)
+        return self.call_lam(lam, actuals, env, cont, calling_app)
+
+    def call_lam(self, lam, actuals, env, cont, calling_app):
+        """ Call the lambda of the closure with arguments it has already
+        matched """
         env_structure = None
         if calling_app is not None:
             env_structure = calling_app.env_structure
-        jit.promote(self.caselam)
         jit.promote(env_structure)
-        lam = self.caselam.lams[0]
         if not jit.we_are_jitted() and env.pycketconfig().callgraph:
             env.toplevel_env().callgraph.register_call(lam, calling_app, cont, env)
-        actuals = lam.match_args(args)
-        if actuals is None:
-            lam.raise_nice_error(args)
         # specialize on the fact that often we end up executing in the
         # same environment.
         prev = lam.env_structure.prev.find_env_in_chain_speculate(
@@ -224,9 +224,21 @@ class W_AsciiImmutableString(W_ImmutableString):
 
 
 class W_UnicodeImmutableString(W_ImmutableString):
+    _attrs_ = ['hash_cache']
+
+    def __init__(self, strategy, storage):
+        W_ImmutableString.__init__(self, strategy, storage)
+        self.hash_cache = 0
+
     def get_strategy(self):
         return UnicodeStringStrategy.singleton
 
+    def hash_equal(self, info=None):
+        # hashing the unicode strategy builds a unicode string first
+        if self.hash_cache == 0:
+            self.hash_cache = W_ImmutableString.hash_equal(self)
+        return self.hash_cache
+
 
 class StringStrategy(object):
     __metaclass__ = SingletonMeta
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 #
 
-from pycket.entry_point import target, get_additional_config_options, take_options
+from pycket.entry_point import target, get_additional_config_options, take_options, jitpolicy
 
 if __name__ == '__main__':
     from pycket.__main__ import main